@@ -0,0 +1,468 @@
+# backend/balance_ledger.py
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import sqlite3
+import threading
+from contextlib import ExitStack
+
+from log_writer import log_segments
+from metrics import BALANCE_LOCK_WAIT, timed_lock
+
+
+# Users hash onto this many locks, so changes for different users rarely contend
+LOCK_STRIPES = 64
+
+
+class InsufficientFunds(Exception):
+    """Raised when a change would take a balance below its floor."""
+
+
+class BalanceLedger:
+    """
+    User balances held in memory, made durable by a write-ahead log.
+
+    The WAL is balance_log.jsonl itself: every change appends the same
+    {"timestamp", "user_id", "change", "reason"} record it always has,
+    through `wal` (an AppendLogWriter, which may rotate the file).
+    A periodic snapshot stores the balances plus the WAL position it
+    covers, so startup loads the snapshot and replays only the log tail.
+
+    Reads are a plain dict lookup and never take a lock. Writes lock only
+    the user's stripe.
+
+    Holds (two-phase reservations for in-flight jobs) are logged as
+    records with a `hold_id` and rebuilt on replay like balances.
+
+    An optional BalanceLogIndex maps each user to their records' WAL
+    positions, so `history()` reads just their lines instead of scanning
+    the whole log.
+
+    The ledger only works within a single process: `load()` takes an
+    exclusive lock on the WAL, and a second process fails to start
+    instead of keeping balances of its own.
+    """
+
+    def __init__(self, snapshot_path, wal, legacy_balances_path=None, snapshot_every=1000, index=None):
+        self.snapshot_path = snapshot_path
+        self.wal = wal
+        self.index = index
+        self.legacy_balances_path = legacy_balances_path
+        self.snapshot_every = snapshot_every
+
+        self.balances = {}
+        self.holds = {}  # hold_id -> {"user_id", "amount"}
+        self.held = {}   # user_id -> total amount on hold
+        self.stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.snapshot_seq = 0  # WAL sequence number covered by the last snapshot
+        self.snapshot_requested = threading.Event()
+        self.lock_file = None
+
+    def _stripe(self, user_id):
+        return self.stripes[zlib.crc32(str(user_id).encode()) % LOCK_STRIPES]
+
+    # --- reads ---
+
+    def get(self, user_id):
+        return round(self.balances.get(user_id, 0.0), 2)
+
+    def available(self, user_id):
+        """Balance minus everything currently on hold."""
+        return round(self.balances.get(user_id, 0.0) - self.held.get(user_id, 0.0), 2)
+
+    def history(self, user_id, since=None, limit=50):
+        """
+        The user's credits and deductions, newest first: looked up in the
+        index when there is one, otherwise read from the log itself.
+        """
+        self.wal.flush()
+        if self.index is None:
+            return scan_history(self.wal.path, user_id, since, limit)
+        return self.index.history(self.wal.path, user_id, since, limit)
+
+    # --- writes ---
+
+    def update(self, user_id, delta, reason, floor=None):
+        """
+        Logs the change, then applies it. Returns the new balance.
+        With a `floor`, raises InsufficientFunds instead of going below it.
+        """
+        with timed_lock(self._stripe(user_id), BALANCE_LOCK_WAIT):
+            if floor is not None and round(self.balances.get(user_id, 0.0) + delta, 2) < floor:
+                raise InsufficientFunds(user_id)
+            new_balance, seq = self._log_and_apply(user_id, delta, reason)
+        self.wal.sync(seq)
+        return new_balance
+
+    def reserve(self, user_id, hold_id, amount):
+        """Puts `amount` on hold, or raises InsufficientFunds."""
+        with timed_lock(self._stripe(user_id), BALANCE_LOCK_WAIT):
+            if self.available(user_id) < amount:
+                raise InsufficientFunds(user_id)
+            _, seq = self._log_and_apply(user_id, 0, "hold", hold_id=hold_id, hold=amount)
+        self.wal.sync(seq)
+
+    def commit(self, hold_id, user_id, actual, reason="job deduction", portion=None, floor=None):
+        """
+        Charges the actual cost and releases `portion` of the hold (all of
+        it by default). Returns the new balance. With a `floor`, raises
+        InsufficientFunds instead of going below it; the hold is then kept.
+        """
+        with timed_lock(self._stripe(user_id), BALANCE_LOCK_WAIT):
+            if floor is not None and round(self.balances.get(user_id, 0.0) - actual, 2) < floor:
+                raise InsufficientFunds(user_id)
+            new_balance, seq = self._log_and_apply(
+                user_id, -actual, reason,
+                hold_id=hold_id, hold_release=self._release_amount(hold_id, portion)
+            )
+        self.wal.sync(seq)
+        return new_balance
+
+    def release(self, hold_id, user_id, portion=None):
+        """Drops `portion` of the hold (all of it by default) without charging."""
+        with timed_lock(self._stripe(user_id), BALANCE_LOCK_WAIT):
+            if hold_id not in self.holds:
+                return
+            _, seq = self._log_and_apply(
+                user_id, 0, "hold release",
+                hold_id=hold_id, hold_release=self._release_amount(hold_id, portion)
+            )
+        self.wal.sync(seq)
+
+    def _release_amount(self, hold_id, portion):
+        hold = self.holds.get(hold_id)
+        if hold is None:
+            return 0
+        return hold["amount"] if portion is None else min(portion, hold["amount"])
+
+    def _log_and_apply(self, user_id, delta, reason, **extra):
+        record = {
+            "timestamp": int(time.time()),
+            "user_id": user_id,
+            "change": delta,
+            "reason": reason
+        }
+        record.update(extra)
+
+        # Queued under the stripe lock, so each user's records stay in order
+        seq = self.wal.append(record)
+        if seq - self.snapshot_seq >= self.snapshot_every:
+            self.snapshot_requested.set()
+
+        return apply_record(self.balances, self.holds, self.held, record), seq
+
+    def pending_changes(self):
+        """WAL records not yet covered by a snapshot."""
+        return self.wal.appended - self.snapshot_seq
+
+    # --- startup / snapshots ---
+
+    def _lock_wal(self):
+        if self.lock_file is not None:
+            return
+        lock_file = open(self.wal.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(
+                f"{self.wal.path} is in use by another process; "
+                "run every process that shares it with BALANCE_STORE=sqlite"
+            )
+        self.lock_file = lock_file
+
+    def close(self):
+        self.wal.close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def load(self):
+        """Loads the latest snapshot and replays the WAL written after it."""
+        self._lock_wal()
+        with ExitStack() as stack:
+            for lock in self.stripes:
+                stack.enter_context(lock)
+
+            self.wal.flush()
+            balances, holds = {}, {}
+            position = (0, 0)
+            imported = False
+
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, "r") as f:
+                    snapshot = json.load(f)
+                balances = snapshot["balances"]
+                holds = snapshot.get("holds", {})
+                # Snapshots from before log rotation only know an offset into segment 0
+                position = tuple(snapshot.get("wal_position", (0, snapshot.get("wal_offset", 0))))
+            elif self.legacy_balances_path and os.path.exists(self.legacy_balances_path):
+                # First start after the ledger was introduced: balances.json
+                # already reflects every record in the existing log.
+                with open(self.legacy_balances_path, "r") as f:
+                    balances = json.load(f)
+                position = self.wal.position()
+                imported = True
+
+            held = {}
+            for hold in holds.values():
+                held[hold["user_id"]] = held.get(hold["user_id"], 0.0) + hold["amount"]
+
+            replayed = 0
+            for segment, path in log_segments(self.wal.path):
+                if segment < position[0] or not os.path.exists(path):
+                    continue
+                with open(path, "r") as f:
+                    if segment == position[0]:
+                        f.seek(position[1])
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue  # Torn final line from a crash mid-write
+                        apply_record(balances, holds, held, record)
+                        replayed += 1
+
+            self.balances = balances
+            self.holds = holds
+            self.held = held
+            # Replayed records count as changes, so the next snapshot covers them
+            self.snapshot_seq = self.wal.appended - replayed
+
+            if imported:
+                # balances.json is no longer rewritten on every change, so
+                # without a snapshot a restart would start from it again and
+                # skip every change logged in between
+                self._write_snapshot(balances, holds, self.wal.position())
+                self.snapshot_seq = self.wal.appended
+
+            if self.index is not None:
+                self.wal.on_write = self.index.add
+                self.index.catch_up(self.wal.path)
+
+        return len(balances), replayed
+
+    def snapshot(self):
+        # Every stripe is held so the copy matches the WAL position exactly
+        with ExitStack() as stack:
+            for lock in self.stripes:
+                stack.enter_context(lock)
+            self.wal.flush()
+            position = self.wal.position()
+            self.snapshot_seq = self.wal.appended
+            balances = dict(self.balances)
+            holds = {hold_id: dict(hold) for hold_id, hold in self.holds.items()}
+
+        self._write_snapshot(balances, holds, position)
+
+    def _write_snapshot(self, balances, holds, position):
+        write_json_atomic(self.snapshot_path, {
+            "balances": balances,
+            "holds": holds,
+            "wal_position": list(position)
+        })
+        if self.legacy_balances_path:
+            # Keep balances.json readable for anything that still looks at it
+            write_json_atomic(self.legacy_balances_path, balances)
+
+    def start_snapshotter(self, interval=60):
+        def loop():
+            while True:
+                self.snapshot_requested.wait(interval)
+                self.snapshot_requested.clear()
+                if not self.pending_changes():
+                    continue
+                try:
+                    self.snapshot()
+                except Exception as e:
+                    print(f"❌ Failed to snapshot balances: {e}")
+
+        threading.Thread(target=loop, name="balance-snapshotter", daemon=True).start()
+
+
+class BalanceLogIndex:
+    """
+    SQLite index of where each user's balance log records live:
+    (user_id, timestamp, segment, offset). Filled from the log writer as
+    records are written, and caught up from the log itself on startup,
+    so a history query reads only the matching lines.
+
+    Pure hold bookkeeping (no balance change) is not indexed.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS balance_index (
+                segment INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                user_id TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                PRIMARY KEY (segment, offset)
+            );
+            CREATE INDEX IF NOT EXISTS balance_index_user_time
+                ON balance_index (user_id, timestamp, segment, offset);
+            CREATE TABLE IF NOT EXISTS balance_index_position (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                segment INTEGER NOT NULL,
+                offset INTEGER NOT NULL
+            );
+        """)
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def add(self, segment, entries, end):
+        """Indexes [(offset, record)] written to `segment`, which now ends at `end`."""
+        rows = [
+            (segment, offset, record["user_id"], record["timestamp"])
+            for offset, record in entries
+            if record.get("change")
+        ]
+
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO balance_index (segment, offset, user_id, timestamp) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            conn.execute(
+                "INSERT INTO balance_index_position (id, segment, offset) VALUES (1, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET segment = excluded.segment, offset = excluded.offset "
+                "WHERE (excluded.segment, excluded.offset) > (segment, offset)",
+                (segment, end)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def catch_up(self, log_path):
+        """Indexes whatever the log holds past the last indexed position."""
+        row = self._conn().execute(
+            "SELECT segment, offset FROM balance_index_position WHERE id = 1"
+        ).fetchone()
+        position = row or (0, 0)
+
+        indexed = 0
+        for segment, path in log_segments(log_path):
+            if segment < position[0] or not os.path.exists(path):
+                continue
+            entries = []
+            with open(path, "rb") as f:
+                if segment == position[0]:
+                    f.seek(position[1])
+                offset = f.tell()
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Still being written
+                    try:
+                        entries.append((offset, json.loads(line)))
+                    except ValueError:
+                        pass
+                    offset += len(line)
+            self.add(segment, entries, offset)
+            indexed += len(entries)
+        return indexed
+
+    def history(self, log_path, user_id, since=None, limit=50):
+        rows = self._conn().execute(
+            "SELECT segment, offset FROM balance_index "
+            "WHERE user_id = ? AND timestamp >= ? "
+            "ORDER BY timestamp DESC, segment DESC, offset DESC LIMIT ?",
+            (user_id, since or 0, limit)
+        ).fetchall()
+
+        paths = dict(log_segments(log_path))
+        files = {}
+        records = []
+        try:
+            for segment, offset in rows:
+                if segment not in files:
+                    path = paths.get(segment)
+                    files[segment] = open(path, "r") if path and os.path.exists(path) else None
+                f = files[segment]
+                if f is None:
+                    continue  # Segment was deleted
+                f.seek(offset)
+                records.append(history_entry(json.loads(f.readline())))
+        finally:
+            for f in files.values():
+                if f is not None:
+                    f.close()
+        return records
+
+
+def history_entry(record):
+    return {
+        "timestamp": record["timestamp"],
+        "change": record["change"],
+        "reason": record.get("reason")
+    }
+
+
+def scan_history(log_path, user_id, since=None, limit=50):
+    """
+    BalanceLogIndex.history without the index: reads the log's segments
+    newest first and stops once `limit` records are found.
+    """
+    records = []
+    for _, path in reversed(log_segments(log_path)):
+        if not os.path.exists(path):
+            continue
+        matches = []
+        with open(path, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # Still being written
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("user_id") == user_id and record.get("change") and \
+                        record["timestamp"] >= (since or 0):
+                    matches.append(history_entry(record))
+        records.extend(reversed(matches))
+        if len(records) >= limit:
+            break
+    records.sort(key=lambda record: record["timestamp"], reverse=True)
+    return records[:limit]
+
+
+def apply_record(balances, holds, held, record):
+    user_id = record["user_id"]
+    hold_id = record.get("hold_id")
+
+    if "hold" in record:
+        holds[hold_id] = {"user_id": user_id, "amount": record["hold"]}
+        held[user_id] = round(held.get(user_id, 0.0) + record["hold"], 6)
+    elif record.get("hold_release") and hold_id in holds:
+        released = record["hold_release"]
+        holds[hold_id]["amount"] = round(holds[hold_id]["amount"] - released, 6)
+        if holds[hold_id]["amount"] <= 0:
+            del holds[hold_id]
+        held[user_id] = round(held.get(user_id, 0.0) - released, 6)
+        if held[user_id] <= 0:
+            del held[user_id]
+
+    new_balance = round(balances.get(user_id, 0.0) + record["change"], 2)
+    balances[user_id] = new_balance
+    return new_balance
+
+
+def write_json_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
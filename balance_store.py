@@ -0,0 +1,251 @@
+# backend/balance_store.py
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from balance_ledger import BalanceLedger, BalanceLogIndex, InsufficientFunds
+from log_writer import AppendLogWriter, log_segments
+from metrics import BALANCE_LOCK_WAIT
+
+
+class SQLiteBalanceStore:
+    """
+    Balances in a SQLite database (WAL mode), shared by every process.
+
+    Each update is one transaction: a conditional UPDATE of the user's
+    row plus the matching balance_log insert, so there is no global lock
+    and no read-modify-write of a JSON file.
+
+    Holds for in-flight jobs live in their own table; the available
+    balance is the stored balance minus the user's holds.
+    """
+
+    def __init__(self, db_path, legacy_balances_path=None, legacy_log_path=None):
+        self.db_path = db_path
+        self.legacy_balances_path = legacy_balances_path
+        self.legacy_log_path = legacy_log_path
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def load(self):
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS balances (
+                user_id TEXT PRIMARY KEY,
+                balance REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS balance_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp INTEGER NOT NULL,
+                user_id TEXT NOT NULL,
+                change REAL NOT NULL,
+                reason TEXT
+            );
+            CREATE INDEX IF NOT EXISTS balance_log_user_time ON balance_log (user_id, timestamp);
+            CREATE TABLE IF NOT EXISTS balance_holds (
+                hold_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                amount REAL NOT NULL,
+                created_at INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS balance_holds_user ON balance_holds (user_id);
+        """)
+
+        users = conn.execute("SELECT COUNT(*) FROM balances").fetchone()[0]
+        if users == 0:
+            self._import_legacy(conn)
+            users = conn.execute("SELECT COUNT(*) FROM balances").fetchone()[0]
+        return users, 0
+
+    def _import_legacy(self, conn):
+        """One-off import of balances.json and balance_log.jsonl."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.legacy_balances_path and os.path.exists(self.legacy_balances_path):
+                with open(self.legacy_balances_path, "r") as f:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO balances (user_id, balance) VALUES (?, ?)",
+                        json.load(f).items()
+                    )
+
+            if self.legacy_log_path \
+                    and conn.execute("SELECT COUNT(*) FROM balance_log").fetchone()[0] == 0:
+                rows = []
+                for _, path in log_segments(self.legacy_log_path):
+                    if not os.path.exists(path):
+                        continue
+                    with open(path, "r") as f:
+                        for line in f:
+                            try:
+                                record = json.loads(line)
+                            except ValueError:
+                                continue
+                            if not record.get("change"):
+                                continue  # Ledger hold bookkeeping; holds are not carried over
+                            rows.append((record["timestamp"], record["user_id"], record["change"], record.get("reason")))
+                conn.executemany(
+                    "INSERT INTO balance_log (timestamp, user_id, change, reason) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def start_snapshotter(self, interval=60):
+        pass  # Every update is already durable
+
+    # --- reads ---
+
+    def get(self, user_id):
+        row = self._conn().execute(
+            "SELECT balance FROM balances WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return round(row[0], 2) if row else 0.0
+
+    def available(self, user_id):
+        """Balance minus everything currently on hold."""
+        row = self._conn().execute(
+            "SELECT COALESCE((SELECT balance FROM balances WHERE user_id = ?), 0) - "
+            "COALESCE((SELECT SUM(amount) FROM balance_holds WHERE user_id = ?), 0)",
+            (user_id, user_id)
+        ).fetchone()
+        return round(row[0], 2)
+
+    def history(self, user_id, since=None, limit=50):
+        """The user's credits and deductions, newest first."""
+        rows = self._conn().execute(
+            "SELECT timestamp, change, reason FROM balance_log "
+            "WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (user_id, since or 0, limit)
+        ).fetchall()
+        return [{"timestamp": timestamp, "change": change, "reason": reason} for timestamp, change, reason in rows]
+
+    # --- writes ---
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        BALANCE_LOCK_WAIT.observe(time.perf_counter() - start)
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def update(self, user_id, delta, reason, floor=None):
+        """
+        Applies `delta` and logs it atomically. Returns the new balance.
+        With a `floor`, raises InsufficientFunds instead of going below it.
+        """
+        with self._transaction() as conn:
+            return self._apply(conn, user_id, delta, reason, floor)
+
+    def reserve(self, user_id, hold_id, amount):
+        """Puts `amount` on hold, or raises InsufficientFunds."""
+        with self._transaction() as conn:
+            inserted = conn.execute(
+                "INSERT INTO balance_holds (hold_id, user_id, amount, created_at) "
+                "SELECT ?, ?, ?, ? WHERE "
+                "COALESCE((SELECT balance FROM balances WHERE user_id = ?), 0) - "
+                "COALESCE((SELECT SUM(amount) FROM balance_holds WHERE user_id = ?), 0) >= ?",
+                (hold_id, user_id, amount, int(time.time()), user_id, user_id, amount)
+            ).rowcount
+            if not inserted:
+                raise InsufficientFunds(user_id)
+
+    def commit(self, hold_id, user_id, actual, reason="job deduction", portion=None, floor=None):
+        """
+        Charges the actual cost and releases `portion` of the hold (all of
+        it by default). Returns the new balance. With a `floor`, raises
+        InsufficientFunds instead of going below it; the hold is then kept.
+        """
+        with self._transaction() as conn:
+            self._release(conn, hold_id, portion)
+            return self._apply(conn, user_id, -actual, reason, floor)
+
+    def release(self, hold_id, user_id, portion=None):
+        """Drops `portion` of the hold (all of it by default) without charging."""
+        with self._transaction() as conn:
+            self._release(conn, hold_id, portion)
+
+    def _apply(self, conn, user_id, delta, reason, floor=None):
+        conn.execute("INSERT OR IGNORE INTO balances (user_id, balance) VALUES (?, 0)", (user_id,))
+        row = conn.execute(
+            "UPDATE balances SET balance = ROUND(balance + ?, 2) "
+            "WHERE user_id = ? AND (? IS NULL OR ROUND(balance + ?, 2) >= ?) "
+            "RETURNING balance",
+            (delta, user_id, floor, delta, floor)
+        ).fetchone()
+        if row is None:
+            raise InsufficientFunds(user_id)
+
+        conn.execute(
+            "INSERT INTO balance_log (timestamp, user_id, change, reason) VALUES (?, ?, ?, ?)",
+            (int(time.time()), user_id, delta, reason)
+        )
+        return row[0]
+
+    def _release(self, conn, hold_id, portion):
+        if portion is None:
+            conn.execute("DELETE FROM balance_holds WHERE hold_id = ?", (hold_id,))
+            return
+        conn.execute(
+            "UPDATE balance_holds SET amount = ROUND(amount - ?, 6) WHERE hold_id = ?",
+            (portion, hold_id)
+        )
+        conn.execute("DELETE FROM balance_holds WHERE hold_id = ? AND amount <= 0", (hold_id,))
+
+def make_balance_store(kind, base_dir):
+    """
+    Builds the balance backend named by BALANCE_STORE: "ledger" (in-process)
+    or "sqlite" (shared across gunicorn workers and hosts that share the
+    volume). The default is the ledger, except with a JOB_QUEUE: then
+    workers and the web process must share balances and holds, so sqlite
+    is the default and the ledger is refused.
+    """
+    if not kind:
+        kind = "sqlite" if os.environ.get("JOB_QUEUE") else "ledger"
+    elif kind == "ledger" and os.environ.get("JOB_QUEUE"):
+        raise ValueError("BALANCE_STORE=ledger cannot be shared with JOB_QUEUE workers; use sqlite")
+
+    balances_path = os.path.join(base_dir, "balances.json")
+    log_path = os.path.join(base_dir, "balance_log.jsonl")
+
+    if kind == "sqlite":
+        return SQLiteBalanceStore(
+            os.environ.get("BALANCES_DB_FILE", os.path.join(base_dir, "balances.db")),
+            legacy_balances_path=balances_path,
+            legacy_log_path=log_path
+        )
+    if kind == "ledger":
+        wal = AppendLogWriter(
+            log_path,
+            fsync=os.environ.get("BALANCE_LOG_FSYNC", "interval"),
+            fsync_interval=float(os.environ.get("BALANCE_LOG_FSYNC_INTERVAL", 1.0)),
+            max_bytes=int(os.environ.get("BALANCE_LOG_MAX_BYTES", 0)) or None,
+            rotate_daily=os.environ.get("BALANCE_LOG_ROTATE_DAILY", "").lower() in ("1", "true", "yes")
+        )
+        return BalanceLedger(
+            os.path.join(base_dir, "balance_snapshot.json"),
+            wal,
+            legacy_balances_path=balances_path,
+            snapshot_every=int(os.environ.get("BALANCE_SNAPSHOT_EVERY", 1000)),
+            index=BalanceLogIndex(os.path.join(base_dir, "balance_index.db"))
+        )
+    raise ValueError(f"Unknown BALANCE_STORE backend: {kind}")
@@ -0,0 +1,129 @@
+# backend/example_catalog.py
+
+import os
+import re
+import glob
+import time
+import random
+import threading
+
+from example_index import ExampleIndex
+from prompt_budget import count_tokens, minify_lilypond
+
+
+EXAMPLE_PATTERN = "example_score_*.ly"
+
+STAFF_RE = re.compile(r"\\new\s+(?:Staff|DrumStaff|TabStaff|RhythmicStaff)\b")
+ASSIGNMENT_RE = re.compile(r"^([A-Za-z]+)\s*=\s*(?:\\[A-Za-z]+\s*)?\{", re.MULTILINE)
+
+
+class ExampleScoreCatalog:
+    """
+    The example scores used as formatting/harmony templates, read once
+    and kept in memory with their metadata. A watcher thread polls the
+    directory's mtimes and swaps in a fresh list when files are added,
+    changed or removed, so picking an example never touches the disk.
+
+    `choose(prompt)` asks an ExampleIndex, rebuilt on every load, for the
+    template closest to the prompt.
+    """
+
+    def __init__(self, directory, pattern=EXAMPLE_PATTERN):
+        self.directory = directory
+        self.pattern = pattern
+        self.examples = []
+        self.index = ExampleIndex([])
+        self.signature = None
+
+    def _scan(self):
+        """{path: (mtime, size)} for every example file."""
+        signature = {}
+        for path in glob.glob(os.path.join(self.directory, self.pattern)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature[path] = (stat.st_mtime, stat.st_size)
+        return signature
+
+    def load(self):
+        signature = self._scan()
+        examples = []
+        for path in sorted(signature):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    examples.append(describe_example(path, f.read()))
+            except (OSError, UnicodeDecodeError) as e:
+                print(f"❌ Failed to load example score {path}: {e}")
+
+        # Readers only ever see a complete list and its matching index
+        self.index = ExampleIndex(examples)
+        self.examples = examples
+        self.signature = signature
+        return len(examples)
+
+    def reload_if_changed(self):
+        if self._scan() == self.signature:
+            return False
+        self.load()
+        return True
+
+    def start_watcher(self, interval=10):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.reload_if_changed():
+                        print(f"🎼 Reloaded {len(self.examples)} example scores")
+                except Exception as e:
+                    print(f"❌ Failed to reload example scores: {e}")
+
+        threading.Thread(target=loop, name="example-score-watcher", daemon=True).start()
+
+    def __len__(self):
+        return len(self.examples)
+
+    def choose(self, prompt=None):
+        """The example that fits `prompt` best, or a random one without a prompt."""
+        index = self.index
+        if not index.examples:
+            raise RuntimeError(f"No {self.pattern} files found")
+        if prompt is None:
+            return random.choice(index.examples)
+        return index.choose(prompt)
+
+    def smallest(self):
+        examples = self.examples
+        return min(examples, key=lambda example: example["tokens"]) if examples else None
+
+
+def describe_example(path, text):
+    """An example score plus the metadata used to pick one."""
+    text = text.strip()
+    minified = minify_lilypond(text)
+    key = re.search(r"\\key\s+([a-z]+)\s+\\([a-z]+)", text)
+    time_signature = re.search(r"\\time\s+(\d+/\d+)", text)
+    title = re.search(r'title\s*=\s*"([^"]*)"', text)
+
+    return {
+        "name": os.path.basename(path),
+        "path": path,
+        "text": text,
+        "minified": minified,
+        "title": title.group(1) if title else None,
+        "key": f"{key.group(1)} {key.group(2)}" if key else None,
+        "time": time_signature.group(1) if time_signature else None,
+        "instruments": re.findall(r'instrumentName\s*=\s*"([^"]*)"', text),
+        "midi_instruments": sorted(set(re.findall(r'midiInstrument\s*=\s*"([^"]*)"', text))),
+        "staves": len(STAFF_RE.findall(text)),
+        "bars": count_bars(text),
+        "tokens": count_tokens(minified)
+    }
+
+
+def count_bars(text):
+    """Bar checks in the longest music variable (`name = { ... | ... }`)."""
+    starts = [match.start() for match in ASSIGNMENT_RE.finditer(text)]
+    score = text.find("\\score")
+    ends = starts[1:] + [score if score > (starts[-1] if starts else -1) else len(text)]
+    return max((text[start:end].count("|") for start, end in zip(starts, ends)), default=0)
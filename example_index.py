@@ -0,0 +1,182 @@
+# backend/example_index.py
+
+import re
+import math
+import random
+
+
+# Words that name an instrument (in prompts or in a score's instrument
+# names), mapped to the family used for matching.
+INSTRUMENT_FAMILIES = {
+    "piano": "keyboard", "grand": "keyboard", "keyboard": "keyboard", "harpsichord": "keyboard",
+    "organ": "keyboard", "celesta": "keyboard",
+    "violin": "strings", "viola": "strings", "cello": "strings", "violoncello": "strings",
+    "contrabass": "strings", "string": "strings", "fiddle": "strings",
+    "flute": "woodwinds", "piccolo": "woodwinds", "oboe": "woodwinds", "clarinet": "woodwinds",
+    "bassoon": "woodwinds", "saxophone": "woodwinds", "sax": "woodwinds",
+    "trumpet": "brass", "horn": "brass", "trombone": "brass", "tuba": "brass", "brass": "brass",
+    "cornet": "brass",
+    "soprano": "voice", "alto": "voice", "tenor": "voice", "baritone": "voice", "voice": "voice",
+    "vocal": "voice", "choir": "voice", "choral": "voice", "sing": "voice", "song": "voice",
+    "lyric": "voice", "oohs": "voice", "aahs": "voice",
+    "drum": "percussion", "kit": "percussion", "percussion": "percussion", "timpani": "percussion",
+    "perc": "percussion", "marimba": "percussion", "xylophone": "percussion",
+    "guitar": "plucked", "harp": "plucked", "lute": "plucked", "mandolin": "plucked",
+}
+
+# Forms that imply a meter when the prompt does not give one
+FORM_METERS = {
+    "waltz": "3/4", "minuet": "3/4", "mazurka": "3/4", "polonaise": "3/4", "sarabande": "3/4",
+    "march": "4/4", "gavotte": "4/4", "chorale": "4/4",
+    "jig": "6/8", "gigue": "6/8", "barcarolle": "6/8", "siciliano": "6/8", "tarantella": "6/8",
+}
+
+NOTE_NAMES = {"sharp": "is", "#": "is", "flat": "es", "b": "es"}
+NOTE_NAME_EXCEPTIONS = {"ees": "es", "aes": "as"}
+
+SHORT_WORDS = {"short", "miniature", "brief", "little", "simple", "tiny"}
+LONG_WORDS = {"long", "extended", "large", "epic", "full"}
+
+WORD_RE = re.compile(r"[a-z]+|\d+/\d+")
+KEY_RE = re.compile(r"\b([a-g])(?:[\s-]?(sharp|flat|#|b))?[\s-]+(major|minor)\b")
+METER_RE = re.compile(r"\b(\d{1,2}/\d{1,2})\b")
+
+# Weights of each signal in the final score
+KEY_WEIGHT = 0.3
+METER_WEIGHT = 0.3
+EXTRA_STAFF_PENALTY = 0.15   # per staff beyond what the prompt asked for
+MISSING_FAMILY_PENALTY = 0.5
+SIZE_PENALTY = 0.1           # times tokens / largest example's tokens
+
+
+def words(text):
+    """Lowercase words with a trailing plural `s` dropped (meters kept whole)."""
+    result = []
+    for word in WORD_RE.findall(text.lower()):
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss") and word[:-1] in INSTRUMENT_FAMILIES:
+            word = word[:-1]
+        result.append(word)
+    return result
+
+
+def families(word_list):
+    return {INSTRUMENT_FAMILIES[word] for word in word_list if word in INSTRUMENT_FAMILIES}
+
+
+def prompt_features(prompt):
+    """What a prompt asks for: words, instrument families, key, meter, length."""
+    text = prompt.lower()
+    prompt_words = words(text)
+
+    key = None
+    match = KEY_RE.search(text)
+    if match:
+        note = match.group(1) + NOTE_NAMES.get(match.group(2), "")
+        key = f"{NOTE_NAME_EXCEPTIONS.get(note, note)} {match.group(3)}"
+
+    meter = None
+    match = METER_RE.search(text)
+    if match:
+        meter = match.group(1)
+    else:
+        meter = next((FORM_METERS[word] for word in prompt_words if word in FORM_METERS), None)
+
+    length = None
+    if SHORT_WORDS.intersection(prompt_words):
+        length = "short"
+    elif LONG_WORDS.intersection(prompt_words):
+        length = "long"
+
+    return {
+        "words": prompt_words,
+        "families": families(prompt_words),
+        "key": key,
+        "meter": meter,
+        "length": length
+    }
+
+
+def example_tags(example):
+    """Descriptive words for an example, used for TF-IDF."""
+    tags = words(" ".join(example["instruments"] + example["midi_instruments"]))
+    tags += sorted(families(tags))
+    tags += words(example.get("title") or "")
+    if example["key"]:
+        tags += example["key"].split()
+    if example["time"]:
+        tags.append(example["time"])
+    tags.append("solo" if example["staves"] <= 2 else "ensemble")
+    return tags
+
+
+class ExampleIndex:
+    """
+    Picks the example score that best fits a prompt.
+
+    Each example gets a normalised TF-IDF vector over its descriptive
+    tags (instruments, families, key, meter, title words), built once
+    per catalog load. A prompt is scored against every example by
+    cosine similarity, plus bonuses for a matching key and meter and
+    penalties for instrument families it lacks or staves the prompt did
+    not ask for. Smaller templates win ties, so fewer prompt tokens are
+    spent.
+    """
+
+    def __init__(self, examples):
+        self.examples = examples
+        self.max_tokens = max((example["tokens"] for example in examples), default=1) or 1
+
+        documents = [example_tags(example) for example in examples]
+        document_frequency = {}
+        for tags in documents:
+            for tag in set(tags):
+                document_frequency[tag] = document_frequency.get(tag, 0) + 1
+
+        count = len(documents)
+        self.idf = {
+            tag: math.log((1 + count) / (1 + frequency)) + 1
+            for tag, frequency in document_frequency.items()
+        }
+        self.vectors = [self._vector(tags) for tags in documents]
+        self.families = [families(tags) for tags in documents]
+
+    def _vector(self, tags):
+        vector = {}
+        for tag in tags:
+            if tag in self.idf:
+                vector[tag] = vector.get(tag, 0.0) + self.idf[tag]
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {tag: weight / norm for tag, weight in vector.items()}
+
+    def score(self, features, query, position):
+        example = self.examples[position]
+        vector = self.vectors[position]
+        score = sum(weight * vector.get(tag, 0.0) for tag, weight in query.items())
+
+        if features["key"] and example["key"] == features["key"]:
+            score += KEY_WEIGHT
+        if features["meter"] and example["time"] == features["meter"]:
+            score += METER_WEIGHT
+
+        wanted = features["families"]
+        if wanted:
+            score -= MISSING_FAMILY_PENALTY * len(wanted - self.families[position])
+            # A staff per requested family (two for keyboard) is "suitable"
+            suitable = len(wanted) + ("keyboard" in wanted)
+            score -= EXTRA_STAFF_PENALTY * max(0, example["staves"] - suitable)
+
+        size = example["tokens"] / self.max_tokens
+        if features["length"] == "long":
+            size = 1 - size
+        return score - SIZE_PENALTY * size
+
+    def choose(self, prompt):
+        """The best example for `prompt`; a random one among exact ties."""
+        if not self.examples:
+            return None
+        features = prompt_features(prompt)
+        query = self._vector(features["words"])
+        scores = [self.score(features, query, position) for position in range(len(self.examples))]
+        best = max(scores)
+        tied = [position for position, score in enumerate(scores) if best - score < 1e-9]
+        return self.examples[random.choice(tied)]
@@ -0,0 +1,26 @@
+# backend/gunicorn.conf.py
+# Picked up automatically by gunicorn from the working directory.
+
+import os
+import glob
+
+
+def on_starting(server):
+    # ✅ Balances held in one worker's memory would diverge between workers
+    if server.cfg.workers > 1:
+        if os.environ.get("BALANCE_STORE", "sqlite") != "sqlite":
+            raise RuntimeError("BALANCE_STORE=ledger needs a single worker; use sqlite")
+        os.environ["BALANCE_STORE"] = "sqlite"
+
+    # ✅ Drop metric files left over from a previous run
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
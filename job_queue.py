@@ -0,0 +1,269 @@
+# backend/job_queue.py
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+
+class SQLiteJobQueue:
+    """
+    Durable FIFO of job payloads in a SQLite file, shared by every process
+    on the host. A claimed message that is not acked within
+    `visibility_timeout` seconds (e.g. its worker died) is handed out again.
+    While a worker runs the heartbeat (`start_heartbeat`), the messages it
+    still holds keep being re-claimed, so long jobs are not run twice.
+
+    Workers also report their per-stage service times with each
+    heartbeat; `service_times()` returns the reports of workers that are
+    still beating, so the web process can estimate queueing delay.
+    """
+
+    POLL_SECONDS = 0.5
+
+    def __init__(self, db_path, visibility_timeout=900):
+        self.db_path = db_path
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = max(1.0, min(60.0, visibility_timeout / 3))
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.local = threading.local()
+        self.claimed = set()
+        self.lock = threading.Lock()
+
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS job_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                claimed_at REAL,
+                claimed_by TEXT
+            );
+            CREATE INDEX IF NOT EXISTS job_queue_claimed ON job_queue (claimed_at, id);
+            CREATE TABLE IF NOT EXISTS job_queue_consumers (
+                consumer TEXT PRIMARY KEY,
+                service_times TEXT NOT NULL,
+                reported_at REAL NOT NULL
+            );
+        """)
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def put(self, payload):
+        self._conn().execute(
+            "INSERT INTO job_queue (payload, enqueued_at) VALUES (?, ?)",
+            (json.dumps(payload), time.time())
+        )
+
+    def get(self, timeout=5):
+        """Claims the oldest message. Returns (message_id, payload) or None."""
+        deadline = time.monotonic() + timeout
+        while True:
+            claimed = self._claim()
+            if claimed or time.monotonic() >= deadline:
+                return claimed
+            time.sleep(self.POLL_SECONDS)
+
+    def _claim(self):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload FROM job_queue "
+                "WHERE claimed_at IS NULL OR claimed_at < ? ORDER BY id LIMIT 1",
+                (now - self.visibility_timeout,)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE job_queue SET claimed_at = ?, claimed_by = ? WHERE id = ?",
+                    (now, self.consumer, row[0])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        if not row:
+            return None
+        with self.lock:
+            self.claimed.add(row[0])
+        return row[0], json.loads(row[1])
+
+    def ack(self, message_id):
+        self._conn().execute("DELETE FROM job_queue WHERE id = ?", (message_id,))
+        with self.lock:
+            self.claimed.discard(message_id)
+
+    def heartbeat(self):
+        """Renews the claim on every message this process has not acked yet."""
+        with self.lock:
+            ids = list(self.claimed)
+        if ids:
+            self._conn().execute(
+                f"UPDATE job_queue SET claimed_at = ? WHERE claimed_by = ? AND id IN ({','.join('?' * len(ids))})",
+                [time.time(), self.consumer] + ids
+            )
+
+    def start_heartbeat(self, stats=None):
+        start_heartbeat(self, self.heartbeat_interval, stats)
+
+    def report_service_times(self, service_times):
+        """Publishes this worker's {stage: seconds} service times."""
+        self._conn().execute(
+            "INSERT OR REPLACE INTO job_queue_consumers (consumer, service_times, reported_at) VALUES (?, ?, ?)",
+            (self.consumer, json.dumps(service_times), time.time())
+        )
+
+    def service_times(self):
+        """[{stage: seconds}] from every worker that reported within three heartbeats."""
+        rows = self._conn().execute(
+            "SELECT service_times FROM job_queue_consumers WHERE reported_at >= ?",
+            (time.time() - 3 * self.heartbeat_interval,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def depth(self):
+        """Messages waiting to be claimed."""
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM job_queue WHERE claimed_at IS NULL"
+        ).fetchone()[0]
+
+
+class RedisJobQueue:
+    """
+    Job queue on a Redis list, for workers spread across hosts.
+
+    Each consumer moves claimed messages onto its own processing list
+    (named after WORKER_NAME, or the hostname and pid) and removes them on
+    ack. While its heartbeat runs, a consumer keeps an "alive" key with a
+    `consumer_ttl` expiry. `recover()` pushes the processing lists of
+    consumers whose key has expired back onto the queue, so work from a
+    crashed worker is not lost and live workers' jobs are left alone.
+    The service times a consumer reports expire with the same TTL.
+    """
+
+    def __init__(self, url, name="composer:jobs", consumer=None, consumer_ttl=60):
+        import redis  # only needed when this backend is selected
+
+        self.redis = redis.Redis.from_url(url)
+        self.name = name
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.consumer_ttl = consumer_ttl
+        self.beating = False
+        self.processing = f"{name}:processing:{self.consumer}"
+
+    def _alive_key(self, consumer):
+        return f"{self.name}:alive:{consumer}"
+
+    def recover(self):
+        moved = 0
+        prefix = f"{self.name}:processing:"
+        for key in self.redis.scan_iter(match=f"{prefix}*"):
+            key = key.decode() if isinstance(key, bytes) else key
+            consumer = key[len(prefix):]
+            if consumer == self.consumer:
+                # Our own list only holds leftovers before our heartbeat starts
+                if self.beating:
+                    continue
+            elif self.redis.exists(self._alive_key(consumer)):
+                continue
+            while self.redis.lmove(key, self.name, "RIGHT", "RIGHT") is not None:
+                moved += 1
+        return moved
+
+    def heartbeat(self):
+        self.redis.set(self._alive_key(self.consumer), "1", ex=int(self.consumer_ttl))
+        self.beating = True
+
+    def start_heartbeat(self, stats=None):
+        self.heartbeat()
+        start_heartbeat(self, max(1.0, self.consumer_ttl / 3), stats)
+
+    def report_service_times(self, service_times):
+        self.redis.set(
+            f"{self.name}:service_times:{self.consumer}", json.dumps(service_times), ex=int(self.consumer_ttl)
+        )
+
+    def service_times(self):
+        reports = []
+        for key in self.redis.scan_iter(match=f"{self.name}:service_times:*"):
+            raw = self.redis.get(key)
+            if raw is not None:
+                reports.append(json.loads(raw))
+        return reports
+
+    def put(self, payload):
+        self.redis.lpush(self.name, json.dumps(payload))
+
+    def get(self, timeout=5):
+        raw = self.redis.blmove(self.name, self.processing, timeout, "RIGHT", "LEFT")
+        if raw is None:
+            return None
+        return raw, json.loads(raw)
+
+    def ack(self, message_id):
+        self.redis.lrem(self.processing, 1, message_id)
+
+    def depth(self):
+        return self.redis.llen(self.name)
+
+
+def start_heartbeat(job_queue, interval, stats=None):
+    """
+    Calls `job_queue.heartbeat()` every `interval` seconds, and also
+    `recover()` where the queue has one, so a crashed sibling's messages
+    go back on the queue without waiting for a restart. With `stats`, a
+    callable returning this worker's {stage: seconds}, they are reported
+    on every beat (and once right away).
+    """
+    def report():
+        if stats is not None:
+            job_queue.report_service_times(stats())
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                job_queue.heartbeat()
+                report()
+                if hasattr(job_queue, "recover"):
+                    moved = job_queue.recover()
+                    if moved:
+                        print(f"♻️ Re-queued {moved} jobs from a stopped worker")
+            except Exception as e:
+                print(f"❌ Job queue heartbeat failed: {e}")
+
+    try:
+        report()
+    except Exception as e:
+        print(f"❌ Could not report service times: {e}")
+    threading.Thread(target=loop, name="job-queue-heartbeat", daemon=True).start()
+
+
+def make_job_queue(kind, base_dir):
+    """
+    Builds the queue named by JOB_QUEUE ("sqlite" or "redis").
+    Returns None when jobs should run in the web process itself.
+    """
+    if not kind:
+        return None
+    if kind == "sqlite":
+        return SQLiteJobQueue(
+            os.environ.get("JOB_QUEUE_DB", os.path.join(base_dir, "job_queue.db")),
+            visibility_timeout=float(os.environ.get("JOB_QUEUE_VISIBILITY_TIMEOUT", 900))
+        )
+    if kind == "redis":
+        return RedisJobQueue(
+            os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+            consumer=os.environ.get("WORKER_NAME"),
+            consumer_ttl=float(os.environ.get("JOB_QUEUE_CONSUMER_TTL", 60))
+        )
+    raise ValueError(f"Unknown JOB_QUEUE backend: {kind}")
@@ -0,0 +1,234 @@
+# backend/job_scheduler.py
+
+import os
+import time
+import queue
+import asyncio
+import inspect
+import threading
+
+
+# Weight of the newest sample in each stage's moving-average service time
+SERVICE_TIME_ALPHA = 0.2
+
+
+class SchedulerFull(Exception):
+    """Raised when the scheduler already holds `max_pending` jobs."""
+
+
+class JobScheduler:
+    """
+    Runs jobs through a fixed pipeline of stages, each with its own
+    bounded pool of worker threads.
+
+    `stages` is a list of (name, handler, workers). A handler receives the
+    job context and returns the name of the next stage, or None when the
+    job is finished. `on_error(ctx, exc)` is called if a handler raises,
+    `on_advance(ctx, next_stage)` (optional) before a job moves on to its
+    next stage, and `on_finish(ctx)` (optional) whenever a job leaves the
+    pipeline.
+
+    A handler may be a coroutine function, given an asyncio `loop`
+    running in another thread. Jobs then start on the loop as soon as
+    they reach the stage, with no thread per job; `workers` is only how
+    many the stage is expected to run at once (for `estimate()`). One
+    thread per async stage takes finished coroutines off its queue and
+    runs the callbacks, which may block.
+
+    Each stage keeps a moving average of how long one pass takes, seeded
+    from `service_estimates` ({stage: seconds}), which `estimate()` uses
+    to predict queueing delay.
+    """
+
+    def __init__(self, stages, max_pending, on_error, on_finish=None, on_advance=None,
+                 service_estimates=None, loop=None):
+        self.stages = {}
+        self.order = []
+        for name, handler, workers in stages:
+            is_async = inspect.iscoroutinefunction(handler)
+            if is_async and loop is None:
+                raise ValueError(f"Stage {name} is async but no event loop was given")
+            self.stages[name] = {
+                "handler": handler,
+                "workers": max(1, int(workers)),
+                "queue": queue.Queue(),
+                "async": is_async,
+                "running": 0,  # async stages only
+            }
+            self.order.append(name)
+
+        self.loop = loop
+
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self.on_finish = on_finish
+        self.on_advance = on_advance
+        self.service_time = dict(service_estimates or {})
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+
+        for name, stage in self.stages.items():
+            if stage["async"]:
+                threading.Thread(
+                    target=self._async_worker,
+                    args=(name,),
+                    name=f"{name}-async-worker",
+                    daemon=True
+                ).start()
+                continue
+            for i in range(stage["workers"]):
+                threading.Thread(
+                    target=self._worker,
+                    args=(name,),
+                    name=f"{name}-worker-{i}",
+                    daemon=True
+                ).start()
+
+    def submit(self, ctx, stage=None, force=False):
+        """
+        Admits a job into the pipeline, starting at `stage` (the first
+        stage by default). Raises SchedulerFull when the pipeline is full,
+        unless `force` is set (used when resuming interrupted jobs).
+        """
+        with self.lock:
+            if self.in_flight >= self.max_pending and not force:
+                raise SchedulerFull(f"{self.in_flight} jobs already queued")
+            self.in_flight += 1
+
+        self._enqueue(stage or self.order[0], ctx)
+
+    def _enqueue(self, name, ctx):
+        stage = self.stages[name]
+        if not stage["async"]:
+            stage["queue"].put(ctx)
+            return
+
+        with self.lock:
+            stage["running"] += 1
+        started = time.perf_counter()
+        future = asyncio.run_coroutine_threadsafe(stage["handler"](ctx), self.loop)
+        future.add_done_callback(
+            lambda done: stage["queue"].put((ctx, done, started))
+        )
+
+    def depth(self):
+        """Number of jobs currently admitted (queued or running)."""
+        return self.in_flight
+
+    def stage_depths(self):
+        return {
+            name: stage["running"] if stage["async"] else stage["queue"].qsize()
+            for name, stage in self.stages.items()
+        }
+
+    def estimate(self, ahead, capacity_scale=1, service_time=None):
+        """
+        Predicts (wait_seconds, run_seconds) for a job admitted behind
+        `ahead` others. Throughput is set by the slowest stage (service
+        time / workers); `capacity_scale` multiplies the worker counts,
+        e.g. by the number of worker processes sharing a broker.
+        `service_time` ({stage: seconds}) replaces this scheduler's own
+        averages, e.g. with ones measured by those workers.
+        """
+        service_time = service_time or self.service_time
+        run_seconds = 0.0
+        bottleneck_rate = None
+        bottleneck_workers = 1
+        for name, stage in self.stages.items():
+            seconds = service_time.get(name)
+            if not seconds:
+                continue
+            run_seconds += seconds
+            workers = stage["workers"] * capacity_scale
+            rate = workers / seconds
+            if bottleneck_rate is None or rate < bottleneck_rate:
+                bottleneck_rate = rate
+                bottleneck_workers = workers
+
+        if not bottleneck_rate:
+            return 0.0, run_seconds
+        waiting = max(0, ahead - (bottleneck_workers - 1))
+        return waiting / bottleneck_rate, run_seconds
+
+    def _observe(self, name, seconds):
+        previous = self.service_time.get(name)
+        if previous is None:
+            self.service_time[name] = seconds
+        else:
+            self.service_time[name] = previous + SERVICE_TIME_ALPHA * (seconds - previous)
+
+    def _worker(self, name):
+        stage = self.stages[name]
+        while True:
+            ctx = stage["queue"].get()
+            started = time.perf_counter()
+            try:
+                next_stage, error = stage["handler"](ctx), None
+            except Exception as e:
+                next_stage, error = None, e
+            try:
+                self._advance(name, ctx, next_stage, error, started)
+            finally:
+                stage["queue"].task_done()
+
+    def _async_worker(self, name):
+        """Handles jobs whose coroutine finished on the event loop."""
+        stage = self.stages[name]
+        while True:
+            ctx, future, started = stage["queue"].get()
+            with self.lock:
+                stage["running"] -= 1
+            try:
+                next_stage, error = future.result(), None
+            except Exception as e:
+                next_stage, error = None, e
+            try:
+                self._advance(name, ctx, next_stage, error, started)
+            finally:
+                stage["queue"].task_done()
+
+    def _advance(self, name, ctx, next_stage, error, started):
+        """Moves a job on after a pass through stage `name` (which began at `started`)."""
+        try:
+            if error is not None:
+                raise error
+            if next_stage and self.on_advance:
+                self.on_advance(ctx, next_stage)
+        except Exception as e:
+            next_stage = None
+            try:
+                self.on_error(ctx, e)
+            except Exception as handler_error:
+                print(f"❌ Error handler failed in {name} stage: {handler_error}")
+        finally:
+            self._observe(name, time.perf_counter() - started)
+
+        if next_stage:
+            self._enqueue(next_stage, ctx)
+            return
+
+        with self.lock:
+            self.in_flight -= 1
+        if self.on_finish:
+            try:
+                self.on_finish(ctx)
+            except Exception as e:
+                print(f"❌ Finish handler failed in {name} stage: {e}")
+
+    def has_capacity(self):
+        return self.in_flight < self.max_pending
+
+
+def pool_size(env_name, default):
+    """Reads a worker pool size from the environment."""
+    try:
+        return max(1, int(os.environ.get(env_name, default)))
+    except ValueError:
+        return default
@@ -0,0 +1,587 @@
+# backend/job_store.py
+
+import os
+import gzip
+import json
+import time
+import shutil
+import sqlite3
+import threading
+
+
+# Fields that can be tens of KB per job; only loaded when asked for.
+# `checkpoint` holds the pipeline context needed to resume an interrupted job.
+LARGE_FIELDS = ("lilypond", "conversation_history", "checkpoint")
+
+FINISHED_STATUSES = ("completed", "failed")
+
+# How often SQLiteJobStore re-reads a job while waiting for it to change
+SQLITE_WAIT_POLL_SECONDS = 0.25
+
+
+class JobArchive:
+    """Cold tier: one gzip-compressed JSON file per finished job."""
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def _path(self, job_id):
+        safe_id = "".join(c for c in job_id if c.isalnum() or c in ("_", "-"))
+        return os.path.join(self.archive_dir, safe_id[:2], f"{safe_id}.json.gz")
+
+    def put(self, job_id, job):
+        path = self._path(job_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def get(self, job_id):
+        try:
+            with gzip.open(self._path(job_id), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def __contains__(self, job_id):
+        return os.path.exists(self._path(job_id))
+
+    def delete(self, job_id):
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        shutil.rmtree(self.archive_dir, ignore_errors=True)
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+
+class JournaledJobStore:
+    """
+    In-memory job dict backed by an append-only journal.
+
+    Every state change appends one small JSON record to `journal_path`.
+    A background thread periodically folds the journal into a snapshot
+    (`snapshot_path`, a plain {job_id: job} dict — the old jobs.json
+    format) so startup only replays the records written since then.
+
+    With an `archive`, finished jobs stay in memory for at most
+    `finished_ttl` seconds (and `max_finished_bytes` in total) before
+    they are spilled to the archive and read back from disk on demand.
+    """
+
+    def __init__(self, snapshot_path, journal_path, compact_every=5000,
+                 archive=None, finished_ttl=3600, max_finished_bytes=64 * 1024 * 1024):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.rotated_path = journal_path + ".1"
+        self.compact_every = compact_every
+
+        self.archive = archive
+        self.finished_ttl = finished_ttl
+        self.max_finished_bytes = max_finished_bytes
+        self.finished = {}  # job_id -> (finished_at, approximate bytes)
+        self.finished_bytes = 0
+
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.journal = None
+        self.records_since_compaction = 0
+        self.compact_requested = threading.Event()
+
+    # --- reads ---
+
+    def get(self, job_id, include_large=True):
+        """A copy of the job, so callers never iterate a record being updated."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                return dict(job) if include_large else {k: v for k, v in job.items() if k not in LARGE_FIELDS}
+        if self.archive is not None:
+            job = self.archive.get(job_id)
+        if job is None or include_large:
+            return job
+        return {k: v for k, v in job.items() if k not in LARGE_FIELDS}
+
+    def find_unfinished(self):
+        """Ids of jobs that were queued or running (for crash recovery)."""
+        with self.lock:
+            return [
+                job_id for job_id, job in self.jobs.items()
+                if job.get("status") not in FINISHED_STATUSES
+            ]
+
+    def wait_for_change(self, job_id, since, timeout):
+        """
+        Blocks until the job's version is greater than `since` or `timeout`
+        seconds pass, then returns the job (large fields omitted).
+        """
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                job = self.jobs.get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job.get("version", 0) > since or remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+
+            if job is not None:
+                return {k: v for k, v in job.items() if k not in LARGE_FIELDS}
+
+        # Spilled jobs are finished, so they will not change any more
+        return self.get(job_id, include_large=False)
+
+    def find(self, user_id=None, status=None, limit=100):
+        """Newest-first jobs matching `user_id` / `status` (large fields omitted)."""
+        with self.lock:
+            matches = [
+                dict(job, job_id=job_id) for job_id, job in self.jobs.items()
+                if (user_id is None or job.get("user_id") == user_id)
+                and (status is None or job.get("status") == status)
+            ]
+        matches.sort(key=lambda job: job.get("created_at", 0), reverse=True)
+        return [
+            {k: v for k, v in job.items() if k not in LARGE_FIELDS}
+            for job in matches[:limit]
+        ]
+
+    def __contains__(self, job_id):
+        return job_id in self.jobs or (self.archive is not None and job_id in self.archive)
+
+    def __len__(self):
+        """Number of jobs held in memory (spilled jobs are not counted)."""
+        return len(self.jobs)
+
+    def stats(self):
+        """Job counts by status plus the approximate in-memory footprint."""
+        with self.lock:
+            by_status = {}
+            active_bytes = 0
+            for job_id, job in self.jobs.items():
+                status = job.get("status")
+                by_status[status] = by_status.get(status, 0) + 1
+                if job_id not in self.finished:
+                    active_bytes += len(json.dumps(job))
+            return {
+                "by_status": by_status,
+                "jobs_in_memory": len(self.jobs),
+                "bytes_in_memory": self.finished_bytes + active_bytes
+            }
+
+    # --- writes ---
+
+    def create(self, job_id, record):
+        record = dict(record, version=1)
+        with self.lock:
+            self.jobs[job_id] = dict(record)
+            self._append({"op": "create", "job_id": job_id, "data": record})
+            self.changed.notify_all()
+
+    def update(self, job_id, fields):
+        self.update_if(job_id, {}, fields)
+
+    def update_if(self, job_id, expected, fields):
+        """
+        Applies `fields` only if every key in `expected` currently has that
+        value. Returns True if the update happened.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or any(job.get(k) != v for k, v in expected.items()):
+                return False
+            fields = dict(fields, version=job.get("version", 0) + 1)
+            job.update(fields)
+            self._append({"op": "update", "job_id": job_id, "data": fields})
+            if fields.get("status") in FINISHED_STATUSES:
+                self._track_finished(job_id, job)
+            self.changed.notify_all()
+            return True
+
+    def delete(self, job_id):
+        with self.lock:
+            if self.jobs.pop(job_id, None) is not None:
+                self._append({"op": "delete", "job_id": job_id})
+                self._untrack_finished(job_id)
+                self.changed.notify_all()
+        if self.archive is not None:
+            self.archive.delete(job_id)
+
+    def clear(self):
+        with self.lock:
+            self.jobs.clear()
+            self._append({"op": "clear"})
+            self.finished.clear()
+            self.finished_bytes = 0
+            self.changed.notify_all()
+        if self.archive is not None:
+            self.archive.clear()
+
+    def _append(self, record):
+        try:
+            self.journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self.journal.flush()
+        except Exception as e:
+            print(f"❌ Failed to journal job change: {e}")
+            return
+
+        self.records_since_compaction += 1
+        if self.records_since_compaction >= self.compact_every:
+            self.compact_requested.set()
+
+    # --- startup / compaction ---
+
+    def load(self):
+        """Rebuilds `jobs` from the snapshot plus any journal records after it."""
+        with self.lock:
+            jobs = {}
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, "r") as f:
+                    jobs = json.load(f)
+
+            replayed = 0
+            # A leftover rotated journal means compaction was interrupted;
+            # replaying it again is harmless because every op is idempotent.
+            for path in (self.rotated_path, self.journal_path):
+                replayed += self._replay(path, jobs)
+
+            self.jobs.clear()
+            self.jobs.update(jobs)
+            self.records_since_compaction = replayed
+
+            self.finished.clear()
+            self.finished_bytes = 0
+            for job_id, job in jobs.items():
+                if job.get("status") in FINISHED_STATUSES:
+                    self._track_finished(job_id, job)
+
+            if self.journal is None:
+                self.journal = open(self.journal_path, "a")
+
+        if replayed >= self.compact_every or os.path.exists(self.rotated_path):
+            self.compact_requested.set()
+        return len(self.jobs), replayed
+
+    def _replay(self, path, jobs):
+        if not os.path.exists(path):
+            return 0
+
+        count = 0
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn final line from a crash mid-write
+                    continue
+                apply_record(jobs, record)
+                count += 1
+        return count
+
+    def compact(self):
+        """Writes a fresh snapshot and drops the journal records it covers."""
+        with self.lock:
+            self.journal.close()
+            if not os.path.exists(self.rotated_path):
+                os.replace(self.journal_path, self.rotated_path)
+            else:
+                # A previous compaction died before finishing; fold this
+                # journal into the rotated one so nothing is lost.
+                with open(self.journal_path, "r") as src, open(self.rotated_path, "a") as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_path)
+            self.journal = open(self.journal_path, "a")
+            self.records_since_compaction = 0
+            snapshot = {job_id: dict(job) for job_id, job in self.jobs.items()}
+
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.snapshot_path)
+        os.remove(self.rotated_path)
+
+    def start_compactor(self, interval=60):
+        def loop():
+            while True:
+                if not self.compact_requested.wait(interval):
+                    continue
+                self.compact_requested.clear()
+                try:
+                    self.compact()
+                    print("🗜️ Compacted job journal")
+                except Exception as e:
+                    print(f"❌ Failed to compact job journal: {e}")
+
+        threading.Thread(target=loop, name="job-journal-compactor", daemon=True).start()
+
+    # --- tiering ---
+
+    def _track_finished(self, job_id, job):
+        size = len(json.dumps(job))
+        self._untrack_finished(job_id)
+        self.finished[job_id] = (job.get("finished_at", 0), size)
+        self.finished_bytes += size
+
+    def _untrack_finished(self, job_id):
+        entry = self.finished.pop(job_id, None)
+        if entry:
+            self.finished_bytes -= entry[1]
+
+    def spill(self):
+        """
+        Moves finished jobs older than the TTL, then the oldest ones over
+        the byte cap, to the archive. Returns how many were spilled.
+        """
+        if self.archive is None:
+            return 0
+
+        with self.lock:
+            cutoff = time.time() - self.finished_ttl
+            by_age = sorted(self.finished.items(), key=lambda item: item[1][0])
+            over_bytes = self.finished_bytes - self.max_finished_bytes
+
+            victims = []
+            for job_id, (finished_at, size) in by_age:
+                if finished_at > cutoff and over_bytes <= 0:
+                    break
+                victims.append(job_id)
+                over_bytes -= size
+
+        spilled = 0
+        for job_id in victims:
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            # Write the cold copy before dropping the hot one
+            self.archive.put(job_id, job)
+            with self.lock:
+                if self.jobs.get(job_id) is job:
+                    del self.jobs[job_id]
+                    self._untrack_finished(job_id)
+                    self._append({"op": "spill", "job_id": job_id})
+                    spilled += 1
+        return spilled
+
+    def start_spiller(self, interval=30):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    spilled = self.spill()
+                    if spilled:
+                        print(f"🧊 Spilled {spilled} finished jobs to disk")
+                except Exception as e:
+                    print(f"❌ Failed to spill finished jobs: {e}")
+
+        if self.archive is not None:
+            threading.Thread(target=loop, name="job-spiller", daemon=True).start()
+
+
+def apply_record(jobs, record):
+    op = record.get("op")
+    job_id = record.get("job_id")
+
+    if op == "create":
+        jobs[job_id] = dict(record["data"])
+    elif op == "update":
+        if job_id in jobs:
+            jobs[job_id].update(record["data"])
+    elif op in ("delete", "spill"):
+        jobs.pop(job_id, None)
+    elif op == "clear":
+        jobs.clear()
+
+
+class SQLiteJobStore:
+    """
+    Job store backed by a SQLite database in WAL mode, so several gunicorn
+    workers can share job state.
+
+    job_id, user_id, status and timestamps are real, indexed columns; the
+    rest of the record lives in a JSON `data` column, and LARGE_FIELDS get
+    their own columns that are only read when `include_large` is set.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def load(self):
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                user_id TEXT,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_user_created ON jobs (user_id, created_at);
+            CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+            CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created_at);
+        """)
+
+        # Large fields are added one by one so older databases pick up new ones
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for field in LARGE_FIELDS:
+            if field not in existing:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {field} TEXT")
+        return len(self), 0
+
+    def start_compactor(self, interval=60):
+        pass  # SQLite checkpoints its own WAL
+
+    def start_spiller(self, interval=30):
+        pass  # Already on disk; nothing is held in memory
+
+    # --- reads ---
+
+    def get(self, job_id, include_large=True):
+        columns = ", ".join(("data",) + LARGE_FIELDS) if include_large else "data"
+        row = self._conn().execute(
+            f"SELECT {columns} FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._row_to_job(row, include_large)
+
+    def wait_for_change(self, job_id, since, timeout):
+        """
+        Polls until the job's version is greater than `since` or `timeout`
+        seconds pass, then returns the job (large fields omitted). Polling
+        picks up changes made by other worker processes.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id, include_large=False)
+            remaining = deadline - time.monotonic()
+            if job is None or job.get("version", 0) > since or remaining <= 0:
+                return job
+            time.sleep(min(SQLITE_WAIT_POLL_SECONDS, remaining))
+
+    def find(self, user_id=None, status=None, limit=100):
+        """Newest-first jobs matching `user_id` / `status` (large fields omitted)."""
+        clauses, params = [], []
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        rows = self._conn().execute(
+            f"SELECT job_id, data FROM jobs {where} ORDER BY created_at DESC LIMIT ?",
+            params + [limit]
+        ).fetchall()
+        return [dict(json.loads(data), job_id=job_id) for job_id, data in rows]
+
+    def __contains__(self, job_id):
+        row = self._conn().execute("SELECT 1 FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def stats(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {"by_status": dict(rows), "jobs_in_memory": 0, "bytes_in_memory": 0}
+
+    # --- writes ---
+
+    def create(self, job_id, record):
+        small, large = split_large_fields(dict(record, version=1))
+        now = time.time()
+        columns = ("job_id", "user_id", "status", "created_at", "updated_at", "data") + LARGE_FIELDS
+        self._conn().execute(
+            f"INSERT OR REPLACE INTO jobs ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            (
+                job_id,
+                record.get("user_id"),
+                record.get("status", "pending"),
+                record.get("created_at", now),
+                now,
+                json.dumps(small),
+            ) + tuple(large.get(field) for field in LARGE_FIELDS)
+        )
+
+    def update(self, job_id, fields):
+        self.update_if(job_id, {}, fields)
+
+    def update_if(self, job_id, expected, fields):
+        """
+        Applies `fields` only if every key in `expected` currently has that
+        value. The check and write share one transaction, so it is safe
+        across processes. Returns True if the update happened.
+        """
+        small, large = split_large_fields(fields)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            data = json.loads(row[0]) if row else None
+            if data is None or any(data.get(k) != v for k, v in expected.items()):
+                conn.execute("ROLLBACK")
+                return False
+
+            data.update(small)
+            data["version"] = data.get("version", 0) + 1
+
+            assignments = ["status = ?", "updated_at = ?", "data = ?"]
+            params = [data.get("status", "pending"), time.time(), json.dumps(data)]
+            for field, value in large.items():
+                assignments.append(f"{field} = ?")
+                params.append(value)
+
+            conn.execute(
+                f"UPDATE jobs SET {', '.join(assignments)} WHERE job_id = ?",
+                params + [job_id]
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, job_id):
+        self._conn().execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def clear(self):
+        self._conn().execute("DELETE FROM jobs")
+
+    def _row_to_job(self, row, include_large):
+        job = json.loads(row[0])
+        if include_large:
+            for field, value in zip(LARGE_FIELDS, row[1:]):
+                value = json.loads(value) if value is not None else None
+                if value is not None:
+                    job[field] = value
+        return job
+
+    def find_unfinished(self):
+        """Ids of jobs that were queued or running (for crash recovery)."""
+        rows = self._conn().execute(
+            "SELECT job_id FROM jobs WHERE status NOT IN (?, ?)", FINISHED_STATUSES
+        ).fetchall()
+        return [row[0] for row in rows]
+
+
+def split_large_fields(record):
+    """Splits a record into (small fields, JSON-encoded LARGE_FIELDS)."""
+    small = {k: v for k, v in record.items() if k not in LARGE_FIELDS}
+    large = {k: json.dumps(record[k]) for k in LARGE_FIELDS if k in record}
+    return small, large
@@ -0,0 +1,74 @@
+# backend/lilypond_stream.py
+
+OPEN_FENCE = "```lilypond"
+CLOSE_FENCE = "```"
+
+
+class LilypondStream:
+    """
+    Follows a streamed completion and spots the ```lilypond block as the
+    deltas arrive, so the caller can report progress while it is being
+    written and stop reading once the block is closed.
+
+    Each delta is only searched together with the few characters before
+    it that could hold the start of a fence.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+        self.tail = ""          # last characters seen, for fences split across deltas
+        self.code_start = None  # offset just past the opening fence
+        self.code_end = None    # offset of the closing fence
+        self.bars = 0           # bar checks (`|`) inside the code block, across all voices
+        self.counted_to = 0
+        self.tokens = 0         # deltas received; OpenAI sends about one token per delta
+
+    @property
+    def in_code(self):
+        return self.code_start is not None and self.code_end is None
+
+    @property
+    def done(self):
+        return self.code_end is not None
+
+    def feed(self, delta):
+        """Adds one delta. Returns True once the code block has been closed."""
+        if self.done:
+            return True
+
+        self.tokens += 1
+        window_start = self.length - len(self.tail)
+        window = self.tail + delta
+        self.parts.append(delta)
+        self.length += len(delta)
+
+        if self.code_start is None:
+            found = window.find(OPEN_FENCE)
+            if found < 0:
+                self.tail = window[-(len(OPEN_FENCE) - 1):]
+                return False
+            self.code_start = window_start + found + len(OPEN_FENCE)
+            self.counted_to = self.code_start
+
+        # Only look at code, never at the opening fence itself
+        code_from = max(self.code_start, window_start)
+        code = window[code_from - window_start:]
+        found = code.find(CLOSE_FENCE)
+        if found >= 0:
+            self.code_end = code_from + found
+            code = code[:found]
+
+        # The tail was already counted last time
+        self.bars += code[max(0, self.counted_to - code_from):].count("|")
+        self.counted_to = code_from + len(code)
+        self.tail = window[-(len(CLOSE_FENCE) - 1):]
+        return self.done
+
+    @property
+    def text(self):
+        """Everything received, cut just after the closing fence."""
+        text = "".join(self.parts)
+        if self.done:
+            return text[:self.code_end + len(CLOSE_FENCE)]
+        return text
@@ -0,0 +1,160 @@
+# backend/llm_async.py
+
+import os
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+
+import httpx
+import openai
+
+from llm_gateway import DEFAULT_MODEL_CONFIG, get_gateway
+from metrics import LLM_RATE_LIMIT_WAIT, LLM_IN_FLIGHT
+from prompt_budget import count_message_tokens
+
+
+class TokenRateLimiter:
+    """
+    Token bucket holding up to `tokens_per_minute`, refilled continuously.
+
+    `acquire(tokens)` waits until that many are available and takes them;
+    waiters are served in arrival order, and a request bigger than the
+    whole bucket only waits for a full one. `charge(tokens)` takes tokens
+    that were not known up front (e.g. completion tokens) without waiting,
+    so the bucket can go negative and later callers wait off the debt.
+    Only used from the event loop's thread.
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = float(tokens_per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.level < tokens:
+                await asyncio.sleep((tokens - self.level) / self.rate)
+                self._refill()
+            self.level -= tokens
+
+    def charge(self, tokens):
+        self._refill()
+        self.level -= tokens
+
+
+class AsyncLLMGateway:
+    """
+    LLM calls as coroutines on one event loop thread per process, so many
+    requests can be in flight without a thread each.
+
+    Timeouts, retries and circuit breakers are the blocking LLMGateway's:
+    the same per-model config and breakers, and the same CallAttempts
+    policy, with only the waiting awaited. On top of that each model gets
+    a semaphore capping requests in flight (`max_concurrency`) and, with
+    `tokens_per_minute` set, a TokenRateLimiter: a call reserves its
+    estimated prompt tokens before it is sent and is charged its
+    completion tokens once they are known.
+    """
+
+    def __init__(self, gateway, base_url=None, max_connections=64, max_keepalive=32):
+        self.gateway = gateway
+        self.loop = asyncio.new_event_loop()
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            timeout=httpx.Timeout(DEFAULT_MODEL_CONFIG["timeout"], connect=DEFAULT_MODEL_CONFIG["connect_timeout"])
+        )
+        self.client = openai.AsyncOpenAI(base_url=base_url, http_client=self.http_client, max_retries=0)
+        self.semaphores = {}
+        self.limiters = {}
+        threading.Thread(target=self.loop.run_forever, name="llm-event-loop", daemon=True).start()
+
+    def submit(self, coroutine):
+        """Schedules `coroutine` on the gateway's loop from any thread; returns a concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def _limits(self, model):
+        if model not in self.semaphores:
+            config = self.gateway.config(model)
+            self.semaphores[model] = asyncio.Semaphore(max(1, int(config["max_concurrency"])))
+            if config["tokens_per_minute"]:
+                self.limiters[model] = TokenRateLimiter(config["tokens_per_minute"])
+        return self.semaphores[model], self.limiters.get(model)
+
+    @asynccontextmanager
+    async def slot(self, model, messages):
+        """
+        Waits for the model's token budget and a free concurrency slot,
+        then holds the slot for the block (e.g. while a stream is read).
+        """
+        semaphore, limiter = self._limits(model)
+        if limiter is not None:
+            started = time.perf_counter()
+            await limiter.acquire(count_message_tokens(messages, model))
+            LLM_RATE_LIMIT_WAIT.labels(model).observe(time.perf_counter() - started)
+
+        async with semaphore:
+            LLM_IN_FLIGHT.labels(model).inc()
+            try:
+                yield
+            finally:
+                LLM_IN_FLIGHT.labels(model).dec()
+
+    def charge(self, model, tokens):
+        """Charges completion tokens against the model's budget, if it has one."""
+        limiter = self._limits(model)[1]
+        if limiter is not None:
+            limiter.charge(tokens)
+
+    async def chat_completion(self, model, messages, **kwargs):
+        """
+        Async chat.completions.create with the model's timeouts and retry
+        policy. Call it inside `slot()`.
+        """
+        attempts = self.gateway.attempts(model)
+        while True:
+            timeout = attempts.start()
+            try:
+                response = await self.client.chat.completions.create(
+                    model=model, messages=messages, timeout=timeout, **kwargs
+                )
+            except Exception as e:
+                delay = attempts.failed(e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            attempts.succeeded()
+            return response
+
+
+_async_gateway = None
+_async_gateway_lock = threading.Lock()
+
+
+def get_async_gateway():
+    """
+    The process-wide async gateway and its event loop thread, started on
+    first use. Uses the same LLM_BASE_URL and connection limits as
+    get_gateway().
+    """
+    global _async_gateway
+    with _async_gateway_lock:
+        if _async_gateway is None:
+            _async_gateway = AsyncLLMGateway(
+                get_gateway(),
+                base_url=os.environ.get("LLM_BASE_URL") or None,
+                max_connections=int(os.environ.get("LLM_MAX_CONNECTIONS", 64)),
+                max_keepalive=int(os.environ.get("LLM_MAX_KEEPALIVE", 32))
+            )
+        return _async_gateway
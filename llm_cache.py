@@ -0,0 +1,148 @@
+# backend/llm_cache.py
+
+import os
+import gzip
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import OrderedDict
+
+from metrics import LLM_CACHE_REQUESTS
+
+
+class LLMResponseCache:
+    """
+    Completions keyed by a hash of the model, messages and sampling
+    parameters.
+
+    Each key holds up to `variants` distinct responses. Until it has
+    that many, every request is a miss and its response is added, so
+    repeated prompts still get some variety. After that, one of the
+    cached variants is served at random. Variants expire after
+    `ttl_seconds`.
+
+    Recently used keys stay in a bounded in-memory LRU. Every key is
+    also written to disk as gzip-compressed JSON, which survives
+    restarts and is shared by every process on the host.
+    """
+
+    def __init__(self, cache_dir, max_entries=256, ttl_seconds=7 * 24 * 3600, variants=1):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants = max(1, variants)
+        self.memory = OrderedDict()  # key -> [variant]
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model, messages, **params):
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json.gz")
+
+    # --- lookups ---
+
+    def get(self, key):
+        """A cached variant for `key`, or None when the model should be called."""
+        variants = self._variants(key)
+        if len(variants) < self.variants:
+            LLM_CACHE_REQUESTS.labels("miss").inc()
+            return None
+        LLM_CACHE_REQUESTS.labels("hit").inc()
+        return random.choice(variants)
+
+    def _variants(self, key):
+        now = time.time()
+        with self.lock:
+            variants = self.memory.get(key)
+            if variants is not None:
+                self.memory.move_to_end(key)
+
+        if variants is None:
+            variants = self._read(key)
+            with self.lock:
+                self._remember(key, variants)
+
+        return [v for v in variants if now - v["created_at"] < self.ttl_seconds]
+
+    def _read(self, key):
+        try:
+            with gzip.open(self._path(key), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError, OSError):
+            return []
+
+    # --- updates ---
+
+    def put(self, key, content, model, usage):
+        """Adds a response as a new variant of `key`. Returns the variant id."""
+        variant = {
+            "id": hashlib.sha256(content.encode("utf-8")).hexdigest()[:16],
+            "content": content,
+            "model": model,
+            "usage": usage,
+            "created_at": time.time()
+        }
+        self._change(key, lambda variants: [v for v in variants if v["id"] != variant["id"]] + [variant])
+        return variant["id"]
+
+    def discard(self, key, variant_id):
+        """Drops one variant, e.g. after its LilyPond failed to compile."""
+        self._change(key, lambda variants: [v for v in variants if v["id"] != variant_id])
+
+    def _change(self, key, update):
+        now = time.time()
+        with self.lock:
+            variants = [v for v in update(self._read(key)) if now - v["created_at"] < self.ttl_seconds]
+            variants = variants[-self.variants:]
+            self._remember(key, variants)
+            self._write(key, variants)
+
+    def _remember(self, key, variants):
+        self.memory[key] = variants
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _write(self, key, variants):
+        path = self._path(key)
+        if not variants:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(variants, f)
+        os.replace(tmp_path, path)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    The process-wide response cache, or None unless LLM_CACHE is enabled.
+    LLM_CACHE_VARIANTS sets how many distinct responses a prompt collects
+    before cached ones are served.
+    """
+    global _cache
+    if os.environ.get("LLM_CACHE", "").lower() not in ("1", "true", "yes"):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMResponseCache(
+                os.environ.get("LLM_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache")),
+                max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 256)),
+                ttl_seconds=float(os.environ.get("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+                variants=int(os.environ.get("LLM_CACHE_VARIANTS", 1))
+            )
+        return _cache
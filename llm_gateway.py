@@ -0,0 +1,226 @@
+# backend/llm_gateway.py
+
+import os
+import json
+import time
+import random
+import threading
+
+import httpx
+import openai
+
+from metrics import LLM_RETRIES, LLM_CIRCUIT_OPENED
+
+
+# Per-model settings; LLM_MODEL_CONFIG (JSON) overrides them per model
+# name, with "*" applying to every model.
+DEFAULT_MODEL_CONFIG = {
+    "timeout": 120.0,         # seconds for one attempt (read/write)
+    "connect_timeout": 10.0,
+    "deadline": 300.0,        # seconds for the whole call, retries included
+    "max_retries": 3,
+    "backoff_base": 1.0,      # first retry waits up to this long...
+    "backoff_max": 30.0,      # ...doubling each time, capped here
+    "failure_threshold": 5,   # consecutive failures that open the circuit
+    "reset_seconds": 30.0,    # how long it stays open before a trial call
+    # Async path only (LLM_ASYNC=1, see llm_async.py)
+    "max_concurrency": 32,    # requests in flight per process
+    "tokens_per_minute": 0,   # token budget per process; 0 = unlimited
+}
+
+# Rate limits, server errors, timeouts and dropped connections are worth
+# another try; anything else (bad request, auth) is not.
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+class LLMUnavailable(Exception):
+    """Raised without calling the API while a model's circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, then rejects
+    calls for `reset_seconds`. After that a single trial call is let
+    through: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        """Returns True when this failure opened the circuit."""
+        with self.lock:
+            self.failures += 1
+            was_open = self.opened_at is not None
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+            return self.opened_at is not None and not was_open
+
+
+class LLMGateway:
+    """
+    One OpenAI client per process, sharing a keep-alive HTTP connection
+    pool across every thread, with a deadline, jittered exponential
+    retries and a circuit breaker per model.
+
+    The SDK's own retries are turned off so that only this layer retries.
+    With stream=True, retries cover opening the stream, not reading it.
+    """
+
+    def __init__(self, base_url=None, model_config=None, max_connections=64, max_keepalive=32):
+        self.model_config = model_config or {}
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            timeout=httpx.Timeout(DEFAULT_MODEL_CONFIG["timeout"], connect=DEFAULT_MODEL_CONFIG["connect_timeout"])
+        )
+        self.client = openai.OpenAI(base_url=base_url, http_client=self.http_client, max_retries=0)
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def config(self, model):
+        config = dict(DEFAULT_MODEL_CONFIG)
+        config.update(self.model_config.get("*", {}))
+        config.update(self.model_config.get(model, {}))
+        return config
+
+    def breaker(self, model):
+        with self.lock:
+            if model not in self.breakers:
+                config = self.config(model)
+                self.breakers[model] = CircuitBreaker(config["failure_threshold"], config["reset_seconds"])
+            return self.breakers[model]
+
+    def attempts(self, model):
+        """Retry bookkeeping for one call to `model` (see CallAttempts)."""
+        return CallAttempts(model, self.config(model), self.breaker(model))
+
+    def chat_completion(self, model, messages, **kwargs):
+        """
+        chat.completions.create with the model's timeouts and retry policy.
+        Raises LLMUnavailable while the model's circuit is open, otherwise
+        the last API error once retries or the deadline run out.
+        """
+        attempts = self.attempts(model)
+        while True:
+            timeout = attempts.start()
+            try:
+                response = self.client.chat.completions.create(
+                    model=model, messages=messages, timeout=timeout, **kwargs
+                )
+            except Exception as e:
+                delay = attempts.failed(e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+
+            attempts.succeeded()
+            return response
+
+
+class CallAttempts:
+    """
+    The retry policy for one call, shared by the blocking and the async
+    gateway so that only the waiting differs between them: the circuit
+    breaker is checked before each attempt, each attempt gets what is
+    left of the deadline as its timeout, and a failure is either retried
+    after a jittered backoff or raised.
+    """
+
+    def __init__(self, model, config, breaker):
+        self.model = model
+        self.config = config
+        self.breaker = breaker
+        self.deadline = time.monotonic() + config["deadline"]
+        self.attempt = 0
+
+    def start(self):
+        """Returns the timeout for the next attempt, or raises LLMUnavailable."""
+        if not self.breaker.allow():
+            raise LLMUnavailable(f"{self.model} is failing; not calling it for now")
+
+        remaining = self.deadline - time.monotonic()
+        return httpx.Timeout(
+            max(1.0, min(self.config["timeout"], remaining)),
+            connect=min(self.config["connect_timeout"], max(1.0, remaining))
+        )
+
+    def succeeded(self):
+        self.breaker.record_success()
+
+    def failed(self, error):
+        """
+        Records a failed attempt. Returns how long to wait before the next
+        one, or None when `error` should be raised instead.
+        """
+        if not isinstance(error, RETRYABLE_ERRORS):
+            # Not the service's fault (e.g. a bad request): leave the circuit alone
+            self.breaker.record_success()
+            return None
+
+        if self.breaker.record_failure():
+            LLM_CIRCUIT_OPENED.labels(self.model).inc()
+            print(f"❌ Circuit opened for {self.model} after repeated failures")
+
+        delay = backoff(self.config, self.attempt, error)
+        if self.attempt >= self.config["max_retries"] or time.monotonic() + delay >= self.deadline:
+            return None
+        LLM_RETRIES.labels(self.model, type(error).__name__).inc()
+        print(f"🔁 {self.model} call failed ({type(error).__name__}), retrying in {delay:.1f}s")
+        self.attempt += 1
+        return delay
+
+
+def backoff(config, attempt, error):
+    """Full-jitter exponential backoff, but never sooner than Retry-After."""
+    delay = random.uniform(0, min(config["backoff_max"], config["backoff_base"] * 2 ** attempt))
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+    return delay
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """
+    The process-wide gateway, built on first use (so each gunicorn worker
+    gets its own connection pool after the fork). LLM_BASE_URL points it
+    at another endpoint, e.g. a local stub server.
+    """
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway(
+                base_url=os.environ.get("LLM_BASE_URL") or None,
+                model_config=json.loads(os.environ.get("LLM_MODEL_CONFIG") or "{}"),
+                max_connections=int(os.environ.get("LLM_MAX_CONNECTIONS", 64)),
+                max_keepalive=int(os.environ.get("LLM_MAX_KEEPALIVE", 32))
+            )
+        return _gateway
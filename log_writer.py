@@ -0,0 +1,226 @@
+# backend/log_writer.py
+
+import os
+import re
+import json
+import time
+import atexit
+import threading
+from datetime import datetime, timezone
+
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class LogWriteError(OSError):
+    pass
+
+
+class AppendLogWriter:
+    """
+    Appends JSON lines to a log file from one background thread.
+
+    `append()` queues a record and returns its sequence number straight
+    away; the writer drains everything queued since its last pass, writes
+    it in one go and flushes. `fsync` controls durability:
+
+      "always"    fsync every group; `sync(seq)` blocks until it is done
+      "interval"  fsync at most every `fsync_interval` seconds
+      "never"     leave it to the OS
+
+    The active file is always `path`. When it grows past `max_bytes`, or
+    a new UTC day starts with `rotate_daily`, it is renamed to
+    `path.<segment>` and a fresh one begins. Segments are numbered in
+    order, so (segment, offset) from `position()` names a point in the log.
+
+    `on_write(segment, entries, end)`, if set, is called from the writer
+    thread after each group with [(offset, record)] for the records just
+    written and the offset just past them.
+
+    A failed write or fsync stops the log: records not yet written are
+    dropped, and `append()`, `sync()`, `wait()` and `flush()` raise
+    LogWriteError from then on, so callers fail instead of carrying on
+    with changes that never reached the log. Retrying is not safe, since
+    part of the group may already be in the file.
+    """
+
+    def __init__(self, path, fsync="interval", fsync_interval=1.0, max_bytes=None, rotate_daily=False,
+                 on_write=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.on_write = on_write
+
+        self.cond = threading.Condition()
+        self.pending = []
+        self.appended = 0  # sequence number of the last queued record
+        self.written = 0   # ... and of the last one written out
+        self.closed = False
+        self.error = None  # the write or fsync failure that stopped the log
+
+        rotated = log_segments(path)[:-1]
+        self.segment = rotated[-1][0] + 1 if rotated else 0
+        self.file = open(path, "a")
+        self.offset = self.file.tell()
+        self.day = _utc_day(os.path.getmtime(path)) if self.offset else _utc_day(time.time())
+        self.last_fsync = time.monotonic()
+        self.dirty = False
+
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # --- producers ---
+
+    def append(self, record):
+        line = json.dumps(record) + "\n"
+        with self.cond:
+            if self.closed:
+                raise RuntimeError(f"Log writer for {self.path} is closed")
+            self._check_failed()
+            self.pending.append((line, record))
+            self.appended += 1
+            self.cond.notify_all()
+            return self.appended
+
+    def sync(self, seq):
+        """
+        Blocks until record `seq` is on disk when fsync="always"; otherwise
+        returns at once, unless the log has already failed.
+        """
+        if self.fsync == "always":
+            self.wait(seq)
+        else:
+            with self.cond:
+                if self.written < seq:
+                    self._check_failed()
+
+    def wait(self, seq):
+        with self.cond:
+            while self.written < seq:
+                self._check_failed()
+                self.cond.wait()
+
+    def _check_failed(self):
+        if self.error is not None:
+            raise LogWriteError(f"Log writer for {self.path} failed: {self.error}") from self.error
+
+    def flush(self):
+        """Waits until everything appended so far has been written."""
+        with self.cond:
+            seq = self.appended
+        self.wait(seq)
+
+    def position(self):
+        """(segment, offset) just past the last written record."""
+        with self.cond:
+            return self.segment, self.offset
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    # --- writer thread ---
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    timeout = self.fsync_interval if self.dirty else None
+                    if not self.cond.wait(timeout):
+                        break  # Idle: time to fsync what is already written
+                batch, self.pending = self.pending, []
+                last = self.appended
+                closing = self.closed and not batch
+                failed = self.error is not None
+
+            if not failed:
+                try:
+                    if batch:
+                        self._write(batch)
+                    if self.dirty and (self.fsync == "always" or closing or
+                                       time.monotonic() - self.last_fsync >= self.fsync_interval):
+                        self._fsync()
+                except Exception as e:
+                    print(f"❌ Failed to write {self.path}, no further records will be logged: {e}")
+                    failed = True
+                    with self.cond:
+                        self.error = e
+
+            with self.cond:
+                if not failed:
+                    self.written = last
+                self.cond.notify_all()
+
+            if closing:
+                self.file.close()
+                return
+
+    def _write(self, batch):
+        today = _utc_day(time.time())
+        if self.offset and ((self.max_bytes and self.offset >= self.max_bytes) or
+                            (self.rotate_daily and today != self.day)):
+            self._rotate()
+        self.day = today
+
+        entries = []
+        offset = self.offset
+        for line, record in batch:
+            entries.append((offset, record))
+            offset += len(line.encode())
+
+        self.file.write("".join(line for line, _ in batch))
+        self.file.flush()
+        self.dirty = True
+        with self.cond:
+            self.offset = offset
+
+        if self.on_write:
+            try:
+                self.on_write(self.segment, entries, offset)
+            except Exception as e:
+                print(f"❌ Log write hook failed for {self.path}: {e}")
+
+    def _fsync(self):
+        if self.fsync != "never":
+            os.fsync(self.file.fileno())
+        self.dirty = False
+        self.last_fsync = time.monotonic()
+
+    def _rotate(self):
+        self._fsync()
+        self.file.close()
+        os.replace(self.path, f"{self.path}.{self.segment}")
+        with self.cond:
+            self.segment += 1
+            self.offset = 0
+        self.file = open(self.path, "a")
+
+
+def log_segments(path):
+    """
+    [(segment, path)] for every file of a rotated log, oldest first.
+    The active file comes last, numbered one past the newest rotated one.
+    """
+    directory = os.path.dirname(path) or "."
+    pattern = re.compile(re.escape(os.path.basename(path)) + r"\.(\d+)$")
+    rotated = sorted(
+        (int(match.group(1)), os.path.join(directory, name))
+        for match, name in ((pattern.match(name), name) for name in os.listdir(directory))
+        if match
+    )
+    active = rotated[-1][0] + 1 if rotated else 0
+    return rotated + [(active, path)]
+
+
+def _utc_day(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).date()
@@ -1,11 +1,15 @@
 # backend/main.py
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, request, send_file, jsonify, Response
 import os
 import uuid
+import socket
 import subprocess
 import urllib.request
 
+import math
 import time
+import asyncio
+import queue
 
 
 import re
@@ -13,12 +17,20 @@ import json as json_lib
 
 import openai
 
-import glob
-import random
-
-from openai_utils import log_openai_request
-
-import threading  # 👈 for async job handling
+from openai_utils import cached_openai_request, async_cached_openai_request, cached_prompt_tokens
+from llm_cache import get_cache
+from llm_async import get_async_gateway
+from example_catalog import ExampleScoreCatalog
+from prompt_budget import PromptTooLong, count_message_tokens, token_budget
+from prompt_templates import PROMPT_TEMPLATE_VERSION, generation_messages, refinement_messages
+
+from job_store import JournaledJobStore, SQLiteJobStore, JobArchive, LARGE_FIELDS, FINISHED_STATUSES
+from job_queue import make_job_queue
+import metrics
+from metrics import timed
+from balance_store import make_balance_store
+from balance_ledger import InsufficientFunds
+from job_scheduler import JobScheduler, SchedulerFull, pool_size  # 👈 stage-aware worker pools
 
    
 
@@ -38,70 +50,154 @@ if not os.path.exists(SOUNDFONT_FILE):
 
 app = Flask(__name__)
 
-# ✅ In-memory job store
-jobs = {}
-
 
 
 
 # ✅ Configuration
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-OUTPUT_DIR = os.path.join(BASE_DIR, "output")
+DATA_DIR = os.environ.get("DATA_DIR", BASE_DIR)  # jobs, balances, queue and generated files
+OUTPUT_DIR = os.path.join(DATA_DIR, "output")
 SOUNDFONT_PATH = os.path.join(BASE_DIR, "FluidR3_GM.sf2")
 MIN_FILE_SIZE = 10  # bytes
 
 
 
-JOBS_FILE = os.path.join(BASE_DIR, "jobs.json")
-
+JOBS_FILE = os.path.join(DATA_DIR, "jobs.json")  # snapshot written by journal compaction
+JOBS_JOURNAL_FILE = os.path.join(DATA_DIR, "jobs.journal.jsonl")
+JOBS_ARCHIVE_DIR = os.path.join(DATA_DIR, "job_archive")
+JOBS_DB_FILE = os.environ.get("JOBS_DB_FILE", os.path.join(DATA_DIR, "jobs.db"))
 
-BALANCES_FILE = os.path.join(BASE_DIR, "balances.json")
-
-def load_balances():
-    if os.path.exists(BALANCES_FILE):
-        with open(BALANCES_FILE, "r") as f:
-            return json_lib.load(f)
-    return {}
-
-def save_balances(balances):
-    with open(BALANCES_FILE, "w") as f:
-        json_lib.dump(balances, f)
+if os.environ.get("JOB_STORE", "journal") == "sqlite":
+    # ✅ Shared SQLite job store (WAL) — safe with several gunicorn workers
+    job_store = SQLiteJobStore(JOBS_DB_FILE)
+else:
+    # ✅ In-memory job store, journaled to disk one state change at a time.
+    # Finished jobs spill to a compressed archive after a TTL / byte cap.
+    job_store = JournaledJobStore(
+        JOBS_FILE,
+        JOBS_JOURNAL_FILE,
+        compact_every=int(os.environ.get("JOB_JOURNAL_COMPACT_EVERY", 5000)),
+        archive=JobArchive(JOBS_ARCHIVE_DIR),
+        finished_ttl=float(os.environ.get("JOB_CACHE_TTL_SECONDS", 3600)),
+        max_finished_bytes=int(os.environ.get("JOB_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    )
 
 
 import threading
-balance_lock = threading.Lock()
+
+# ✅ Balance backend: in-memory ledger with balance_log.jsonl as its WAL (default),
+# or BALANCE_STORE=sqlite to share balances across processes (the default with JOB_QUEUE)
+balance_store = make_balance_store(os.environ.get("BALANCE_STORE"), DATA_DIR)
+users, replayed = balance_store.load()
+print(f"💰 Loaded balances for {users} users ({replayed} log records replayed)")
+balance_store.start_snapshotter()
 
 def update_balance(user_id, delta):
     """
     Safely updates the user's balance by `delta` (can be positive or negative).
-    Automatically loads and saves the balances with thread locking.
+    The change is handed to the balance_log.jsonl writer before it is applied.
     Returns the new balance.
     """
-    with balance_lock:
-        balances = load_balances()
-        new_balance = round(balances.get(user_id, 0.0) + delta, 2)
-        balances[user_id] = new_balance
-        save_balances(balances)
+    reason = "credit" if delta > 0 else "job deduction"
+    return balance_store.update(user_id, delta, reason)
+
 
-        # ✅ log it
-        reason = "credit" if delta > 0 else "job deduction"
-        log_balance_change(user_id, delta, reason)
+# ✅ Two-phase charging: a job puts its worst-case cost on hold when it is
+# accepted, then commits its actual cost on completion or releases the hold on failure
+HOLD_COMPLETION_TOKENS = int(os.environ.get("HOLD_COMPLETION_TOKENS", 4000))
+LLM_ATTEMPTS = 3  # the first generation plus two fallbacks
+MIN_JOB_BALANCE = 0.99  # the least a user needs available to start any job
+
+def job_hold_amount(model):
+    """
+    What one job puts on hold: the price of every LLM attempt it may make,
+    each with a full prompt budget and HOLD_COMPLETION_TOKENS of output,
+    and never less than MIN_JOB_BALANCE. JOB_HOLD_AMOUNT replaces the
+    priced amount with a flat one. The reservation is the only funds
+    check, so a job that is accepted is never refused later.
+    """
+    if os.environ.get("JOB_HOLD_AMOUNT"):
+        amount = float(os.environ["JOB_HOLD_AMOUNT"])
+    else:
+        cost, _ = compute_final_cost(
+            token_budget(model) * LLM_ATTEMPTS, HOLD_COMPLETION_TOKENS * LLM_ATTEMPTS, model
+        )
+        amount = math.ceil(cost * 100) / 100
+    return max(amount, MIN_JOB_BALANCE)
+
+def charge_job_cost(ctx, cost):
+    """
+    Charges a finished job against its hold (or directly, for jobs without
+    one) and returns the amount charged. A cost the balance cannot cover
+    is charged down to zero.
+    """
+    if not ctx.get("hold_id"):
+        update_balance(ctx["user_id"], -cost)
+        return cost
 
-        return new_balance
+    charge = cost
+    while True:
+        try:
+            balance_store.commit(
+                ctx["hold_id"], ctx["user_id"], charge, portion=ctx.get("hold_share"),
+                floor=0 if charge > 0 else None
+            )
+            return charge
+        except InsufficientFunds:
+            # Retried, since other jobs may move the balance in between
+            charge = min(charge, max(0.0, balance_store.get(ctx["user_id"])))
+
+def settle_job_cost(ctx, cost):
+    """
+    Charges a finished job without ever failing it: if the balance store
+    refuses the write (log failure, database busy), the hold stays in
+    place, the cost is recorded on the job as `unsettled_cost` and the
+    charge is retried in the background. What the balance could not cover
+    is recorded as `uncharged_cost`.
+    """
+    if not ctx.get("user_id"):
+        return
+    try:
+        charge = charge_job_cost(ctx, cost)
+    except Exception as e:
+        print(f"❌ Could not settle job {ctx['job_id']}, keeping its hold and retrying: {e}")
+        record_settlement(ctx, {"unsettled_cost": cost})
+        unsettled_jobs.put((ctx, cost))
+        return
+    if charge < cost:
+        print(f"⚠️ Job {ctx['job_id']} cost {cost} but only {charge} could be charged")
+        record_settlement(ctx, {"uncharged_cost": round(cost - charge, 6)})
+
+def record_settlement(ctx, fields):
+    try:
+        job_store.update(ctx["job_id"], fields)
+    except Exception as e:
+        print(f"⚠️ Could not record settlement for job {ctx['job_id']}: {e}")
 
+SETTLE_RETRY_SECONDS = float(os.environ.get("SETTLE_RETRY_SECONDS", 10))
+unsettled_jobs = queue.Queue()
 
+def retry_settlements():
+    while True:
+        ctx, cost = unsettled_jobs.get()
+        time.sleep(SETTLE_RETRY_SECONDS)
+        try:
+            charge = charge_job_cost(ctx, cost)
+        except Exception as e:
+            print(f"❌ Settling job {ctx['job_id']} failed again: {e}")
+            unsettled_jobs.put((ctx, cost))
+            continue
+        print(f"✅ Settled job {ctx['job_id']}")
+        fields = {"unsettled_cost": None}
+        if charge < cost:
+            fields["uncharged_cost"] = round(cost - charge, 6)
+        record_settlement(ctx, fields)
 
-BALANCE_LOG_FILE = os.path.join(BASE_DIR, "balance_log.jsonl")
+threading.Thread(target=retry_settlements, name="settle-retry", daemon=True).start()
 
-def log_balance_change(user_id, delta, reason):
-    with open(BALANCE_LOG_FILE, "a") as f:
-        json_lib.dump({
-            "timestamp": int(time.time()),
-            "user_id": user_id,
-            "change": delta,
-            "reason": reason
-        }, f)
-        f.write("\n")
+def release_job_hold(ctx):
+    if ctx.get("user_id") and ctx.get("hold_id"):
+        balance_store.release(ctx["hold_id"], ctx["user_id"], portion=ctx.get("hold_share"))
 
 
 
@@ -129,24 +225,16 @@ def extract_title_from_lilypond(code):
 
 
 
-def save_jobs_to_file():
-    try:
-        with open(JOBS_FILE, "w") as f:
-            json_lib.dump(jobs, f)
-    except Exception as e:
-        print(f"❌ Failed to save jobs: {e}")
-
 def load_jobs_from_file():
-    global jobs
     try:
-        if os.path.exists(JOBS_FILE):
-            with open(JOBS_FILE, "r") as f:
-                jobs = json_lib.load(f)
-                print(f"🔄 Loaded {len(jobs)} jobs from disk")
+        loaded, replayed = job_store.load()
+        print(f"🔄 Loaded {loaded} jobs from disk ({replayed} journal records replayed)")
     except Exception as e:
         print(f"❌ Failed to load jobs: {e}")
 
 load_jobs_from_file()
+job_store.start_compactor()
+job_store.start_spiller()
 
 
 # ✅ Ensure output/ exists
@@ -161,17 +249,42 @@ def get_user_balance():
     if not user_id:
         return jsonify({"error": "Missing user_id"}), 400
     balance = get_user_balance_value(user_id)
-    return jsonify({"user_id": user_id, "balance": balance})
+    return jsonify({
+        "user_id": user_id,
+        "balance": balance,
+        "available": balance_store.available(user_id)
+    })
 
     
     
 def get_user_balance_value(user_id):
     """
-    Thread-safe read of the user's current balance from disk.
+    Lock-free read of the user's current balance from the ledger.
+    """
+    return balance_store.get(user_id)
+
+
+MAX_BALANCE_HISTORY = 500
+
+@app.route("/balance-history", methods=["GET"])
+def balance_history():
+    """
+    A user's credits and deductions, newest first.
+    Optional `since` (unix timestamp) and `limit` (default 50).
     """
-    with balance_lock:
-        balances = load_balances()
-        return round(balances.get(user_id, 0.0), 2)
+    user_id = request.args.get("user_id")
+    if not user_id:
+        return jsonify({"error": "Missing user_id"}), 400
+    try:
+        since = int(request.args.get("since", 0))
+        limit = max(1, min(int(request.args.get("limit", 50)), MAX_BALANCE_HISTORY))
+    except ValueError:
+        return jsonify({"error": "Invalid since or limit"}), 400
+
+    return jsonify({
+        "user_id": user_id,
+        "history": balance_store.history(user_id, since=since, limit=limit)
+    })
 
 
 @app.route("/add-credits", methods=["POST"])
@@ -191,12 +304,167 @@ def add_credits():
 
 
 
+MAX_USER_JOBS = 100
+
+@app.route("/user-jobs", methods=["GET"])
+def user_jobs():
+    """
+    A user's jobs, newest first, without their large fields.
+    Optional `status` filter and `limit` (default 20).
+    """
+    user_id = request.args.get("user_id")
+    if not user_id:
+        return jsonify({"error": "Missing user_id"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), MAX_USER_JOBS))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    return jsonify({
+        "user_id": user_id,
+        "jobs": job_store.find(user_id=user_id, status=request.args.get("status") or None, limit=limit)
+    })
+
+
 @app.route("/job-status/<job_id>")
 def job_status(job_id):
-    job = jobs.get(job_id)
+    """
+    Returns the job without its large fields by default.
+    `fields=status,pdf_url` projects to just those keys; `fields=all`
+    includes `lilypond` and `conversation_history`. The job's version and
+    the view (the sorted field list for a projection) are sent as an ETag,
+    and a matching If-None-Match gets a bodyless 304.
+    """
+    fields_param = request.args.get("fields", "")
+    if fields_param == "all":
+        fields = None
+        include_large = True
+    elif fields_param:
+        fields = sorted({f.strip() for f in fields_param.split(",") if f.strip()})
+        if not fields:
+            return jsonify({"error": "fields must name at least one field"}), 400
+        include_large = any(f in LARGE_FIELDS for f in fields)
+    else:
+        fields = None
+        include_large = False
+
+    job = job_store.get(job_id, include_large=False)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+
+    if fields is not None:
+        view = "fields=" + ",".join(fields)
+    else:
+        view = "all" if include_large else "compact"
+    etag = f"{job_id}-{job.get('version', 0)}-{view}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    if include_large:
+        job = job_store.get(job_id) or job
+    if fields is not None:
+        job = {field: job[field] for field in fields if field in job}
+
+    response = jsonify(job)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+PROGRESS_FIELDS = (
+    "status", "stage", "version", "error", "title", "pdf_url", "mp3_url", "final_cost",
+    "queue_position", "estimated_completion_at", "llm_progress"
+)
+LONG_POLL_MAX_SECONDS = 30
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_SECONDS = 300
+
+# ✅ Each waiting client holds a gunicorn thread, so only this many may wait
+# at once (keep it below --threads); the rest of the routes stay responsive.
+# Over the cap, long-polls answer right away and SSE streams get a 503.
+PROGRESS_WATCHERS = threading.BoundedSemaphore(pool_size("MAX_PROGRESS_WATCHERS", 16))
+
+
+def job_progress_view(job_id, job):
+    view = {field: job.get(field) for field in PROGRESS_FIELDS if field in job}
+    view["job_id"] = job_id
+    view.setdefault("version", 0)
+    return view
+
+
+@app.route("/job-progress/<job_id>")
+def job_progress(job_id):
+    """
+    Long-poll fallback for /job-events: returns as soon as the job's
+    version is newer than `since`, or after `timeout` seconds.
+    """
+    since = request.args.get("since", -1, type=int)
+    timeout = min(request.args.get("timeout", 25, type=float), LONG_POLL_MAX_SECONDS)
+
+    if PROGRESS_WATCHERS.acquire(blocking=False):
+        try:
+            job = job_store.wait_for_change(job_id, since, max(timeout, 0))
+        finally:
+            PROGRESS_WATCHERS.release()
+    else:
+        # Too many clients waiting: answer now and let the client poll again
+        job = job_store.get(job_id, include_large=False)
     if not job:
         return jsonify({"error": "Job not found"}), 404
-    return jsonify(job)
+    return jsonify(job_progress_view(job_id, job))
+
+
+@app.route("/job-events/<job_id>")
+def job_events(job_id):
+    """
+    Server-Sent Events stream of stage transitions
+    (llm → lilypond → fluidsynth → ffmpeg → completed).
+    """
+    if job_id not in job_store:
+        return jsonify({"error": "Job not found"}), 404
+
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", -1, type=int)
+
+    if not PROGRESS_WATCHERS.acquire(blocking=False):
+        response = jsonify({"error": "Too many open progress streams; poll /job-progress instead"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "5"
+        return response
+
+    def stream():
+        version = since
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        yield "retry: 2000\n\n"
+
+        while time.monotonic() < deadline:
+            job = job_store.wait_for_change(job_id, version, SSE_HEARTBEAT_SECONDS)
+            if not job:
+                yield "event: error\ndata: {\"error\": \"Job not found\"}\n\n"
+                return
+
+            if job.get("version", 0) <= version:
+                yield ": keep-alive\n\n"
+                continue
+
+            version = job.get("version", 0)
+            view = job_progress_view(job_id, job)
+            yield f"id: {version}\nevent: progress\ndata: {json_lib.dumps(view)}\n\n"
+
+            if job.get("status") in FINISHED_STATUSES:
+                return
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Runs when the stream ends or the client goes away
+    response.call_on_close(PROGRESS_WATCHERS.release)
+    return response
 
 
 
@@ -213,85 +481,58 @@ def download(filename):
 
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 
+# ✅ Stream completions (progress while the model writes, early stop at the
+# closing fence); LLM_STREAMING=0 waits for whole responses instead
+LLM_STREAMING = os.environ.get("LLM_STREAMING", "1").lower() not in ("0", "false", "no")
+LLM_PROGRESS_INTERVAL_SECONDS = float(os.environ.get("LLM_PROGRESS_INTERVAL_SECONDS", 1.0))
+
+# ✅ LLM_ASYNC=1 runs the LLM stage as coroutines on one event loop thread
+# (per-model concurrency and token-per-minute limits in LLM_MODEL_CONFIG)
+# instead of one blocking worker thread per call
+LLM_ASYNC = os.environ.get("LLM_ASYNC", "").lower() in ("1", "true", "yes")
 
 
 
-def run_smart_generation(user_prompt, model, balance):
-    import re
-    import json as json_lib
-    import glob
-    import random
-    from openai_utils import log_openai_request
 
-    if balance < 0.99:
-        raise ValueError("Insufficient funds")
+# ✅ Example scores are read once and reloaded when the directory changes
+example_catalog = ExampleScoreCatalog(os.path.join(BASE_DIR, "example_scores"))
+print(f"🎼 Loaded {example_catalog.load()} example scores")
+example_catalog.start_watcher(interval=float(os.environ.get("EXAMPLE_SCORES_POLL_SECONDS", 10)))
 
+
+def fit_generation_prompt(user_prompt, model):
+    """
+    Builds the generation messages within the model's prompt token
+    budget: the best-fitting example first, then the smallest one, then
+    no example at all (also when there are no example scores). Returns
+    (messages, token estimate, example).
+    """
+    budget = token_budget(model)
+    best = example_catalog.index.choose(user_prompt)
+    candidates = [best, example_catalog.smallest(), None]
+    for example in candidates:
+        messages = generation_messages(user_prompt, example["minified"] if example else None)
+        estimate = count_message_tokens(messages, model)
+        if estimate <= budget:
+            return messages, estimate, example
+    raise PromptTooLong(f"Prompt needs {estimate} tokens; the budget for {model} is {budget}")
+
+
+def smart_generation_steps(user_prompt, model):
+    """
+    The generation loop without the API calls: yields the messages for
+    each call, is sent back (response, cache_ref) and returns the result.
+    run_smart_generation and run_smart_generation_async drive it with
+    blocking and async calls.
+    """
     NUM_ITERATIONS = 1
+    timings = {}
 
-    EXAMPLE_SCORES_DIR = os.path.join(BASE_DIR, "example_scores")
-    example_files = glob.glob(os.path.join(EXAMPLE_SCORES_DIR, "example_score_*.ly"))
-    if not example_files:
-        raise RuntimeError("No example_score_*.ly files found")
-
-    random_example_path = random.choice(example_files)
-    with open(random_example_path, "r", encoding="utf-8") as f:
-        example_lilypond = f.read()
-
-    conversation = [
-        {
-            "role": "system",
-            "content":
-                "You are an expert composer.\n\n"
-                "Write similar as if an etude by composers such as: Bach, Czerny, Chopin, Liszt, Debussy, Scriabin, Rachmaninoff, Shostakovich, Bartók, Paganini, Ernst, Kreutzer, Rode, Mazas, Accolay.\n"
-                "When the user requests a musical composition, you must first carefully plan (don't be so generic, not always C major and 6/8 time):\n\n"
-                "- Style\n"
-                "- Form\n"
-                "- Key (or 'atonal')\n"
-                "- Modulation (if any)\n"
-                "- Time Signature\n"
-                "- Mood\n"
-                "- Upbeat (or not)\n"
-                "- Texture\n\n"
-                "- Measures must add up exactly according to the time signature.\n"
-                "- All voices must have the same number of measures and remain aligned bar-by-bar.\n"
-                "✅ Then generate the LilyPond (.ly) code inside a ```lilypond``` block.\n\n"
-                "LilyPond Code Rules:\n"
-                "only include a composer if specified (otherwise DO NOT include a composer)\n"
-                "- Use exact pitches (no \\relative).\n"
-                "- Include \\version, \\header, \\layout, and \\midi blocks.\n"
-                "- Include \\score { ... } surrounding the music.\n"
-                "- Use valid LilyPond pitch names (e.g., bes not Bb).\n\n"
-                "- Include a tempo indication (such as a descriptive word or a numerical marking) using \\\\tempo near the beginning of the score. Choose a value that matches the character and pacing of the piece.\n"
-                "- Use dynamics (e.g., \\\\p, \\\\f, \\\\mf) and expressive markings (e.g., phrasing hairpins, text expressions with \\\\markup) that support the musical shape and intention.\n"
-                "- Add phrasing slurs and articulations (e.g., staccato, accents) to clarify musical expression and performance details."
-                "- All staves (voices) must have the same number of measures.\n"
-                "If lyrics are needed, define a variable like \\verseLyrics (do not use \\lyrics), then connect it using \\new Lyrics \\lyricsto \"voiceName\" \\verseLyrics. Always define the melody as a separate variable (e.g., melody = { ... }) before using it inside \\new Voice = \"voiceName\" { \\melody }, so lyrics can attach correctly."
-                "Base the harmonic structure on the following (use it as a close guide!!):\n\n"
-                "```lilypond\n" + example_lilypond + "\n```" + "\n\n"
-                "NEVER output explanations, comments, or markdown outside code blocks.\n"
-                "Only output pure LilyPond inside code blocks.\n\n"
-                "Make the music interesting: think: movement, contrast, rests, quavers, ties, suspensions, syncopation, unity. "
-                "Ensure rhythmic interest. Avoid voice doubling. Use exact pitch and valid LilyPond syntax."
-                "Add syncopation, triplets, arpeggios, scalic runs, suspensions, and phrasing rests. "
-                "Introduce pedal tones where appropriate. Ensure all voices contribute to the texture and maintain proper text-book voice-leading (no parallel 5ths and octaves)."
-                "Ensure:\n"
-                "- rhythmic contrast and interest throughout\n"
-                "- expressive melodic phrasing\n"
-                "- inner voices with variation (triplets, pedal tones, arpeggiation)\n"
-                "- motivic unity\n"
-                "- use of phrasing rests\n"
-                "Always follow the formatting style used in the example score above. "
-                "Each LilyPond command (e.g., \\\\version, \\\\header, variable = { ... }, \\\\score { ... }) must start on its own line. "
-                "Never place multiple commands on the same line. "
-                "Match the indentation and spacing style exactly."
-                "Use the example score as a strict formatting template. Do not deviate from its structure or layout style. However, choose your instrumentation wisely based on the user prompt."
-                "Do not include any comments (e.g., lines starting with %). Absolutely no `%` symbols should appear in the output LilyPond code. All output must be pure code only, with no comments."
-        },
-        {"role": "user", "content": user_prompt}
-    ]
+    with timed(timings, "build_prompt"):
+        # ✅ Closest template for this prompt that fits the model's token budget
+        conversation, conversation_estimate, example = fit_generation_prompt(user_prompt, model)
 
     def parse_response(full_text):
-        import re
         # ✅ Try matching proper Markdown code block
         match = re.search(r"```lilypond\s*(.*?)\s*```", full_text, re.DOTALL)
         if match:
@@ -310,6 +551,8 @@ def run_smart_generation(user_prompt, model, balance):
     total_prompt_tokens = 0
     total_completion_tokens = 0
     total_tokens = 0
+    total_prompt_estimate = 0
+    total_cached_tokens = 0
 
     lilypond_code = None
     versions = []
@@ -318,57 +561,15 @@ def run_smart_generation(user_prompt, model, balance):
     for i in range(1, NUM_ITERATIONS + 1):
         if i == 1:
             messages = conversation
+            prompt_estimate = conversation_estimate
         else:
-                if i == 2:
-                    refine_prompt = (
-                        "Following the original plan, add a melody over the harmony using chord tones as a base."
-                        "Do not change the style, form, or key unless the plan specifies it. "
-                        "Make the melody interesting and distinct compared to other voices. Think: movement, contrast, rests, quavers, ties, suspensions, syncopation, unity. "
-                        "Ensure rhythmic interest. Avoid voice doubling. Use exact pitch and valid LilyPond syntax."
-                    )
-                elif i == 3:
-                    refine_prompt = (
-                        "Following the plan, enhance the inner and lower voices for greater musical and rhythmic interest. "
-                        "Add syncopation, triplets, arpeggios, scalic runs, suspensions, and phrasing rests. "
-                        "Introduce pedal tones where appropriate. Ensure all voices contribute to the texture and maintain proper voice-leading."
-                    )
-                elif i == 4:
-                    refine_prompt = (
-                        "Continue following the original plan. Refine the composition for musical expressiveness, rhythmic vitality, and structural clarity. "
-                        "Ensure:\n"
-                        "- rhythmic contrast and interest throughout\n"
-                        "- expressive melodic phrasing\n"
-                        "- inner voices with variation (triplets, pedal tones, arpeggiation)\n"
-                        "- motivic unity\n"
-                        "- use of phrasing rests\n"
-                        "Ensure the LilyPond code compiles, uses exact pitch, and follows formatting rules."
-                    )
-                elif i == 5:
-                    refine_prompt = (
-                        "Finalize the composition. Confirm it matches the original plan. Make the music coherent, expressive, and formally satisfying. "
-                        "Double-check that the LilyPond code includes \\version, \\header, \\layout, \\midi, and \\score { ... } and compiles correctly."
-                        "Fix the score: ensure all measures add up to the correct duration, synchronize all parts bar-by-bar, and align voices so they finish together."
-                    )
-
-                messages = [
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are an expert LilyPond composer and editor. When refining a composition, follow the user's original plan exactly. "
-                            "Use German note names (e.g., fis, bes), exact pitch (no \\relative), and avoid parallel 5ths/8ves. "
-                            "Ensure rhythmic and melodic variety, structural balance, and musical interest in all voices. "
-                            "Wrap the music in a valid \\score block with \\layout and \\midi. "
-                            "Output valid LilyPond code only — no explanations or extra comments."
-                        )
-                    },
-                    {"role": "user", "content": f"The user's original musical prompt:\n\n{user_prompt}"},
-                    {"role": "user", "content": f"Here is the current LilyPond score:\n\n{lilypond_code}"},
-                    {"role": "user", "content": refine_prompt}
-                ]
+            messages = refinement_messages(i, user_prompt, lilypond_code)
+            prompt_estimate = count_message_tokens(messages, model)
 
         all_messages.append({"iteration": i, "messages": messages})
 
-        response = log_openai_request(model=model, messages=messages, temperature=0.7)
+        with timed(timings, f"openai_iteration_{i}", "openai"):
+            response, cache_ref = yield messages
         content = response.choices[0].message.content.strip()
         usage = response.usage
         model_used = response.model
@@ -376,6 +577,15 @@ def run_smart_generation(user_prompt, model, balance):
         total_prompt_tokens += usage.prompt_tokens
         total_completion_tokens += usage.completion_tokens
         total_tokens += usage.total_tokens
+        total_prompt_estimate += prompt_estimate
+
+        # ✅ Prompt tokens the provider served from its prompt cache
+        cached_tokens = cached_prompt_tokens(usage)
+        total_cached_tokens += cached_tokens
+
+        # ✅ Track how far the local estimate is from what the API counted
+        if not getattr(usage, "estimated", False) and prompt_estimate:
+            metrics.PROMPT_TOKEN_ESTIMATE_RATIO.labels(model_used).observe(usage.prompt_tokens / prompt_estimate)
 
         if i == 1:
             lilypond_code = parse_response(content)
@@ -388,8 +598,11 @@ def run_smart_generation(user_prompt, model, balance):
         versions.append({
             "iteration": i,
             "lilypond": lilypond_code,
+            "cached": bool(cache_ref and cache_ref["hit"]),
             "tokens": {
+                "prompt_estimate": prompt_estimate,
                 "prompt": usage.prompt_tokens,
+                "cached_prompt": cached_tokens,
                 "completion": usage.completion_tokens,
                 "total": usage.total_tokens
             }
@@ -399,232 +612,966 @@ def run_smart_generation(user_prompt, model, balance):
         "final_lilypond": lilypond_code,
         "iterations": versions,
         "prompt_tokens": total_prompt_tokens,
+        "prompt_tokens_estimate": total_prompt_estimate,
+        "cached_prompt_tokens": total_cached_tokens,
         "completion_tokens": total_completion_tokens,
         "total_tokens": total_tokens,
         "model": model_used,
-        "conversation_history": all_messages
+        "example": example["name"] if example else None,
+        "prompt_template_version": PROMPT_TEMPLATE_VERSION,
+        "conversation_history": all_messages,
+        "timings_ms": timings,
+        "cache_ref": cache_ref
     }
 
 
+def run_smart_generation(user_prompt, model, on_progress=None):
+    steps = smart_generation_steps(user_prompt, model)
+    try:
+        messages = next(steps)
+        while True:
+            messages = steps.send(cached_openai_request(
+                model=model, messages=messages, temperature=0.7,
+                stream=LLM_STREAMING, on_progress=on_progress
+            ))
+    except StopIteration as done:
+        return done.value
+
+
+async def run_smart_generation_async(user_prompt, model, on_progress=None):
+    """run_smart_generation with the API calls awaited on the LLM event loop."""
+    steps = smart_generation_steps(user_prompt, model)
+    try:
+        messages = next(steps)
+        while True:
+            messages = steps.send(await async_cached_openai_request(
+                model=model, messages=messages, temperature=0.7,
+                stream=LLM_STREAMING, on_progress=on_progress
+            ))
+    except StopIteration as done:
+        return done.value
+
+
 
         
         
         
-@app.route("/start-smart-full-generate", methods=["POST"])
-def start_smart_full_generate():
-    data = request.get_json()
-    user_prompt = data.get("prompt")
-    model = data.get("model", "gpt-4.1")
-    # balance = data.get("balance", 0.0)
-    user_id = data.get("user_id")  # <-- NEW
-    balance = get_user_balance_value(user_id) if user_id else 0.0
+def sanitize_title_for_lilypond(title):
+    return title.replace('"', '\\"').replace("\\", "\\\\")
 
 
-    requested_filename = data.get("filename") or str(uuid.uuid4())
+def run_tool(tool, args):
+    """subprocess.run(check=True) that counts failures per tool."""
+    try:
+        subprocess.run(args, check=True)
+    except (subprocess.CalledProcessError, OSError):
+        metrics.SUBPROCESS_FAILURES.labels(tool).inc()
+        raise
 
-    if not user_prompt:
-        return jsonify({"error": "Missing prompt"}), 400
-    if balance < 0.99:
-        return jsonify({"error": "Insufficient funds"}), 403
 
-    filename = "".join(c for c in requested_filename if c.isalnum() or c in ("_", "-")).rstrip()
-    job_id = str(uuid.uuid4())
+def span_name(ctx, name):
+    """Prefixes timing spans of fallback attempts, e.g. `fallback_1.llm`."""
+    if ctx["fallback_level"]:
+        return f"fallback_{ctx['fallback_level']}.{name}"
+    return name
 
-    jobs[job_id] = {
-        "status": "pending",
-        "filename": filename,
-        "result": None,
-        "error": None
-    }
 
-    def job_runner():
-        try:
-            # Step 1: smart generate
-            result = run_smart_generation(user_prompt, model, balance)
-            
-            # ✅ Calculate token cost and include it in the result
-            prompt_tokens = result.get("prompt_tokens", 0)
-            completion_tokens = result.get("completion_tokens", 0)
-            model_used = result.get("model", model)
-            lilypond_code = result["final_lilypond"]
-            lilypond_code = add_footer_to_lilypond(lilypond_code)  # ✅ Inject footer here
-
-
-            # Step 2: compile LilyPond → PDF/MP3
-            ly_path = os.path.join(OUTPUT_DIR, f"{filename}.ly")
-            pdf_path = os.path.join(OUTPUT_DIR, f"{filename}.pdf")
-            midi_path = os.path.join(OUTPUT_DIR, f"{filename}.midi")
-            mp3_path = os.path.join(OUTPUT_DIR, f"{filename}.mp3")
-            wav_path = os.path.join(OUTPUT_DIR, f"{filename}.wav")
-
-            with open(ly_path, "w") as f:
-                f.write(lilypond_code)
+def enter_stage(ctx, stage):
+    job_store.update(ctx["job_id"], {"stage": stage, "timings_ms": ctx["timings"]})
+
+
+def make_checkpoint(ctx, next_stage):
+    # The queue message id only means something to the process that claimed it
+    state = {k: v for k, v in ctx.items() if k != "queue_message_id"}
+    return {"stage": next_stage, "ctx": state}
+
+
+def checkpoint_job(ctx, next_stage):
+    """
+    Saves everything needed to resume the job at `next_stage` after a
+    restart: generated LilyPond, token usage and finished render steps.
+    """
+    job_store.update(ctx["job_id"], {"checkpoint": make_checkpoint(ctx, next_stage)})
+
+
+def resume_point(ctx):
+    """Returns (ctx, stage) from the job's last checkpoint, if it has one."""
+    job = job_store.get(ctx["job_id"]) or {}
+    checkpoint = job.get("checkpoint")
+    if not checkpoint:
+        return ctx, None
+    resumed = dict(checkpoint["ctx"])
+    if "queue_message_id" in ctx:
+        resumed["queue_message_id"] = ctx["queue_message_id"]
+    return resumed, checkpoint["stage"]
+
+
+# ✅ A job running in this process carries its owner and a lease that the
+# process keeps renewing. Resuming only takes over jobs whose lease ran out,
+# so gunicorn workers sharing a SQLite job store never run a sibling's job.
+PROCESS_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 120))
+owned_jobs = set()
+owned_jobs_lock = threading.Lock()
+
+
+def lease_fields():
+    return {"owner": PROCESS_ID, "lease_until": time.time() + JOB_LEASE_SECONDS}
+
+
+def own_job(job_id):
+    with owned_jobs_lock:
+        owned_jobs.add(job_id)
+
 
+def disown_job(job_id):
+    with owned_jobs_lock:
+        owned_jobs.discard(job_id)
+
+
+def renew_leases():
+    with owned_jobs_lock:
+        job_ids = list(owned_jobs)
+    for job_id in job_ids:
+        job_store.update_if(job_id, {"owner": PROCESS_ID}, {"lease_until": time.time() + JOB_LEASE_SECONDS})
+
+
+def resume_interrupted_jobs(ignore_leases=False):
+    """
+    Re-enqueues jobs left unfinished by a restart (or a crashed sibling
+    process) from their last finished stage, so LLM output that was
+    already paid for is not generated again. Each job is claimed with
+    update_if first; jobs under a live lease are left alone unless
+    `ignore_leases` (no other process can be running them).
+    """
+    resumed = 0
+    batch_groups = {}
+    now = time.time()
+    for job_id in job_store.find_unfinished():
+        job = job_store.get(job_id) or {}
+        if job.get("kind") == "batch":
+            batch_groups.setdefault(job_id, job)
+            continue
+        if job.get("stage") == "waiting":
+            # Items are admitted in order, so one its group already counts as
+            # admitted lost the process that was admitting it
+            group_id = job.get("group_id")
+            if group_id not in batch_groups:
+                batch_groups[group_id] = job_store.get(group_id, include_large=False) or {}
+            if job.get("batch_index", 0) < batch_groups[group_id].get("admitted", 0):
+                admit_batch_item(job_id)
+            continue
+        if job.get("owner") == PROCESS_ID:
+            continue
+        if not ignore_leases and (job.get("lease_until") or 0) > now:
+            continue
+
+        current = {"owner": job.get("owner"), "lease_until": job.get("lease_until")}
+        checkpoint = job.get("checkpoint")
+        if not checkpoint:
+            job_store.update_if(job_id, current, {
+                "status": "failed",
+                "stage": "failed",
+                "finished_at": time.time(),
+                "error": "Interrupted by a server restart"
+            })
+            continue
+
+        if not job_store.update_if(job_id, current, lease_fields()):
+            continue  # Another process took it over first
+        own_job(job_id)
+        if job.get("group_id"):
+            with batch_lock:
+                batch_items_here.add(job_id)
+        scheduler.submit(dict(checkpoint["ctx"]), checkpoint["stage"], force=True)
+        resumed += 1
+
+    if resumed:
+        print(f"♻️ Resumed {resumed} interrupted jobs")
+
+    for group_id, group in batch_groups.items():
+        if group.get("kind") == "batch":
+            feed_batch(group_id)
+
+
+def start_lease_keeper():
+    """Renews this process's leases and picks up jobs whose owner died."""
+    def loop():
+        while True:
+            time.sleep(JOB_LEASE_SECONDS / 3)
             try:
-                subprocess.run(
-                    ["lilypond", "-dignore-errors", "-o", os.path.join(OUTPUT_DIR, filename), ly_path],
-                    check=True
-                )
-            except subprocess.CalledProcessError:
-                print(f"❌ LilyPond compilation failed for {filename}.ly. Retrying with fallback prompts...")
+                renew_leases()
+                resume_interrupted_jobs()
+            except Exception as e:
+                print(f"❌ Failed to renew job leases: {e}")
+
+    threading.Thread(target=loop, name="job-lease-keeper", daemon=True).start()
+
+
+def run_llm_stage(ctx):
+    """
+    Pipeline stage 1: asks the model for LilyPond code.
+    On a LilyPond fallback this runs again with a safer prompt.
+    """
+    with timed(ctx["timings"], span_name(ctx, "llm"), "llm"):
+        return generate_lilypond(ctx)
+
+
+async def run_llm_stage_async(ctx):
+    """run_llm_stage for LLM_ASYNC=1: runs on the LLM event loop instead of a worker thread."""
+    with timed(ctx["timings"], span_name(ctx, "llm"), "llm"):
+        return await generate_lilypond_async(ctx)
+
 
-                # First fallback: retry with title
-                extracted_title = extract_title_from_lilypond(lilypond_code)
+def llm_progress_reporter(ctx, loop=None):
+    """
+    Writes streaming progress to the job record, at most once per interval.
+    With an event `loop` the write goes to its default executor instead of
+    blocking the loop; a report is skipped while the previous one is still
+    being written, so a slow store only makes progress coarser.
+    """
+    last_report = [0.0]
+    writing = [None]
 
-                def sanitize_title_for_lilypond(title):
-                    return title.replace('"', '\\"').replace("\\", "\\\\")
+    def write_progress(fields):
+        try:
+            job_store.update(ctx["job_id"], fields)
+        except Exception as e:
+            print(f"⚠️ Could not record LLM progress for job {ctx['job_id']}: {e}")
+
+    def report(stream):
+        now = time.monotonic()
+        if now - last_report[0] < LLM_PROGRESS_INTERVAL_SECONDS:
+            return
+        if writing[0] is not None and not writing[0].done():
+            return
+        last_report[0] = now
+        fields = {
+            "llm_progress": {
+                "tokens": stream.tokens,
+                "bars": stream.bars,
+                "in_code": stream.in_code,
+                "fallback_level": ctx["fallback_level"]
+            }
+        }
+        if loop is None:
+            write_progress(fields)
+        else:
+            writing[0] = loop.run_in_executor(None, write_progress, fields)
 
-                safe_title = sanitize_title_for_lilypond(extracted_title)
-                safe_prompt_1 = f'Write a piano piece with title "{safe_title}"'
-                original_title = safe_title
+    return report
 
-                try:
-                    safe_result = run_smart_generation(safe_prompt_1, model, balance)
-                    lilypond_code = safe_result["final_lilypond"]
-                    lilypond_code = add_footer_to_lilypond(lilypond_code)
 
-                    with open(ly_path, "w") as f:
-                        f.write(lilypond_code)
+def generation_prompt(ctx):
+    """Marks the job as in the LLM stage and returns the prompt for its fallback level."""
+    fallback_level = ctx["fallback_level"]
 
-                    subprocess.run(
-                        ["lilypond", "-dignore-errors", "-o", os.path.join(OUTPUT_DIR, filename), ly_path],
-                        check=True
-                    )
+    if fallback_level == 0:
+        ctx["timings"]["queue_wait"] = round((time.time() - ctx["submitted_at"]) * 1000, 1)
+    enter_stage(ctx, "llm")
 
-                    print("✅ First fallback succeeded")
+    if fallback_level == 0:
+        prompt = ctx["user_prompt"]
+    elif fallback_level == 1:
+        # First fallback: retry with title
+        extracted_title = extract_title_from_lilypond(ctx["lilypond_code"])
+        ctx["original_title"] = sanitize_title_for_lilypond(extracted_title)
+        prompt = f'Write a piano piece with title "{ctx["original_title"]}"'
+    else:
+        # Second fallback: plain piano piece, keeping the original title
+        prompt = "Write a piano piece"
+    return prompt
+
+
+def save_generation(ctx, result):
+    """Stores a generation result on the job and writes its .ly file."""
+    filename = ctx["filename"]
+    fallback_level = ctx["fallback_level"]
+
+    ctx["results"].append(result)
+    for name, ms in result.get("timings_ms", {}).items():
+        ctx["timings"][span_name(ctx, name)] = ms
+    lilypond_code = result["final_lilypond"]
+
+    if fallback_level == 2:
+        original_title = ctx["original_title"]
+        if not re.search(r'title\s*=\s*"', lilypond_code):
+            lilypond_code = lilypond_code.replace(
+                '\\header {',
+                f'\\header {{\n  title = "{original_title}"',
+                1
+            )
+        else:
+            lilypond_code = re.sub(
+                r'(title\s*=\s*")[^"]*(")',
+                rf'\1{original_title}\2',
+                lilypond_code,
+                count=1
+            )
 
-                except subprocess.CalledProcessError:
-                    print("❌ First fallback failed. Trying second fallback...")
+    lilypond_code = add_footer_to_lilypond(lilypond_code)  # ✅ Inject footer here
+    ctx["lilypond_code"] = lilypond_code
 
-                    safe_prompt_2 = "Write a piano piece"
-                    safe_result_2 = run_smart_generation(safe_prompt_2, model, balance)
-                    lilypond_code = safe_result_2["final_lilypond"]
-                    
-                    lilypond_code = safe_result_2["final_lilypond"]
+    with open(os.path.join(OUTPUT_DIR, f"{filename}.ly"), "w") as f:
+        f.write(lilypond_code)
 
-                    if not re.search(r'title\s*=\s*"', lilypond_code):
-                        lilypond_code = lilypond_code.replace(
-                            '\\header {',
-                            f'\\header {{\n  title = "{original_title}"',
-                            1
-                        )
-                    else:
-                        lilypond_code = re.sub(
-                            r'(title\s*=\s*")[^"]*(")',
-                            rf'\1{original_title}\2',
-                            lilypond_code,
-                            count=1
-                        )
+    return "lilypond"
 
-                    lilypond_code = add_footer_to_lilypond(lilypond_code)
 
+def generate_lilypond(ctx):
+    prompt = generation_prompt(ctx)
+    result = run_smart_generation(prompt, ctx["model"], on_progress=llm_progress_reporter(ctx))
+    return save_generation(ctx, result)
 
-                    with open(ly_path, "w") as f:
-                        f.write(lilypond_code)
 
-                    subprocess.run(
-                        ["lilypond", "-dignore-errors", "-o", os.path.join(OUTPUT_DIR, filename), ly_path],
-                        check=True
-                    )
+async def generate_lilypond_async(ctx):
+    # Job store and file writes run in a thread to keep the event loop free
+    prompt = await asyncio.to_thread(generation_prompt, ctx)
+    result = await run_smart_generation_async(
+        prompt, ctx["model"],
+        on_progress=llm_progress_reporter(ctx, asyncio.get_running_loop())
+    )
+    return await asyncio.to_thread(save_generation, ctx, result)
+
+
+def discard_cached_response(result):
+    """Keeps a cached response whose LilyPond failed to compile from being served again."""
+    cache, cache_ref = get_cache(), result.get("cache_ref")
+    if cache is not None and cache_ref:
+        cache.discard(cache_ref["key"], cache_ref["variant"])
+
+
+def run_lilypond_stage(ctx):
+    """
+    Pipeline stage 2: compiles the .ly file to PDF/MIDI.
+    A failed compile sends the job back to the LLM stage with a fallback prompt.
+    """
+    filename = ctx["filename"]
+    ly_path = os.path.join(OUTPUT_DIR, f"{filename}.ly")
+    enter_stage(ctx, "lilypond")
+
+    if not os.path.exists(ly_path):
+        # Resumed from a checkpoint on a host without the .ly file
+        with open(ly_path, "w") as f:
+            f.write(ctx["lilypond_code"])
 
-                    print("✅ Second fallback succeeded")
+    try:
+        metrics.LILYPOND_COMPILES.inc()
+        with timed(ctx["timings"], span_name(ctx, "lilypond"), "lilypond"):
+            run_tool("lilypond", [
+                "lilypond", "-dignore-errors", "-o", os.path.join(OUTPUT_DIR, filename), ly_path
+            ])
+    except subprocess.CalledProcessError:
+        discard_cached_response(ctx["results"][-1] if ctx["results"] else {})
+        if ctx["fallback_level"] >= 2:
+            raise
+        metrics.LILYPOND_FALLBACKS.labels(str(ctx["fallback_level"] + 1)).inc()
+        if ctx["fallback_level"] == 0:
+            print(f"❌ LilyPond compilation failed for {filename}.ly. Retrying with fallback prompts...")
+        else:
+            print("❌ First fallback failed. Trying second fallback...")
+        ctx["fallback_level"] += 1
+        return "llm"
 
-                # # Update token accounting from fallback(s)
-                # prompt_tokens += safe_result["prompt_tokens"]
-                # completion_tokens += safe_result["completion_tokens"]
-                # model_used = safe_result.get("model", model)
+    if ctx["fallback_level"] == 1:
+        print("✅ First fallback succeeded")
+    elif ctx["fallback_level"] == 2:
+        print("✅ Second fallback succeeded")
 
+    return "audio"
 
 
-            subprocess.run([
+def run_audio_stage(ctx):
+    """
+    Pipeline stage 3: renders MIDI → WAV → MP3, renames the outputs
+    and records the finished job.
+    """
+    job_id = ctx["job_id"]
+    filename = ctx["filename"]
+    lilypond_code = ctx["lilypond_code"]
+
+    ly_path = os.path.join(OUTPUT_DIR, f"{filename}.ly")
+    pdf_path = os.path.join(OUTPUT_DIR, f"{filename}.pdf")
+    midi_path = os.path.join(OUTPUT_DIR, f"{filename}.midi")
+    mp3_path = os.path.join(OUTPUT_DIR, f"{filename}.mp3")
+    wav_path = os.path.join(OUTPUT_DIR, f"{filename}.wav")
+
+    timings = ctx["timings"]
+    done_steps = ctx.setdefault("done_steps", [])
+
+    if "fluidsynth" not in done_steps:
+        enter_stage(ctx, "fluidsynth")
+        with timed(timings, "fluidsynth"):
+            run_tool("fluidsynth", [
                 "fluidsynth", "-ni", SOUNDFONT_PATH, midi_path,
                 "-F", wav_path, "-r", "44100"
-            ], check=True)
+            ])
+        done_steps.append("fluidsynth")
+        checkpoint_job(ctx, "audio")
 
+    if "ffmpeg" not in done_steps:
+        enter_stage(ctx, "ffmpeg")
+        with timed(timings, "ffmpeg"):
             # subprocess.run(["ffmpeg", "-y", "-i", wav_path, mp3_path], check=True)
-            subprocess.run(["ffmpeg", "-y", "-i", wav_path, "-filter:a", "volume=6dB", mp3_path], check=True)
-
-
-            if os.path.exists(wav_path):
-                os.remove(wav_path)
-                
-                
-            # ✅ Extract title and rename files accordingly
-            title = extract_title_from_lilypond(lilypond_code)
-            timestamp = int(time.time())
-            safe_title = "".join(c for c in title.replace(" ", "_") if c.isalnum() or c == "_")
-            final_base = f"{safe_title}_{timestamp}"
-
-            # Final paths
-            final_pdf_path = os.path.join(OUTPUT_DIR, f"{final_base}.pdf")
-            final_mp3_path = os.path.join(OUTPUT_DIR, f"{final_base}.mp3")
-            final_ly_path = os.path.join(OUTPUT_DIR, f"{final_base}.ly")
-
-            # Rename files
-            os.rename(pdf_path, final_pdf_path)
-            os.rename(mp3_path, final_mp3_path)
-            os.rename(ly_path, final_ly_path)
-
-
-            
-
-            # ✅ Check if fallback was used
-            conversation_history = result.get("conversation_history")
-            retry_used = False
-
-            if "safe_result" in locals():
-                retry_used = True
-                prompt_tokens += safe_result.get("prompt_tokens", 0)
-                completion_tokens += safe_result.get("completion_tokens", 0)
-                conversation_history += safe_result.get("conversation_history", [])
-
-            if "safe_result_2" in locals():
-                retry_used = True
-                prompt_tokens += safe_result_2.get("prompt_tokens", 0)
-                completion_tokens += safe_result_2.get("completion_tokens", 0)
-                conversation_history += safe_result_2.get("conversation_history", [])
-
-
-            # ✅ Compute final cost
-            final_cost, pricing_tier = compute_final_cost(prompt_tokens, completion_tokens, model_used)
-
-
-            # ✅ Save job result with cost
-            jobs[job_id].update({
-                "status": "completed",
-                "pdf_url": f"/download/{final_base}.pdf",
-                "mp3_url": f"/download/{final_base}.mp3",
-                "lilypond": lilypond_code,
-                "conversation_history": conversation_history,  # ✅ from earlier
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": prompt_tokens + completion_tokens,
-                "model": model_used,
-                "final_cost": final_cost,
-                "pricing_tier": pricing_tier,
-                "title": title,
-                "safe_retry_used": retry_used  # ✅ new field
-            })
+            run_tool("ffmpeg", ["ffmpeg", "-y", "-i", wav_path, "-filter:a", "volume=6dB", mp3_path])
+        done_steps.append("ffmpeg")
+
+    if os.path.exists(wav_path):
+        os.remove(wav_path)
+
+    # ✅ Extract title and rename files accordingly
+    title = extract_title_from_lilypond(lilypond_code)
+    if "final_base" not in ctx:
+        timestamp = int(time.time())
+        safe_title = "".join(c for c in title.replace(" ", "_") if c.isalnum() or c == "_")
+        ctx["final_base"] = f"{safe_title}_{timestamp}"
+        checkpoint_job(ctx, "audio")
+    final_base = ctx["final_base"]
+
+    # Final paths
+    final_pdf_path = os.path.join(OUTPUT_DIR, f"{final_base}.pdf")
+    final_mp3_path = os.path.join(OUTPUT_DIR, f"{final_base}.mp3")
+    final_ly_path = os.path.join(OUTPUT_DIR, f"{final_base}.ly")
+
+    # Rename files (some may already be renamed if this is a resumed job)
+    with timed(timings, "rename"):
+        for src, dst in ((pdf_path, final_pdf_path), (mp3_path, final_mp3_path), (ly_path, final_ly_path)):
+            if os.path.exists(src) or not os.path.exists(dst):
+                os.rename(src, dst)
+
+    # ✅ Token accounting, including any fallback generations
+    result = ctx["results"][0]
+    prompt_tokens = result.get("prompt_tokens", 0)
+    completion_tokens = result.get("completion_tokens", 0)
+    model_used = result.get("model", ctx["model"])
+    conversation_history = result.get("conversation_history")
+
+    retry_used = len(ctx["results"]) > 1
+    for safe_result in ctx["results"][1:]:
+        prompt_tokens += safe_result.get("prompt_tokens", 0)
+        completion_tokens += safe_result.get("completion_tokens", 0)
+        conversation_history += safe_result.get("conversation_history", [])
+
+    # ✅ Compute final cost
+    final_cost, pricing_tier = compute_final_cost(prompt_tokens, completion_tokens, model_used)
+
+    # ✅ Save job result with cost
+    job_store.update(job_id, {
+        "status": "completed",
+        "stage": "completed",
+        "finished_at": time.time(),
+        "pdf_url": f"/download/{final_base}.pdf",
+        "mp3_url": f"/download/{final_base}.mp3",
+        "lilypond": lilypond_code,
+        "conversation_history": conversation_history,  # ✅ from earlier
+        "prompt_tokens": prompt_tokens,
+        "prompt_tokens_estimate": sum(r.get("prompt_tokens_estimate", 0) for r in ctx["results"]),
+        "cached_prompt_tokens": sum(r.get("cached_prompt_tokens", 0) for r in ctx["results"]),
+        "prompt_template_version": result.get("prompt_template_version"),
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "model": model_used,
+        "final_cost": final_cost,
+        "pricing_tier": pricing_tier,
+        "title": title,
+        "safe_retry_used": retry_used,  # ✅ new field
+        "timings_ms": timings,
+        "checkpoint": None
+    })
+
+    # ✅ Charge the actual cost against the job's hold
+    settle_job_cost(ctx, final_cost)
+
+    return None
+
+
+def fail_job(ctx, error):
+    job_store.update(ctx["job_id"], {
+        "status": "failed",
+        "stage": "failed",
+        "finished_at": time.time(),
+        "error": str(error),
+        "timings_ms": ctx.get("timings", {}),
+        "checkpoint": None
+    })
+    release_job_hold(ctx)
+
+
+def finish_job(ctx):
+    disown_job(ctx["job_id"])
+    job = job_store.get(ctx["job_id"], include_large=False) or {}
+    metrics.JOBS_FINISHED.labels(job.get("status", "unknown")).inc()
+
+    # ✅ Jobs taken from a shared queue are only acked once they are done
+    if job_queue is not None and "queue_message_id" in ctx:
+        job_queue.ack(ctx["queue_message_id"])
+
+    # ✅ A finished job frees a slot for the next batch item
+    with batch_lock:
+        batch_items_here.discard(ctx["job_id"])
+        groups = list(waiting_batches)
+    if ctx.get("group_id"):
+        feed_batch(ctx["group_id"], finished=1)
+    for group_id in groups:
+        if group_id != ctx.get("group_id"):
+            feed_batch(group_id)
+
+
+# ✅ Optional broker between the web process (producer) and `python -m worker`
+# (consumers). Unset JOB_QUEUE runs jobs inside the web process as before.
+job_queue = make_job_queue(os.environ.get("JOB_QUEUE"), DATA_DIR)
+if job_queue is not None and not isinstance(job_store, SQLiteJobStore):
+    # Workers would never see jobs created by the web process and drop them
+    raise SystemExit("❌ JOB_QUEUE needs JOB_STORE=sqlite so workers share the web process's jobs")
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 1000))
+
+
+# ✅ Stage-aware worker pools: LLM calls are I/O-bound, LilyPond is CPU-bound
+# (about one per core), audio render/encode sits in between.
+CPU_COUNT = os.cpu_count() or 1
+
+if LLM_ASYNC:
+    # Workers here is how many jobs the stage is expected to keep in flight
+    llm_stage = ("llm", run_llm_stage_async, pool_size("LLM_ASYNC_CONCURRENCY", 64))
+else:
+    llm_stage = ("llm", run_llm_stage, pool_size("LLM_WORKERS", 16))
+
+scheduler = JobScheduler(
+    stages=[
+        llm_stage,
+        ("lilypond", run_lilypond_stage, pool_size("LILYPOND_WORKERS", CPU_COUNT)),
+        ("audio", run_audio_stage, pool_size("AUDIO_WORKERS", max(1, CPU_COUNT // 2))),
+    ],
+    max_pending=pool_size("MAX_PENDING_JOBS", 64),
+    on_error=fail_job,
+    on_finish=finish_job,
+    on_advance=checkpoint_job,
+    # Starting guesses until real stage timings come in
+    service_estimates={"llm": 45.0, "lilypond": 5.0, "audio": 5.0},
+    loop=get_async_gateway().loop if LLM_ASYNC else None
+)
+if job_queue is None:
+    scheduler.start()
+
+
+def refresh_metrics():
+    stats = job_store.stats()
+    for status, count in stats["by_status"].items():
+        metrics.JOBS_BY_STATUS.labels(str(status)).set(count)
+    metrics.JOBS_IN_MEMORY.set(stats["jobs_in_memory"])
+    metrics.JOBS_IN_MEMORY_BYTES.set(stats["bytes_in_memory"])
+
+    for stage, depth in scheduler.stage_depths().items():
+        metrics.QUEUE_DEPTH.labels(stage).set(depth)
+    metrics.QUEUE_DEPTH.labels("in_flight").set(scheduler.depth())
+    if job_queue is not None:
+        metrics.BROKER_DEPTH.set(job_queue.depth())
+
+
+metrics.start_refresher(refresh_metrics)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    refresh_metrics()
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+def sanitize_filename(requested_filename):
+    return "".join(c for c in requested_filename if c.isalnum() or c in ("_", "-")).rstrip()
+
+
+def new_job_ctx(job_id, user_prompt, model, balance, user_id, filename):
+    """Pipeline context carried by a job through every stage."""
+    return {
+        "job_id": job_id,
+        "user_prompt": user_prompt,
+        "model": model,
+        "balance": balance,
+        "user_id": user_id,
+        "filename": filename,
+        "fallback_level": 0,
+        "lilypond_code": None,
+        "results": [],
+        "timings": {},
+        "submitted_at": time.time()
+    }
+
 
-            # ✅ Deduct cost from user balance
-            if user_id:
-                update_balance(user_id, -final_cost)
+# ✅ Admission control: refuse work we cannot finish in reasonable time
+MAX_QUEUE_WAIT_SECONDS = float(os.environ.get("MAX_QUEUE_WAIT_SECONDS", 120))
+QUEUE_WORKER_PROCESSES = int(os.environ.get("QUEUE_WORKER_PROCESSES", 1))  # consumers of JOB_QUEUE
+MAX_RETRY_AFTER_SECONDS = 300
+WORKER_STATS_SECONDS = 5  # how long the workers' reported service times are reused
+worker_stats = {"at": None, "service_time": None, "workers": QUEUE_WORKER_PROCESSES}
+worker_stats_lock = threading.Lock()
 
-            save_jobs_to_file()
 
+def queue_worker_stats():
+    """
+    ({stage: seconds}, worker count) measured by the JOB_QUEUE workers
+    that are running: each stage's service time averaged over their
+    reports. Falls back to this process's seed estimates and
+    QUEUE_WORKER_PROCESSES until a worker has reported.
+    """
+    with worker_stats_lock:
+        if worker_stats["at"] is not None and time.monotonic() - worker_stats["at"] < WORKER_STATS_SECONDS:
+            return worker_stats["service_time"], worker_stats["workers"]
+
+        try:
+            reports = job_queue.service_times()
         except Exception as e:
-            jobs[job_id]["status"] = "failed"
-            jobs[job_id]["error"] = str(e)
-            save_jobs_to_file()
+            print(f"❌ Could not read worker service times: {e}")
+            reports = []
+
+        service_time, workers = None, QUEUE_WORKER_PROCESSES
+        if reports:
+            stages = {stage for report in reports for stage in report}
+            service_time = {
+                stage: sum(report[stage] for report in reports if stage in report) /
+                       sum(1 for report in reports if stage in report)
+                for stage in stages
+            }
+            workers = len(reports)
+        worker_stats.update(at=time.monotonic(), service_time=service_time, workers=workers)
+        return service_time, workers
 
 
+def check_admission():
+    """
+    Estimates where a new job would land from the current queue depth
+    and recent per-stage throughput. Returns a dict with `queue_position`,
+    `wait_seconds`, `run_seconds`, `saturated` and `retry_after`.
+
+    With a JOB_QUEUE this process runs no jobs, so throughput comes from
+    the service times the workers report (see queue_worker_stats).
+    """
+    if job_queue is not None:
+        ahead = job_queue.depth()
+        full = ahead >= MAX_QUEUED_JOBS
+        service_time, workers = queue_worker_stats()
+        wait_seconds, run_seconds = scheduler.estimate(ahead, capacity_scale=workers, service_time=service_time)
+    else:
+        ahead = scheduler.depth()
+        full = not scheduler.has_capacity()
+        wait_seconds, run_seconds = scheduler.estimate(ahead)
+
+    saturated = full or wait_seconds > MAX_QUEUE_WAIT_SECONDS
+    if wait_seconds > MAX_QUEUE_WAIT_SECONDS:
+        # Time until enough of the backlog drains to get back under the limit
+        retry_after = wait_seconds - MAX_QUEUE_WAIT_SECONDS
+    else:
+        # Roughly one job's worth of drain time
+        retry_after = wait_seconds / ahead if ahead else 5
 
+    return {
+        "queue_position": ahead + 1,
+        "wait_seconds": wait_seconds,
+        "run_seconds": run_seconds,
+        "saturated": saturated,
+        "retry_after": min(MAX_RETRY_AFTER_SECONDS, max(1, int(retry_after + 0.999)))
+    }
 
-    threading.Thread(target=job_runner).start()
 
-    return jsonify({"job_id": job_id})
+def busy_response(retry_after):
+    response = jsonify({
+        "error": "Server busy, please try again shortly",
+        "retry_after": retry_after
+    })
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
 
 
+@app.route("/start-smart-full-generate", methods=["POST"])
+def start_smart_full_generate():
+    data = request.get_json()
+    user_prompt = data.get("prompt")
+    model = data.get("model", "gpt-4.1")
+    # balance = data.get("balance", 0.0)
+    user_id = data.get("user_id")  # <-- NEW
+    balance = get_user_balance_value(user_id) if user_id else 0.0
+
+
+    requested_filename = data.get("filename") or str(uuid.uuid4())
+
+    if not user_prompt:
+        return jsonify({"error": "Missing prompt"}), 400
+    if not user_id:
+        return jsonify({"error": "Insufficient funds"}), 403
+
+    admission = check_admission()
+    if admission["saturated"]:
+        return busy_response(admission["retry_after"])
+
+    filename = sanitize_filename(requested_filename)
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    estimated_completion_at = now + admission["wait_seconds"] + admission["run_seconds"]
+
+    # ✅ Reserve funds up front so concurrent submissions cannot overspend
+    try:
+        balance_store.reserve(user_id, job_id, job_hold_amount(model))
+    except InsufficientFunds:
+        return jsonify({"error": "Insufficient funds"}), 403
+
+    ctx = new_job_ctx(job_id, user_prompt, model, balance, user_id, filename)
+    ctx["hold_id"] = job_id
+
+    job_store.create(job_id, {
+        "status": "pending",
+        "stage": "queued",
+        "user_id": user_id,
+        "created_at": now,
+        "filename": filename,
+        "result": None,
+        "error": None,
+        "queue_position": admission["queue_position"],
+        "estimated_completion_at": round(estimated_completion_at, 1),
+        "checkpoint": make_checkpoint(ctx, "llm"),
+        **lease_fields()
+    })
+
+    try:
+        if job_queue is not None:
+            if job_queue.depth() >= MAX_QUEUED_JOBS:
+                raise SchedulerFull(f"{MAX_QUEUED_JOBS} jobs already queued")
+            job_queue.put(ctx)
+        else:
+            own_job(job_id)
+            scheduler.submit(ctx)
+    except SchedulerFull:
+        disown_job(job_id)
+        job_store.delete(job_id)
+        release_job_hold(ctx)
+        return busy_response(admission["retry_after"])
+
+    return jsonify({
+        "job_id": job_id,
+        "queue_position": admission["queue_position"],
+        "estimated_completion_at": round(estimated_completion_at, 1),
+        "estimated_wait_seconds": round(admission["wait_seconds"], 1)
+    })
+
+
+
+# ✅ Batch generation: many prompts submitted as one job group
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 500))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", 4))
+BATCH_ITEM_FIELDS = ("status", "stage", "error", "title", "pdf_url", "mp3_url", "final_cost")
+# Share of the pipeline (or shared queue) that batch items may take up
+# across all groups, so batches cannot crowd out single jobs
+BATCH_PIPELINE_SHARE = float(os.environ.get("BATCH_PIPELINE_SHARE", 0.5))
+
+batch_items_here = set()  # batch items submitted to this process's scheduler
+waiting_batches = set()   # groups this process saw with items still waiting
+batch_lock = threading.Lock()
+
+
+def batch_room():
+    """How many more batch items the pipeline takes right now."""
+    if job_queue is not None:
+        return int(MAX_QUEUED_JOBS * BATCH_PIPELINE_SHARE) - job_queue.depth()
+    with batch_lock:
+        in_flight = len(batch_items_here)
+    return min(
+        int(scheduler.max_pending * BATCH_PIPELINE_SHARE) - in_flight,
+        scheduler.max_pending - scheduler.depth()
+    )
+
+
+def submit_ctx(ctx):
+    if job_queue is not None:
+        job_queue.put(ctx)
+    else:
+        # Batch items are already throttled by batch_room()
+        with batch_lock:
+            batch_items_here.add(ctx["job_id"])
+        own_job(ctx["job_id"])
+        scheduler.submit(ctx, force=True)
+
+
+def batch_counters(group):
+    """(admitted, running, finished) for a group, counted from its items for groups that predate the counters."""
+    if "admitted" in group:
+        return group["admitted"], group["running"], group["finished"]
+    admitted = running = finished = 0
+    for item_id in group["items"]:
+        item = job_store.get(item_id, include_large=False) or {}
+        if item.get("stage") == "waiting":
+            break
+        admitted += 1
+        if item.get("status") in FINISHED_STATUSES:
+            finished += 1
+        else:
+            running += 1
+    return admitted, running, finished
+
+
+def feed_batch(group_id, finished=0):
+    """
+    Counts `finished` more items of the batch as done, admits waiting
+    items (in order) while fewer than `max_concurrency` run and
+    batch_room() allows, and completes the group once every item is done.
+
+    The counters live on the group record and change with update_if on
+    its version, so any process may call this; only the items it admits
+    are read.
+    """
+    while True:
+        group = job_store.get(group_id, include_large=False)
+        if not group or group.get("kind") != "batch" or group.get("status") in FINISHED_STATUSES:
+            return
+
+        total = len(group["items"])
+        admitted, running, done = batch_counters(group)
+        running -= finished
+        done += finished
+        take = max(0, min(total - admitted, group["max_concurrency"] - running, batch_room()))
+
+        fields = {"admitted": admitted + take, "running": running + take, "finished": done}
+        if done >= total:
+            fields.update(status="completed", stage="completed", finished_at=time.time())
+        elif take == 0 and not finished and "admitted" in group:
+            break  # Nothing to change
+        if job_store.update_if(group_id, {"version": group.get("version", 0)}, fields):
+            break
+        # Another process changed the group in between; start over
+
+    with batch_lock:
+        if admitted + take < total:
+            waiting_batches.add(group_id)
+        else:
+            waiting_batches.discard(group_id)
+
+    for item_id in group["items"][admitted:admitted + take]:
+        admit_batch_item(item_id)
+
+
+def admit_batch_item(item_id):
+    if not job_store.update_if(item_id, {"stage": "waiting"}, dict(lease_fields(), stage="queued")):
+        return  # Already admitted (e.g. by a resume pass)
+    item = job_store.get(item_id)
+    submit_ctx(dict(item["checkpoint"]["ctx"]))
+
+
+@app.route("/start-batch-generate", methods=["POST"])
+def start_batch_generate():
+    """
+    Submits a list of prompts as one group. Each entry is a prompt string
+    or {"prompt": ..., "filename": ...}. Funds for the whole batch are
+    reserved as one hold; each item charges or releases its share.
+    """
+    data = request.get_json()
+    prompts = data.get("prompts")
+    model = data.get("model", "gpt-4.1")
+    user_id = data.get("user_id")
+
+    if not isinstance(prompts, list) or not prompts:
+        return jsonify({"error": "Missing prompts"}), 400
+    if len(prompts) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} prompts per batch"}), 400
+
+    items = []
+    for entry in prompts:
+        if isinstance(entry, str):
+            entry = {"prompt": entry}
+        if not isinstance(entry, dict) or not entry.get("prompt"):
+            return jsonify({"error": "Every batch item needs a prompt"}), 400
+        items.append(entry)
+
+    try:
+        max_concurrency = int(data.get("max_concurrency", BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid max_concurrency"}), 400
+    max_concurrency = max(1, min(max_concurrency, BATCH_MAX_CONCURRENCY))
+
+    if not user_id:
+        return jsonify({"error": "Insufficient funds"}), 403
+
+    admission = check_admission()
+    if admission["saturated"]:
+        return busy_response(admission["retry_after"])
+
+    group_id = str(uuid.uuid4())
+    hold_amount = job_hold_amount(model)
+    try:
+        balance_store.reserve(user_id, group_id, hold_amount * len(items))
+    except InsufficientFunds:
+        return jsonify({"error": "Insufficient funds"}), 403
+    balance = get_user_balance_value(user_id)
+    now = time.time()
+    item_ids = []
+
+    for index, entry in enumerate(items):
+        job_id = str(uuid.uuid4())
+        filename = sanitize_filename(entry.get("filename") or job_id)
+        ctx = new_job_ctx(job_id, entry["prompt"], model, balance, user_id, filename)
+        ctx["group_id"] = group_id
+        ctx["hold_id"] = group_id
+        ctx["hold_share"] = hold_amount
+
+        job_store.create(job_id, {
+            "status": "pending",
+            "stage": "waiting",
+            "user_id": user_id,
+            "created_at": now,
+            "filename": filename,
+            "result": None,
+            "error": None,
+            "group_id": group_id,
+            "batch_index": index,
+            "checkpoint": make_checkpoint(ctx, "llm")
+        })
+        item_ids.append(job_id)
+
+    job_store.create(group_id, {
+        "kind": "batch",
+        "status": "pending",
+        "stage": "running",
+        "user_id": user_id,
+        "created_at": now,
+        "model": model,
+        "items": item_ids,
+        "max_concurrency": max_concurrency,
+        "admitted": 0,
+        "running": 0,
+        "finished": 0
+    })
+
+    feed_batch(group_id)
+    return jsonify({"group_id": group_id, "job_ids": item_ids})
+
+
+@app.route("/batch-status/<group_id>")
+def batch_status(group_id):
+    group = job_store.get(group_id, include_large=False)
+    if not group or group.get("kind") != "batch":
+        return jsonify({"error": "Batch not found"}), 404
+
+    counts = {}
+    total_cost = 0.0
+    results = []
+    for index, item_id in enumerate(group["items"]):
+        item = job_store.get(item_id, include_large=False) or {"status": "missing"}
+        result = {field: item.get(field) for field in BATCH_ITEM_FIELDS if field in item}
+        result.update({"job_id": item_id, "index": index})
+        results.append(result)
+
+        state = "waiting" if item.get("stage") == "waiting" else item.get("status")
+        counts[state] = counts.get(state, 0) + 1
+        total_cost += item.get("final_cost") or 0.0
+
+    return jsonify({
+        "group_id": group_id,
+        "status": group["status"],
+        "total": len(group["items"]),
+        "counts": counts,
+        "total_cost": round(total_cost, 6),
+        "items": results
+    })
+
 
 def compute_final_cost(prompt_tokens, completion_tokens, model):
     if model.startswith("gpt-4.1-nano"):  # ✅ safer than equality
@@ -653,12 +1600,18 @@ def compute_final_cost(prompt_tokens, completion_tokens, model):
 
 @app.route("/clear-jobs", methods=["POST"])
 def clear_jobs():
-    global jobs
-    jobs = {}
-    save_jobs_to_file()
+    job_store.clear()
     return jsonify({"message": "All jobs cleared"}), 200
     
     
+if job_queue is None:
+    # With a shared queue, workers resume jobs as the broker redelivers them.
+    # The journal store belongs to this process alone, so every lease in it
+    # was left by a previous run.
+    resume_interrupted_jobs(ignore_leases=not isinstance(job_store, SQLiteJobStore))
+    start_lease_keeper()
+
+
 if __name__ == "__main__":
     # app.run(host="0.0.0.0", port=5050, debug=True) # for local Mac backend hosting
     port = int(os.environ.get("PORT", 10000)) # for Render
@@ -0,0 +1,194 @@
+# backend/metrics.py
+#
+# Prometheus metrics for the composer backend. When PROMETHEUS_MULTIPROC_DIR
+# is set (see Dockerfile / gunicorn.conf.py), every gunicorn worker writes
+# its samples there and /metrics aggregates them.
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+
+# Spans run from a few ms (renames) to minutes (LLM calls, fallbacks)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180, 300)
+
+STAGE_LATENCY = Histogram(
+    "composer_stage_duration_seconds",
+    "Time spent in each job pipeline stage / span",
+    ["stage"],
+    buckets=LATENCY_BUCKETS
+)
+
+LLM_TOKENS = Counter(
+    "composer_llm_tokens",
+    "Tokens reported by the OpenAI usage object",
+    ["model", "kind"]
+)
+
+LLM_RETRIES = Counter(
+    "composer_llm_retries",
+    "OpenAI calls retried after a retryable error",
+    ["model", "error"]
+)
+
+LLM_CIRCUIT_OPENED = Counter(
+    "composer_llm_circuit_opened",
+    "Times a model's circuit breaker opened",
+    ["model"]
+)
+
+LLM_RATE_LIMIT_WAIT = Histogram(
+    "composer_llm_rate_limit_wait_seconds",
+    "Time async LLM calls waited for their model's token budget",
+    ["model"],
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+)
+
+LLM_CACHE_REQUESTS = Counter(
+    "composer_llm_cache_requests",
+    "LLM response cache lookups",
+    ["result"]
+)
+
+SUBPROCESS_FAILURES = Counter(
+    "composer_subprocess_failures",
+    "Failed lilypond / fluidsynth / ffmpeg runs",
+    ["tool"]
+)
+
+LILYPOND_COMPILES = Counter(
+    "composer_lilypond_compiles",
+    "LilyPond compile attempts, including fallback attempts"
+)
+
+LILYPOND_FALLBACKS = Counter(
+    "composer_lilypond_fallbacks",
+    "Fallback regenerations after a failed LilyPond compile",
+    ["level"]
+)
+
+JOBS_FINISHED = Counter(
+    "composer_jobs_finished",
+    "Jobs that left the pipeline",
+    ["status"]
+)
+
+PROMPT_TOKEN_ESTIMATE_RATIO = Histogram(
+    "composer_prompt_token_estimate_ratio",
+    "Prompt tokens reported by the API divided by the local estimate",
+    ["model"],
+    buckets=(0.5, 0.75, 0.9, 0.95, 1.0, 1.05, 1.1, 1.25, 1.5, 2)
+)
+
+BALANCE_LOCK_WAIT = Histogram(
+    "composer_balance_lock_wait_seconds",
+    "Time spent waiting to acquire the balance lock",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+)
+
+# Per-process values that add up across workers
+QUEUE_DEPTH = Gauge(
+    "composer_queue_depth",
+    "Jobs admitted to this process's pipeline, by stage queue",
+    ["stage"],
+    multiprocess_mode="livesum"
+)
+
+LLM_IN_FLIGHT = Gauge(
+    "composer_llm_in_flight",
+    "Async LLM calls holding a concurrency slot",
+    ["model"],
+    multiprocess_mode="livesum"
+)
+
+JOBS_IN_MEMORY = Gauge(
+    "composer_job_store_jobs",
+    "Job records held in process memory",
+    multiprocess_mode="livesum"
+)
+
+JOBS_IN_MEMORY_BYTES = Gauge(
+    "composer_job_store_bytes",
+    "Approximate JSON size of job records held in process memory",
+    multiprocess_mode="livesum"
+)
+
+# Shared state that every worker sees the same way
+JOBS_BY_STATUS = Gauge(
+    "composer_jobs",
+    "Jobs in the job store, by status",
+    ["status"],
+    multiprocess_mode="livemax"
+)
+
+BROKER_DEPTH = Gauge(
+    "composer_broker_queue_depth",
+    "Messages waiting in the shared job queue",
+    multiprocess_mode="livemax"
+)
+
+
+@contextmanager
+def timed(timings, name, stage=None):
+    """
+    Times the block and adds the elapsed milliseconds to `timings[name]`
+    (repeated spans accumulate). The histogram is labelled with `stage`,
+    which defaults to `name`; failed spans are recorded too.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings[name] = round(timings.get(name, 0) + elapsed * 1000, 1)
+        STAGE_LATENCY.labels(stage or name).observe(elapsed)
+
+
+@contextmanager
+def timed_lock(lock, histogram):
+    """Acquires `lock`, recording how long the acquire blocked."""
+    start = time.perf_counter()
+    with lock:
+        histogram.observe(time.perf_counter() - start)
+        yield
+
+
+def record_usage(model, usage, cached_prompt_tokens=0):
+    LLM_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens)
+    LLM_TOKENS.labels(model, "cached_prompt").inc(cached_prompt_tokens)
+    LLM_TOKENS.labels(model, "completion").inc(usage.completion_tokens)
+
+
+def start_refresher(refresh, interval=15):
+    """Runs `refresh()` every `interval` seconds to keep gauges current."""
+    def loop():
+        while True:
+            try:
+                refresh()
+            except Exception as e:
+                print(f"❌ Failed to refresh metrics: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name="metrics-refresher", daemon=True).start()
+
+
+def render():
+    """Returns (body, content type) for the /metrics endpoint."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
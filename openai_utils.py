@@ -1,41 +1,290 @@
 # backend/openai_utils.py
 
-import openai
 import logging
 import json
+import asyncio
+from types import SimpleNamespace
 from datetime import datetime
 
+from llm_cache import get_cache
+from llm_gateway import get_gateway
+from llm_async import get_async_gateway
+from lilypond_stream import LilypondStream
+from metrics import record_usage
+from prompt_budget import count_message_tokens
+
 # ✅ Set up logging to console — works with Render logs
 logging.basicConfig(level=logging.INFO)
 
+# Deltas read after the closing fence while waiting for the finish and
+# usage chunks; a model still talking past that is cut off
+TRAILING_DELTAS = 8
+
 def log_openai_request(model, messages, temperature=0.7):
-    client = openai.OpenAI()
-    
     try:
-        response = client.chat.completions.create(
+        # ✅ Shared pooled client with timeouts, retries and a circuit breaker
+        response = get_gateway().chat_completion(
             model=model,
             messages=messages,
             temperature=temperature
         )
 
-        log_data = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "model": model,
-            "temperature": temperature,
-            "messages": messages,
-            "response": response.choices[0].message.content,
-            "usage": {
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "total_tokens": response.usage.total_tokens
-            }
-        }
+        log_interaction(model, temperature, messages, response)
+        return response
+
+    except Exception as e:
+        logging.error("❌ OpenAI API Error: %s", str(e))
+        raise
+
+
+class StreamCollector:
+    """
+    Feeds streamed chunks to a LilypondStream and builds a chat completion
+    shaped object from them. After the block is closed the stream is
+    still read to the end, which normally brings the finish reason and
+    the usage chunk within a delta or two. When the stream is cut short
+    the API never sends usage, so it is estimated (prompt from the local
+    token count, completion from deltas received).
+    """
+
+    def __init__(self, model, on_progress=None):
+        self.tracker = LilypondStream()
+        self.on_progress = on_progress
+        self.usage = None
+        self.model = model
+        self.finish_reason = None
+        self.trailing = 0  # content deltas after the closing fence
+
+    def add(self, chunk):
+        """
+        Takes one chunk. Returns True once reading on is not worth it: the
+        ```lilypond block is closed and more than TRAILING_DELTAS deltas
+        of chatter have followed it.
+        """
+        self.model = chunk.model or self.model
+        if chunk.usage:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return False
+        self.finish_reason = chunk.choices[0].finish_reason or self.finish_reason
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            return False
+        if self.tracker.done:
+            self.trailing += 1
+            return self.trailing > TRAILING_DELTAS
+        if self.tracker.feed(delta):
+            return False
+        if self.on_progress:
+            self.on_progress(self.tracker)
+        return False
+
+    def response(self, model, messages):
+        # A closed block is a finished answer even if the stream was cut off after it
+        finish_reason = self.finish_reason or ("stop" if self.tracker.done else None)
+        usage = self.usage
+        if usage is None:
+            prompt_tokens = count_message_tokens(messages, model)
+            usage = SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=self.tracker.tokens + self.trailing,
+                total_tokens=prompt_tokens + self.tracker.tokens + self.trailing,
+                estimated=True
+            )
+
+        return SimpleNamespace(
+            model=self.model,
+            usage=usage,
+            choices=[SimpleNamespace(
+                finish_reason=finish_reason,
+                message=SimpleNamespace(role="assistant", content=self.tracker.text)
+            )]
+        )
+
 
-        # Show log in Render's Logs tab
-        logging.info("🔍 OpenAI API Interaction:\n%s", json.dumps(log_data, indent=2))
+def stream_openai_request(model, messages, temperature=0.7, on_progress=None):
+    """
+    Streams the completion and reads it to the end, so the API's usage
+    comes through; only a model that keeps talking well past the closed
+    ```lilypond block is cut off (see StreamCollector). `on_progress(stream)`
+    is called with the LilypondStream after every delta.
 
+    Returns an object shaped like a chat completion (see StreamCollector).
+    """
+    try:
+        stream = get_gateway().chat_completion(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+        collector = StreamCollector(model, on_progress)
+        try:
+            for chunk in stream:
+                if collector.add(chunk):
+                    break
+        finally:
+            stream.close()
+
+        response = collector.response(model, messages)
+        log_interaction(model, temperature, messages, response)
+        return response
+
+    except Exception as e:
+        logging.error("❌ OpenAI API Error: %s", str(e))
+        raise
+
+
+async def async_log_openai_request(model, messages, temperature=0.7):
+    """log_openai_request on the async gateway's event loop."""
+    gateway = get_async_gateway()
+    try:
+        async with gateway.slot(model, messages):
+            response = await gateway.chat_completion(
+                model=model,
+                messages=messages,
+                temperature=temperature
+            )
+        gateway.charge(model, response.usage.completion_tokens)
+
+        log_interaction(model, temperature, messages, response)
         return response
 
     except Exception as e:
         logging.error("❌ OpenAI API Error: %s", str(e))
         raise
+
+
+async def async_stream_openai_request(model, messages, temperature=0.7, on_progress=None):
+    """stream_openai_request on the async gateway's event loop."""
+    gateway = get_async_gateway()
+    try:
+        async with gateway.slot(model, messages):
+            stream = await gateway.chat_completion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+
+            collector = StreamCollector(model, on_progress)
+            try:
+                async for chunk in stream:
+                    if collector.add(chunk):
+                        break
+            finally:
+                await stream.close()
+
+        response = collector.response(model, messages)
+        gateway.charge(model, response.usage.completion_tokens)
+
+        log_interaction(model, temperature, messages, response)
+        return response
+
+    except Exception as e:
+        logging.error("❌ OpenAI API Error: %s", str(e))
+        raise
+
+
+def lookup_cached_response(model, messages, temperature):
+    """
+    Returns (key, hit). `hit` is (response, cache_ref) when a cached
+    variant should be served; `key` is None when the cache is disabled.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None, None
+    key = cache.key(model, messages, temperature=temperature)
+    variant = cache.get(key)
+    if variant is None:
+        return key, None
+
+    logging.info("🗃️ Serving cached OpenAI response %s/%s", key[:12], variant["id"])
+    return key, (SimpleNamespace(
+        model=variant["model"],
+        usage=SimpleNamespace(**variant["usage"]),
+        choices=[SimpleNamespace(
+            finish_reason="stop",
+            message=SimpleNamespace(role="assistant", content=variant["content"])
+        )]
+    ), {"key": key, "variant": variant["id"], "hit": True})
+
+
+def store_cached_response(key, response):
+    """Adds a finished response under `key`. Returns its cache_ref, or None."""
+    content = response.choices[0].message.content
+    if key is None or response.choices[0].finish_reason != "stop" or not content:
+        return None
+
+    usage = {
+        "prompt_tokens": response.usage.prompt_tokens,
+        "completion_tokens": response.usage.completion_tokens,
+        "total_tokens": response.usage.total_tokens
+    }
+    try:
+        return {"key": key, "variant": get_cache().put(key, content, response.model, usage), "hit": False}
+    except Exception as e:
+        logging.error("❌ Failed to cache OpenAI response: %s", str(e))
+        return None
+
+
+def cached_openai_request(model, messages, temperature=0.7, stream=False, on_progress=None):
+    """
+    log_openai_request (or stream_openai_request with `stream`) behind the
+    response cache, when LLM_CACHE is enabled.
+
+    Returns (response, cache_ref). cache_ref is {"key", "variant", "hit"}
+    for responses that are in the cache, so a variant that turns out to
+    be unusable can be discarded.
+    """
+    key, hit = lookup_cached_response(model, messages, temperature)
+    if hit is not None:
+        return hit
+
+    if stream:
+        response = stream_openai_request(model, messages, temperature=temperature, on_progress=on_progress)
+    else:
+        response = log_openai_request(model, messages, temperature=temperature)
+    return response, store_cached_response(key, response)
+
+
+async def async_cached_openai_request(model, messages, temperature=0.7, stream=False, on_progress=None):
+    """cached_openai_request on the event loop; cache disk I/O runs in a thread."""
+    key, hit = await asyncio.to_thread(lookup_cached_response, model, messages, temperature)
+    if hit is not None:
+        return hit
+
+    if stream:
+        response = await async_stream_openai_request(model, messages, temperature=temperature, on_progress=on_progress)
+    else:
+        response = await async_log_openai_request(model, messages, temperature=temperature)
+    return response, await asyncio.to_thread(store_cached_response, key, response)
+
+
+def cached_prompt_tokens(usage):
+    """Prompt tokens the provider served from its prompt cache (0 when not reported)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def log_interaction(model, temperature, messages, response):
+    log_data = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "model": model,
+        "temperature": temperature,
+        "messages": messages,
+        "response": response.choices[0].message.content,
+        "usage": {
+            "prompt_tokens": response.usage.prompt_tokens,
+            "cached_prompt_tokens": cached_prompt_tokens(response.usage),
+            "completion_tokens": response.usage.completion_tokens,
+            "total_tokens": response.usage.total_tokens
+        }
+    }
+
+    # Show log in Render's Logs tab
+    logging.info("🔍 OpenAI API Interaction:\n%s", json.dumps(log_data, indent=2))
+    record_usage(response.model, response.usage, cached_prompt_tokens(response.usage))
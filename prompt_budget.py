@@ -0,0 +1,92 @@
+# backend/prompt_budget.py
+
+import os
+import re
+import json
+import threading
+
+try:
+    import tiktoken  # optional: exact counts for OpenAI models
+except ImportError:
+    tiktoken = None
+
+
+DEFAULT_PROMPT_TOKEN_BUDGET = 8000
+
+# Framing the chat format adds around each message, and once per request
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REQUEST = 3
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+class PromptTooLong(ValueError):
+    """Raised when no version of a prompt fits the model's token budget."""
+
+
+def _encoding(model):
+    """The tiktoken encoding for `model`, or None to fall back to the heuristic."""
+    if tiktoken is None:
+        return None
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                # e.g. the encoding file cannot be downloaded
+                print(f"❌ Falling back to estimated token counts: {e}")
+                _encodings[model] = None
+        return _encodings[model]
+
+
+def count_tokens(text, model=None):
+    encoding = _encoding(model or "gpt-4.1")
+    if encoding is None:
+        # About four characters per token for English and LilyPond
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages, model=None):
+    return TOKENS_PER_REQUEST + sum(
+        TOKENS_PER_MESSAGE + count_tokens(message["content"], model) for message in messages
+    )
+
+
+def token_budget(model):
+    """
+    Prompt token budget for `model`: PROMPT_TOKEN_BUDGETS (JSON, per
+    model or "*") overrides PROMPT_TOKEN_BUDGET.
+    """
+    budgets = json.loads(os.environ.get("PROMPT_TOKEN_BUDGETS") or "{}")
+    default = int(os.environ.get("PROMPT_TOKEN_BUDGET", DEFAULT_PROMPT_TOKEN_BUDGET))
+    return int(budgets.get(model, budgets.get("*", default)))
+
+
+STRING_OR_COMMENT_RE = re.compile(r'"(?:\\.|[^"\\])*"|%\{.*?%\}|%[^\n]*', re.DOTALL)
+
+
+def minify_lilypond(code):
+    """
+    Drops what LilyPond ignores: comments, trailing whitespace, blank
+    lines and runs of spaces inside a line. Strings and each line's
+    indentation are left alone, since the example doubles as a
+    formatting template.
+    """
+    # Comments are removed first; `%` inside strings is kept
+    code = STRING_OR_COMMENT_RE.sub(lambda m: m.group(0) if m.group(0).startswith('"') else "", code)
+
+    lines = []
+    for line in code.splitlines():
+        stripped = line.rstrip()
+        if not stripped.strip():
+            continue
+        indent = stripped[:len(stripped) - len(stripped.lstrip())]
+        # Collapse spaces between tokens, again leaving strings intact
+        parts = re.split(r'("(?:\\.|[^"\\])*")', stripped.lstrip())
+        body = "".join(part if part.startswith('"') else re.sub(r"[ \t]+", " ", part) for part in parts)
+        lines.append(indent + body)
+    return "\n".join(lines)
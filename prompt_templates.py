@@ -0,0 +1,126 @@
+# backend/prompt_templates.py
+#
+# Prompt templates for generation and refinement. Providers cache the
+# longest prompt prefix they have seen recently, so every template puts
+# its static text first, byte-identical across requests, then the example
+# score (shared by requests that pick the same one) and the per-job
+# content last. Bump PROMPT_TEMPLATE_VERSION whenever any of the text
+# below changes; it is saved with every job.
+
+PROMPT_TEMPLATE_VERSION = 2
+
+
+GENERATION_INSTRUCTIONS = (
+    "You are an expert composer.\n\n"
+    "Write similar as if an etude by composers such as: Bach, Czerny, Chopin, Liszt, Debussy, Scriabin, Rachmaninoff, Shostakovich, Bartók, Paganini, Ernst, Kreutzer, Rode, Mazas, Accolay.\n"
+    "When the user requests a musical composition, you must first carefully plan (don't be so generic, not always C major and 6/8 time):\n\n"
+    "- Style\n"
+    "- Form\n"
+    "- Key (or 'atonal')\n"
+    "- Modulation (if any)\n"
+    "- Time Signature\n"
+    "- Mood\n"
+    "- Upbeat (or not)\n"
+    "- Texture\n\n"
+    "- Measures must add up exactly according to the time signature.\n"
+    "- All voices must have the same number of measures and remain aligned bar-by-bar.\n"
+    "✅ Then generate the LilyPond (.ly) code inside a ```lilypond``` block.\n\n"
+    "LilyPond Code Rules:\n"
+    "only include a composer if specified (otherwise DO NOT include a composer)\n"
+    "- Use exact pitches (no \\relative).\n"
+    "- Include \\version, \\header, \\layout, and \\midi blocks.\n"
+    "- Include \\score { ... } surrounding the music.\n"
+    "- Use valid LilyPond pitch names (e.g., bes not Bb).\n\n"
+    "- Include a tempo indication (such as a descriptive word or a numerical marking) using \\\\tempo near the beginning of the score. Choose a value that matches the character and pacing of the piece.\n"
+    "- Use dynamics (e.g., \\\\p, \\\\f, \\\\mf) and expressive markings (e.g., phrasing hairpins, text expressions with \\\\markup) that support the musical shape and intention.\n"
+    "- Add phrasing slurs and articulations (e.g., staccato, accents) to clarify musical expression and performance details.\n"
+    "- All staves (voices) must have the same number of measures.\n"
+    "If lyrics are needed, define a variable like \\verseLyrics (do not use \\lyrics), then connect it using \\new Lyrics \\lyricsto \"voiceName\" \\verseLyrics. Always define the melody as a separate variable (e.g., melody = { ... }) before using it inside \\new Voice = \"voiceName\" { \\melody }, so lyrics can attach correctly.\n\n"
+    "NEVER output explanations, comments, or markdown outside code blocks.\n"
+    "Only output pure LilyPond inside code blocks.\n\n"
+    "Make the music interesting: think: movement, contrast, rests, quavers, ties, suspensions, syncopation, unity. "
+    "Ensure rhythmic interest. Avoid voice doubling. Use exact pitch and valid LilyPond syntax. "
+    "Add syncopation, triplets, arpeggios, scalic runs, suspensions, and phrasing rests. "
+    "Introduce pedal tones where appropriate. Ensure all voices contribute to the texture and maintain proper text-book voice-leading (no parallel 5ths and octaves). "
+    "Ensure:\n"
+    "- rhythmic contrast and interest throughout\n"
+    "- expressive melodic phrasing\n"
+    "- inner voices with variation (triplets, pedal tones, arpeggiation)\n"
+    "- motivic unity\n"
+    "- use of phrasing rests\n"
+    "When an example score is given, always follow its formatting style. "
+    "Each LilyPond command (e.g., \\\\version, \\\\header, variable = { ... }, \\\\score { ... }) must start on its own line. "
+    "Never place multiple commands on the same line. "
+    "Match the indentation and spacing style exactly. "
+    "Use the example score as a strict formatting template. Do not deviate from its structure or layout style. However, choose your instrumentation wisely based on the user prompt. "
+    "Do not include any comments (e.g., lines starting with %). Absolutely no `%` symbols should appear in the output LilyPond code. All output must be pure code only, with no comments."
+)
+
+EXAMPLE_INTRO = "Example score. Base the harmonic structure on it (use it as a close guide!!):\n\n"
+
+
+REFINE_INSTRUCTIONS = (
+    "You are an expert LilyPond composer and editor. When refining a composition, follow the user's original plan exactly. "
+    "Use German note names (e.g., fis, bes), exact pitch (no \\relative), and avoid parallel 5ths/8ves. "
+    "Ensure rhythmic and melodic variety, structural balance, and musical interest in all voices. "
+    "Wrap the music in a valid \\score block with \\layout and \\midi. "
+    "Output valid LilyPond code only — no explanations or extra comments."
+)
+
+# What each refinement iteration asks for
+REFINE_STEPS = {
+    2: (
+        "Following the original plan, add a melody over the harmony using chord tones as a base. "
+        "Do not change the style, form, or key unless the plan specifies it. "
+        "Make the melody interesting and distinct compared to other voices. Think: movement, contrast, rests, quavers, ties, suspensions, syncopation, unity. "
+        "Ensure rhythmic interest. Avoid voice doubling. Use exact pitch and valid LilyPond syntax."
+    ),
+    3: (
+        "Following the plan, enhance the inner and lower voices for greater musical and rhythmic interest. "
+        "Add syncopation, triplets, arpeggios, scalic runs, suspensions, and phrasing rests. "
+        "Introduce pedal tones where appropriate. Ensure all voices contribute to the texture and maintain proper voice-leading."
+    ),
+    4: (
+        "Continue following the original plan. Refine the composition for musical expressiveness, rhythmic vitality, and structural clarity. "
+        "Ensure:\n"
+        "- rhythmic contrast and interest throughout\n"
+        "- expressive melodic phrasing\n"
+        "- inner voices with variation (triplets, pedal tones, arpeggiation)\n"
+        "- motivic unity\n"
+        "- use of phrasing rests\n"
+        "Ensure the LilyPond code compiles, uses exact pitch, and follows formatting rules."
+    ),
+    5: (
+        "Finalize the composition. Confirm it matches the original plan. Make the music coherent, expressive, and formally satisfying. "
+        "Double-check that the LilyPond code includes \\version, \\header, \\layout, \\midi, and \\score { ... } and compiles correctly. "
+        "Fix the score: ensure all measures add up to the correct duration, synchronize all parts bar-by-bar, and align voices so they finish together."
+    ),
+}
+
+
+def generation_messages(user_prompt, example_lilypond=None):
+    """
+    Messages for the first generation call: the static instructions, the
+    example score `example_lilypond` (left out when None), then the
+    user's prompt.
+    """
+    messages = [{"role": "system", "content": GENERATION_INSTRUCTIONS}]
+    if example_lilypond is not None:
+        messages.append({
+            "role": "system",
+            "content": EXAMPLE_INTRO + "```lilypond\n" + example_lilypond + "\n```"
+        })
+    messages.append({"role": "user", "content": user_prompt})
+    return messages
+
+
+def refinement_messages(iteration, user_prompt, lilypond_code):
+    """
+    Messages for refinement `iteration` (2-5). The instructions for that
+    step come first, so every job refining at the same step shares them.
+    """
+    return [
+        {"role": "system", "content": REFINE_INSTRUCTIONS + "\n\n" + REFINE_STEPS[iteration]},
+        {"role": "user", "content": f"The user's original musical prompt:\n\n{user_prompt}"},
+        {"role": "user", "content": f"Here is the current LilyPond score:\n\n{lilypond_code}"}
+    ]
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app_main(tmp_path_factory):
+    """
+    main imported once per session, with its jobs, balances and output in
+    a temporary DATA_DIR and no shared queue, store or cache configured.
+    """
+    data_dir = tmp_path_factory.mktemp("data")
+    (data_dir / "FluidR3_GM.sf2").touch()  # keeps main from downloading the soundfont
+
+    with pytest.MonkeyPatch.context() as mp:
+        for name in ("JOB_QUEUE", "JOB_STORE", "BALANCE_STORE", "LLM_CACHE", "LLM_ASYNC"):
+            mp.delenv(name, raising=False)
+        mp.setenv("DATA_DIR", str(data_dir))
+        mp.setenv("OPENAI_API_KEY", "test")
+        mp.chdir(data_dir)
+        import main
+        yield main
@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from balance_ledger import BalanceLedger, BalanceLogIndex, InsufficientFunds
+from log_writer import AppendLogWriter, LogWriteError, log_segments
+
+
+def open_ledger(tmp_path, index=None, max_bytes=None):
+    ledger = BalanceLedger(
+        str(tmp_path / "balance_snapshot.json"),
+        AppendLogWriter(str(tmp_path / "balance_log.jsonl"), max_bytes=max_bytes),
+        legacy_balances_path=str(tmp_path / "balances.json"),
+        index=index
+    )
+    ledger.load()
+    return ledger
+
+
+def test_restart_after_legacy_import_keeps_changes(tmp_path):
+    (tmp_path / "balances.json").write_text(json.dumps({"u1": 1.0, "u2": 2.0}))
+
+    ledger = open_ledger(tmp_path)
+    assert (tmp_path / "balance_snapshot.json").exists()
+    ledger.update("u1", 5.0, "top-up")
+    ledger.update("u2", -0.5, "job deduction")
+    ledger.close()
+
+    ledger = open_ledger(tmp_path)
+    assert ledger.get("u1") == 6.0
+    assert ledger.get("u2") == 1.5
+    ledger.close()
+
+
+def test_restart_keeps_holds(tmp_path):
+    ledger = open_ledger(tmp_path)
+    ledger.update("u1", 2.0, "top-up")
+    ledger.reserve("u1", "job-1", 1.5)
+    ledger.close()
+
+    ledger = open_ledger(tmp_path)
+    assert ledger.available("u1") == pytest.approx(0.5)
+    ledger.close()
+
+
+def test_second_process_cannot_open_the_ledger(tmp_path):
+    ledger = open_ledger(tmp_path)
+    with pytest.raises(RuntimeError):
+        open_ledger(tmp_path)
+    ledger.close()
+
+
+def test_failed_log_write_fails_the_update(tmp_path, monkeypatch):
+    ledger = open_ledger(tmp_path)
+    ledger.update("u1", 1.0, "top-up")
+    ledger.wal.flush()
+
+    def broken_write(batch):
+        raise OSError("disk full")
+    monkeypatch.setattr(ledger.wal, "_write", broken_write)
+    ledger.wal.fsync = "always"
+
+    with pytest.raises(LogWriteError):
+        ledger.update("u1", 1.0, "top-up")
+    with pytest.raises(LogWriteError):
+        ledger.reserve("u1", "job-1", 0.5)
+    ledger.close()
+
+    ledger = open_ledger(tmp_path)
+    assert ledger.get("u1") == 1.0
+    ledger.close()
+
+
+def test_commit_floor_keeps_the_hold(tmp_path):
+    ledger = open_ledger(tmp_path)
+    ledger.update("u1", 1.0, "top-up")
+    ledger.reserve("u1", "job-1", 0.5)
+
+    with pytest.raises(InsufficientFunds):
+        ledger.commit("job-1", "u1", 1.5, floor=0)
+    assert ledger.get("u1") == 1.0
+    assert ledger.available("u1") == 0.5
+
+    assert ledger.commit("job-1", "u1", 1.0, floor=0) == 0.0
+    assert ledger.available("u1") == 0.0
+    ledger.close()
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_history_with_and_without_an_index(tmp_path, indexed):
+    index = BalanceLogIndex(str(tmp_path / "balance_index.db")) if indexed else None
+    ledger = open_ledger(tmp_path, index=index, max_bytes=200)  # rotates every couple of records
+    for amount in range(1, 8):
+        ledger.update("u1", float(amount), "credit")
+        ledger.update("u2", 1.0, "credit")
+        ledger.wal.flush()
+    assert len(log_segments(ledger.wal.path)) > 2
+    ledger.reserve("u1", "job-1", 2.0)
+    ledger.commit("job-1", "u1", 1.5)
+
+    history = ledger.history("u1", limit=3)
+    assert [entry["change"] for entry in history] == [-1.5, 7.0, 6.0]
+    assert history[0]["reason"] == "job deduction"
+    assert len(ledger.history("u1", limit=50)) == 8
+    assert ledger.history("u1", since=history[0]["timestamp"] + 1) == []
+    assert ledger.history("nobody") == []
+    ledger.close()
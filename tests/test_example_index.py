@@ -0,0 +1,102 @@
+import pytest
+
+from example_catalog import ExampleScoreCatalog
+from example_index import ExampleIndex
+
+PIANO_WALTZ = """\\version "2.24.1"
+\\header { title = "Little Waltz" }
+right = { \\key a \\minor \\time 3/4 a'4 c'' e'' | d''2. | }
+left = { \\key a \\minor \\time 3/4 a,4 e a | f2. | }
+\\score {
+  \\new PianoStaff <<
+    \\new Staff \\with { instrumentName = "Piano" midiInstrument = "acoustic grand" } \\right
+    \\new Staff \\left
+  >>
+}
+"""
+
+STRING_QUARTET = """\\version "2.24.1"
+\\header { title = "Quartet Movement" }
+violinOne = { \\key d \\major \\time 4/4 d''4 e'' fis'' g'' | a''1 | b''1 | a''1 | }
+violinTwo = { \\key d \\major \\time 4/4 a'4 b' cis'' d'' | e''1 | d''1 | cis''1 | }
+viola = { \\key d \\major \\time 4/4 fis'4 g' a' b' | cis''1 | g'1 | e'1 | }
+cello = { \\key d \\major \\time 4/4 d4 e fis g | a1 | g1 | a1 | }
+\\score {
+  <<
+    \\new Staff \\with { instrumentName = "Violin I" midiInstrument = "violin" } \\violinOne
+    \\new Staff \\with { instrumentName = "Violin II" midiInstrument = "violin" } \\violinTwo
+    \\new Staff \\with { instrumentName = "Viola" midiInstrument = "viola" } \\viola
+    \\new Staff \\with { instrumentName = "Cello" midiInstrument = "cello" } \\cello
+  >>
+}
+"""
+
+FLUTE_BARCAROLLE = """\\version "2.24.1"
+\\header { title = "Barcarolle" }
+flute = { \\key e \\minor \\time 6/8 b'4. g'8 a' b' | e''2. | }
+harp = { \\key e \\minor \\time 6/8 e8 g b e' g' b' | e2. | }
+\\score {
+  <<
+    \\new Staff \\with { instrumentName = "Flute" midiInstrument = "flute" } \\flute
+    \\new Staff \\with { instrumentName = "Harp" midiInstrument = "orchestral harp" } \\harp
+  >>
+}
+"""
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    for number, text in enumerate([PIANO_WALTZ, STRING_QUARTET, FLUTE_BARCAROLLE], 1):
+        (tmp_path / f"example_score_{number}.ly").write_text(text)
+    catalog = ExampleScoreCatalog(str(tmp_path))
+    assert catalog.load() == 3
+    return catalog
+
+
+@pytest.mark.parametrize("prompt, expected", [
+    ("A gentle waltz for piano", "example_score_1.ly"),
+    ("Something melancholy in A minor", "example_score_1.ly"),
+    ("A string quartet in D major", "example_score_2.ly"),
+    ("Slow movement for violin, viola and cello", "example_score_2.ly"),
+    ("A barcarolle for flute and harp", "example_score_3.ly"),
+    ("Pastoral piece in 6/8 for flute", "example_score_3.ly"),
+])
+def test_prompts_pick_the_matching_template(catalog, prompt, expected):
+    assert catalog.choose(prompt)["name"] == expected
+
+
+def test_unmatched_prompt_gets_the_smallest_template(catalog):
+    assert catalog.choose("zzz qqq")["name"] == catalog.smallest()["name"]
+
+
+def test_long_prompt_prefers_the_largest_template(catalog):
+    largest = max(catalog.examples, key=lambda example: example["tokens"])
+    assert catalog.choose("an epic extended piece")["name"] == largest["name"]
+
+
+def test_example_metadata(catalog):
+    quartet = catalog.examples[1]
+    assert quartet["key"] == "d major"
+    assert quartet["time"] == "4/4"
+    assert quartet["staves"] == 4
+    assert quartet["bars"] == 4
+
+
+def test_empty_catalog(tmp_path):
+    assert ExampleIndex([]).choose("A waltz for piano") is None
+
+    catalog = ExampleScoreCatalog(str(tmp_path))
+    assert catalog.load() == 0
+    assert catalog.smallest() is None
+    with pytest.raises(RuntimeError):
+        catalog.choose("A waltz for piano")
+
+
+def test_generation_without_examples_falls_back_to_no_template(app_main, tmp_path, monkeypatch):
+    empty = ExampleScoreCatalog(str(tmp_path))
+    empty.load()
+    monkeypatch.setattr(app_main, "example_catalog", empty)
+
+    messages, estimate, example = app_main.fit_generation_prompt("A waltz for piano", "gpt-4.1")
+    assert example is None
+    assert messages[-1]["content"] == "A waltz for piano"
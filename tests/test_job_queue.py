@@ -0,0 +1,48 @@
+import time
+
+from job_queue import SQLiteJobQueue
+
+
+def test_fifo_claim_and_ack(tmp_path):
+    job_queue = SQLiteJobQueue(str(tmp_path / "queue.db"))
+    job_queue.put({"job_id": "a"})
+    job_queue.put({"job_id": "b"})
+    assert job_queue.depth() == 2
+
+    message_id, payload = job_queue.get(timeout=0)
+    assert payload == {"job_id": "a"}
+    assert job_queue.depth() == 1
+    job_queue.ack(message_id)
+
+    assert job_queue.get(timeout=0)[1] == {"job_id": "b"}
+    assert job_queue.get(timeout=0) is None
+
+
+def test_unacked_message_is_handed_out_again_unless_heartbeat(tmp_path):
+    path = str(tmp_path / "queue.db")
+    worker = SQLiteJobQueue(path, visibility_timeout=0.2)
+    other = SQLiteJobQueue(path, visibility_timeout=0.2)
+    other.consumer = "other"
+    worker.put({"job_id": "a"})
+    worker.get(timeout=0)
+
+    time.sleep(0.3)
+    worker.heartbeat()
+    assert other.get(timeout=0) is None
+
+    time.sleep(0.3)
+    assert other.get(timeout=0)[1] == {"job_id": "a"}
+
+
+def test_service_times_come_from_live_workers(tmp_path):
+    path = str(tmp_path / "queue.db")
+    web = SQLiteJobQueue(path)
+    assert web.service_times() == []
+
+    worker = SQLiteJobQueue(path)
+    worker.report_service_times({"llm": 30.0, "lilypond": 4.0})
+    worker.report_service_times({"llm": 20.0, "lilypond": 4.0})
+    assert web.service_times() == [{"llm": 20.0, "lilypond": 4.0}]
+
+    web.heartbeat_interval = 0
+    assert web.service_times() == []
@@ -0,0 +1,192 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from job_scheduler import JobScheduler, SchedulerFull
+
+
+class Recorder:
+    """Collects the scheduler's callbacks and lets a test wait for finished jobs."""
+
+    def __init__(self):
+        self.errors = []
+        self.finished = []
+        self.advanced = []
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+
+    def on_error(self, ctx, error):
+        with self.lock:
+            self.errors.append((ctx["id"], error))
+
+    def on_advance(self, ctx, next_stage):
+        with self.lock:
+            self.advanced.append((ctx["id"], next_stage))
+
+    def on_finish(self, ctx):
+        with self.lock:
+            self.finished.append(ctx["id"])
+            self.done.notify_all()
+
+    def wait(self, count, timeout=5):
+        with self.lock:
+            assert self.done.wait_for(lambda: len(self.finished) >= count, timeout)
+
+
+def make_scheduler(recorder, stages, **kwargs):
+    kwargs.setdefault("max_pending", 10)
+    scheduler = JobScheduler(
+        stages, on_error=recorder.on_error, on_finish=recorder.on_finish,
+        on_advance=recorder.on_advance, **kwargs
+    )
+    scheduler.start()
+    return scheduler
+
+
+def passing(next_stage):
+    def handler(ctx):
+        ctx["trail"].append(next_stage)
+        return next_stage
+    return handler
+
+
+def test_jobs_run_through_every_stage():
+    recorder = Recorder()
+    scheduler = make_scheduler(recorder, [
+        ("llm", passing("lilypond"), 2),
+        ("lilypond", passing("audio"), 1),
+        ("audio", passing(None), 1),
+    ])
+    jobs = [{"id": i, "trail": []} for i in range(5)]
+    for ctx in jobs:
+        scheduler.submit(ctx)
+
+    recorder.wait(5)
+    assert sorted(recorder.finished) == list(range(5))
+    assert all(ctx["trail"] == ["lilypond", "audio", None] for ctx in jobs)
+    assert sorted(recorder.advanced) == sorted((i, stage) for i in range(5) for stage in ("lilypond", "audio"))
+    assert recorder.errors == []
+    assert scheduler.depth() == 0
+
+
+def test_stage_error_reaches_on_error_once_and_stops_the_job():
+    recorder = Recorder()
+    failure = RuntimeError("lilypond crashed")
+    audio_runs = []
+
+    def compile_stage(ctx):
+        raise failure
+
+    scheduler = make_scheduler(recorder, [
+        ("llm", passing("lilypond"), 1),
+        ("lilypond", compile_stage, 1),
+        ("audio", lambda ctx: audio_runs.append(ctx) or None, 1),
+    ])
+    scheduler.submit({"id": "job", "trail": []})
+
+    recorder.wait(1)
+    assert recorder.errors == [("job", failure)]
+    assert recorder.finished == ["job"]
+    assert audio_runs == []
+    assert scheduler.depth() == 0
+
+
+def test_on_advance_error_reaches_on_error_once():
+    recorder = Recorder()
+    failure = ValueError("checkpoint failed")
+
+    def on_advance(ctx, next_stage):
+        raise failure
+
+    scheduler = JobScheduler(
+        [("llm", passing("lilypond"), 1), ("lilypond", passing(None), 1)],
+        max_pending=10, on_error=recorder.on_error, on_finish=recorder.on_finish, on_advance=on_advance
+    )
+    scheduler.start()
+    ctx = {"id": "job", "trail": []}
+    scheduler.submit(ctx)
+
+    recorder.wait(1)
+    assert recorder.errors == [("job", failure)]
+    assert ctx["trail"] == ["lilypond"]
+
+
+def test_full_pipeline_refuses_jobs_unless_forced():
+    recorder = Recorder()
+    release = threading.Event()
+    scheduler = make_scheduler(recorder, [("llm", lambda ctx: release.wait(5) and None, 1)], max_pending=2)
+
+    scheduler.submit({"id": 1})
+    scheduler.submit({"id": 2})
+    assert not scheduler.has_capacity()
+    with pytest.raises(SchedulerFull):
+        scheduler.submit({"id": 3})
+    scheduler.submit({"id": 4}, force=True)
+    assert scheduler.depth() == 3
+
+    release.set()
+    recorder.wait(3)
+    assert scheduler.has_capacity()
+
+
+def test_estimate_uses_the_slowest_stage():
+    scheduler = JobScheduler(
+        [("llm", passing(None), 4), ("lilypond", passing(None), 1)],
+        max_pending=10, on_error=Recorder().on_error,
+        service_estimates={"llm": 20.0, "lilypond": 10.0}
+    )
+    # llm: 4 workers / 20 s = 0.2 jobs/s; lilypond: 1 / 10 s = 0.1 jobs/s
+    assert scheduler.estimate(0) == (0.0, 30.0)
+    assert scheduler.estimate(3) == (30.0, 30.0)
+    assert scheduler.estimate(3, capacity_scale=2) == (10.0, 30.0)
+
+
+def test_estimate_follows_observed_durations():
+    recorder = Recorder()
+
+    def slow(ctx):
+        time.sleep(0.05)
+        return None
+
+    scheduler = make_scheduler(recorder, [("llm", slow, 1)], max_pending=20, service_estimates={"llm": 10.0})
+    _, before = scheduler.estimate(0)
+    for i in range(20):
+        scheduler.submit({"id": i})
+    recorder.wait(20)
+
+    _, after = scheduler.estimate(0)
+    assert before == 10.0
+    assert 0.05 <= after < 1.0
+
+
+def test_async_stage_runs_on_the_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    recorder = Recorder()
+    failure = RuntimeError("llm down")
+
+    async def llm(ctx):
+        await asyncio.sleep(0.01)
+        if ctx["id"] == "bad":
+            raise failure
+        return "audio"
+
+    scheduler = make_scheduler(recorder, [("llm", llm, 8), ("audio", passing(None), 1)], loop=loop)
+    scheduler.submit({"id": "good", "trail": []})
+    scheduler.submit({"id": "bad", "trail": []})
+
+    recorder.wait(2)
+    assert sorted(recorder.finished) == ["bad", "good"]
+    assert recorder.errors == [("bad", failure)]
+    assert scheduler.stage_depths() == {"llm": 0, "audio": 0}
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_async_stage_needs_a_loop():
+    async def llm(ctx):
+        return None
+
+    with pytest.raises(ValueError):
+        JobScheduler([("llm", llm, 1)], max_pending=1, on_error=Recorder().on_error)
@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+import pytest
+
+from lilypond_stream import LilypondStream
+from openai_utils import TRAILING_DELTAS, StreamCollector
+
+CODE = "\\version \"2.24.1\"\n{ c'4 d' e' f' | g'1 | }"
+ANSWER = "Plan: a short piece.\n```lilypond\n" + CODE + "\n```"
+MESSAGES = [{"role": "user", "content": "A short piece"}]
+
+
+def split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def chunk(content=None, finish_reason=None):
+    return SimpleNamespace(model="gpt-4.1", usage=None, choices=[
+        SimpleNamespace(finish_reason=finish_reason, delta=SimpleNamespace(content=content))
+    ])
+
+
+def usage_chunk(prompt_tokens, completion_tokens):
+    return SimpleNamespace(model="gpt-4.1", choices=[], usage=SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens
+    ))
+
+
+def code_of(text):
+    return text.split("```lilypond\n", 1)[1].rsplit("\n```", 1)[0]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 11, len(ANSWER)])
+def test_fences_split_across_deltas(size):
+    stream = LilypondStream()
+    closed = [stream.feed(delta) for delta in split(ANSWER, size)]
+
+    assert closed[-1] and not any(closed[:-1])
+    assert stream.text == ANSWER
+    assert code_of(stream.text) == CODE
+    assert stream.bars == CODE.count("|")
+
+
+def test_text_after_the_fence_is_left_out():
+    stream = LilypondStream()
+    for delta in split(ANSWER + "\nHope you enjoy it!", 4):
+        stream.feed(delta)
+    assert stream.done
+    assert stream.text == ANSWER
+
+
+def test_no_closing_fence():
+    stream = LilypondStream()
+    for delta in split(ANSWER[:-3], 4):
+        assert not stream.feed(delta)
+    assert stream.in_code and not stream.done
+    assert stream.text == ANSWER[:-3]
+
+
+def test_usage_after_the_fence_is_kept():
+    collector = StreamCollector("gpt-4.1")
+    chunks = [chunk(delta) for delta in split(ANSWER, 3)]
+    chunks += [chunk("\n"), chunk(finish_reason="stop"), usage_chunk(120, 40)]
+
+    assert not any(collector.add(c) for c in chunks)
+    response = collector.response("gpt-4.1", MESSAGES)
+    assert code_of(response.choices[0].message.content) == CODE
+    assert response.choices[0].finish_reason == "stop"
+    assert response.usage.prompt_tokens == 120
+    assert response.usage.completion_tokens == 40
+    assert not getattr(response.usage, "estimated", False)
+
+
+def test_trailing_chatter_is_cut_off_and_usage_estimated():
+    collector = StreamCollector("gpt-4.1")
+    deltas = split(ANSWER, 3)
+    for delta in deltas:
+        assert not collector.add(chunk(delta))
+
+    stopped = [collector.add(chunk(" more")) for _ in range(TRAILING_DELTAS + 1)]
+    assert stopped == [False] * TRAILING_DELTAS + [True]
+
+    response = collector.response("gpt-4.1", MESSAGES)
+    assert code_of(response.choices[0].message.content) == CODE
+    assert response.choices[0].finish_reason == "stop"
+    assert response.usage.estimated
+    assert response.usage.completion_tokens == len(deltas) + TRAILING_DELTAS + 1
+
+
+def test_stream_without_closing_fence_has_no_finish_reason():
+    collector = StreamCollector("gpt-4.1")
+    for delta in split(ANSWER[:-3], 3):
+        collector.add(chunk(delta))
+    response = collector.response("gpt-4.1", MESSAGES)
+    assert response.choices[0].finish_reason is None
+    assert response.usage.estimated
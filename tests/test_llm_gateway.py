@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from llm_async import AsyncLLMGateway
+from llm_gateway import LLMGateway, LLMUnavailable
+
+FAST_RETRIES = {"*": {"backoff_base": 0.001, "backoff_max": 0.001}}
+
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+
+
+def connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://llm.test/v1/chat/completions"))
+
+
+def bad_request():
+    request = httpx.Request("POST", "http://llm.test/v1/chat/completions")
+    return openai.BadRequestError("bad", response=httpx.Response(400, request=request), body=None)
+
+
+class ScriptedCompletions:
+    """Raises the scripted errors in turn, then returns "ok"."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+class AsyncScriptedCompletions(ScriptedCompletions):
+    async def create(self, **kwargs):
+        return ScriptedCompletions.create(self, **kwargs)
+
+
+def sync_call(errors):
+    gateway = LLMGateway(model_config=FAST_RETRIES)
+    completions = ScriptedCompletions(errors)
+    gateway.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    try:
+        return gateway.chat_completion("m", []), completions.calls
+    except Exception as e:
+        return e, completions.calls
+
+
+def async_call(errors):
+    gateway = AsyncLLMGateway(LLMGateway(model_config=FAST_RETRIES))
+    completions = AsyncScriptedCompletions(errors)
+    gateway.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    try:
+        return gateway.submit(gateway.chat_completion("m", [])).result(timeout=5), completions.calls
+    except Exception as e:
+        return e, completions.calls
+
+
+@pytest.mark.parametrize("call", [sync_call, async_call])
+def test_retryable_errors_are_retried(call):
+    assert call([connection_error(), connection_error()]) == ("ok", 3)
+
+
+@pytest.mark.parametrize("call", [sync_call, async_call])
+def test_other_errors_are_raised_at_once(call):
+    error, calls = call([bad_request()])
+    assert isinstance(error, openai.BadRequestError)
+    assert calls == 1
+
+
+@pytest.mark.parametrize("call", [sync_call, async_call])
+def test_retries_stop_at_max_retries(call):
+    error, calls = call([connection_error()] * 10)
+    assert isinstance(error, openai.APIConnectionError)
+    assert calls == 4  # the first attempt and max_retries=3 more
+
+
+def test_open_circuit_rejects_calls_without_calling_the_api():
+    gateway = LLMGateway(model_config={"*": dict(FAST_RETRIES["*"], failure_threshold=3)})
+    completions = ScriptedCompletions([connection_error()] * 10)
+    gateway.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    with pytest.raises(LLMUnavailable):
+        gateway.chat_completion("m", [])  # the third failure opens the circuit
+    assert completions.calls == 3
+
+    calls = completions.calls
+    with pytest.raises(LLMUnavailable):
+        gateway.chat_completion("m", [])
+    assert completions.calls == calls
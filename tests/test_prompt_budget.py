@@ -0,0 +1,52 @@
+import pytest
+
+from prompt_budget import PromptTooLong, count_message_tokens, minify_lilypond
+
+
+def test_line_comments_are_dropped():
+    code = "\\version \"2.24.1\"  % the version\n% a whole line\nmelody = { c'4   d'4 % first bar\n  e'2 }\n"
+    assert minify_lilypond(code) == "\\version \"2.24.1\"\nmelody = { c'4 d'4\n  e'2 }"
+
+
+def test_block_comments_are_dropped():
+    code = "melody = {\n  %{ a block\n  with { braces } and \"quotes %}c'4 d'4\n  %{ inline %} e'2\n}"
+    # The comment's indentation stays in front of what followed it
+    assert minify_lilypond(code) == "melody = {\n  c'4 d'4\n   e'2\n}"
+
+
+def test_percent_inside_strings_is_kept():
+    code = (
+        "\\header { title = \"100% Etude\" subtitle = \"a \\\"quoted\\\" % sign\" }\n"
+        "\\override TextScript.stencil = #(lambda (grob) (grob-interpret-markup grob #\"50%  %{ x %}\"))"
+    )
+    assert minify_lilypond(code) == code
+
+
+def test_markup_text_keeps_its_spacing_in_strings():
+    code = "c'4^\\markup {   \\italic   \"dolce   e  cantabile\"  }   % expression\n"
+    assert minify_lilypond(code) == "c'4^\\markup { \\italic \"dolce   e  cantabile\" }"
+
+
+def test_indentation_and_music_are_unchanged():
+    code = "\\score {\n  \\new Staff {\n    \\time 3/4\n    c'4 e'8 g' c''4 |\n  }\n}"
+    assert minify_lilypond(code) == code
+
+
+def test_budget_falls_back_to_smaller_examples_but_keeps_the_prompt(app_main, monkeypatch):
+    prompt = "A slow nocturne in D flat major for solo piano"
+    full, full_estimate, example = app_main.fit_generation_prompt(prompt, "gpt-4.1")
+    assert example is not None
+    assert full[-1] == {"role": "user", "content": prompt}
+
+    no_example = count_message_tokens(app_main.generation_messages(prompt), "gpt-4.1")
+    monkeypatch.setenv("PROMPT_TOKEN_BUDGET", str(no_example))
+    messages, estimate, example = app_main.fit_generation_prompt(prompt, "gpt-4.1")
+    assert example is None
+    assert estimate <= no_example
+    assert messages[-1] == {"role": "user", "content": prompt}
+
+
+def test_budget_too_small_for_the_prompt_raises(app_main, monkeypatch):
+    monkeypatch.setenv("PROMPT_TOKEN_BUDGET", "10")
+    with pytest.raises(PromptTooLong):
+        app_main.fit_generation_prompt("A slow nocturne", "gpt-4.1")
@@ -0,0 +1,97 @@
+import sqlite3
+import time
+
+from job_queue import SQLiteJobQueue
+
+
+def test_start_refuses_a_balance_below_the_hold(app_main):
+    client = app_main.app.test_client()
+    app_main.balance_store.update("low-balance", 0.5, "credit")
+
+    for model in ("gpt-4.1-nano", "gpt-4.1"):
+        response = client.post("/start-smart-full-generate", json={
+            "prompt": "A short waltz", "user_id": "low-balance", "model": model
+        })
+        assert response.status_code == 403
+        assert response.get_json() == {"error": "Insufficient funds"}
+    assert app_main.balance_store.available("low-balance") == 0.5
+
+
+def test_hold_is_at_least_the_minimum_balance(app_main):
+    assert app_main.job_hold_amount("gpt-4.1-nano") == app_main.MIN_JOB_BALANCE
+    assert app_main.job_hold_amount("gpt-4.1") > app_main.MIN_JOB_BALANCE
+
+
+def test_failed_settlement_keeps_the_hold_and_is_retried(app_main, monkeypatch):
+    store = app_main.balance_store
+    store.update("settle-user", 5.0, "credit")
+    store.reserve("settle-user", "settle-job", 2.0)
+    app_main.job_store.create("settle-job", {"status": "completed", "user_id": "settle-user"})
+    monkeypatch.setattr(app_main, "SETTLE_RETRY_SECONDS", 0.05)
+
+    commit = store.commit
+    calls = []
+
+    def flaky_commit(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return commit(*args, **kwargs)
+    monkeypatch.setattr(store, "commit", flaky_commit)
+
+    ctx = {"job_id": "settle-job", "user_id": "settle-user", "hold_id": "settle-job"}
+    app_main.settle_job_cost(ctx, 1.0)
+    assert app_main.job_store.get("settle-job")["status"] == "completed"
+    assert store.available("settle-user") == 3.0
+
+    deadline = time.monotonic() + 5
+    while store.get("settle-user") != 4.0 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert store.available("settle-user") == 4.0
+    assert app_main.job_store.get("settle-job")["unsettled_cost"] is None
+
+
+def test_queue_admission_uses_worker_service_times(app_main, tmp_path, monkeypatch):
+    job_queue = SQLiteJobQueue(str(tmp_path / "queue.db"))
+    monkeypatch.setattr(app_main, "job_queue", job_queue)
+    monkeypatch.setattr(app_main, "WORKER_STATS_SECONDS", 0)
+    for _ in range(10):
+        job_queue.put({"job_id": "waiting"})
+
+    seeded = app_main.check_admission()
+
+    worker = SQLiteJobQueue(job_queue.db_path)
+    worker.report_service_times({"llm": 1.0, "lilypond": 0.5, "audio": 0.5})
+    measured = app_main.check_admission()
+    assert measured["queue_position"] == 11
+    assert measured["run_seconds"] == 2.0
+    assert measured["wait_seconds"] < seeded["wait_seconds"]
+
+    # A second worker doubles the throughput
+    second = SQLiteJobQueue(job_queue.db_path)
+    second.consumer = "second"
+    second.report_service_times({"llm": 1.0, "lilypond": 0.5, "audio": 0.5})
+    assert app_main.check_admission()["wait_seconds"] < measured["wait_seconds"]
+
+
+def test_job_status_projection_etags(app_main):
+    client = app_main.app.test_client()
+    app_main.job_store.create("etag-job", {"status": "completed", "user_id": "u", "title": "Waltz"})
+
+    assert client.get("/job-status/etag-job?fields=,").status_code == 400
+    assert client.get("/job-status/etag-job?fields=%20,%20").status_code == 400
+
+    compact = client.get("/job-status/etag-job")
+    projected = client.get("/job-status/etag-job?fields=title,status")
+    assert projected.get_json() == {"status": "completed", "title": "Waltz"}
+    assert client.get("/job-status/etag-job?fields=status,title").headers["ETag"] == projected.headers["ETag"]
+
+    etags = {compact.headers["ETag"], projected.headers["ETag"]}
+    for fields in ("compact", "all", "status"):
+        etags.add(client.get(f"/job-status/etag-job?fields={fields}").headers["ETag"])
+    assert len(etags) == 5
+
+    cached = client.get("/job-status/etag-job?fields=compact", headers={"If-None-Match": compact.headers["ETag"]})
+    assert cached.status_code == 200
+    assert cached.get_json() == {}
+    assert client.get("/job-status/etag-job", headers={"If-None-Match": compact.headers["ETag"]}).status_code == 304
@@ -0,0 +1,57 @@
+# backend/worker.py
+#
+# Consumer side of the job pipeline. Run one or more of these next to the
+# web process (JOB_QUEUE=sqlite|redis, JOB_STORE=sqlite):
+#
+#     python -m worker
+
+import time
+
+import main
+
+
+def run_worker():
+    job_queue = main.job_queue
+    scheduler = main.scheduler
+
+    if job_queue is None:
+        raise SystemExit("❌ JOB_QUEUE is not set; jobs already run inside the web process")
+
+    if hasattr(job_queue, "recover"):
+        recovered = job_queue.recover()
+        if recovered:
+            print(f"♻️ Re-queued {recovered} unfinished jobs from a previous run")
+
+    # ✅ Keeps claims on running jobs alive so they are not handed out twice,
+    # and shares this worker's stage timings for the web process's admission control
+    job_queue.start_heartbeat(stats=lambda: dict(scheduler.service_time))
+    scheduler.start()
+    print("👷 Worker started, waiting for jobs...")
+
+    while True:
+        # Only take work off the shared queue when this worker has room,
+        # so idle workers on other hosts can pick it up instead.
+        if not scheduler.has_capacity():
+            time.sleep(0.2)
+            continue
+
+        message = job_queue.get(timeout=5)
+        if message is None:
+            continue
+
+        message_id, ctx = message
+        ctx["queue_message_id"] = message_id
+
+        job = main.job_store.get(ctx["job_id"], include_large=False)
+        if job is None or job.get("status") in main.FINISHED_STATUSES:
+            # Finished (or cleared) before the ack landed; nothing to do
+            job_queue.ack(message_id)
+            continue
+
+        # A redelivered message picks up from the job's last checkpoint
+        ctx, stage = main.resume_point(ctx)
+        scheduler.submit(ctx, stage)
+
+
+if __name__ == "__main__":
+    run_worker()